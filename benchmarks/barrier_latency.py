@@ -0,0 +1,146 @@
+"""
+Benchmark: round barrier latency against the number of controllers.
+
+Runs the round barriers among N controllers within a single process,
+connected by a simulated network in which every message takes
+LATENCY seconds to arrive and COST seconds to be handled,
+each controller handling its messages one at a time.
+All controllers arrive at the barrier together,
+and the time till the last of them is released is measured.
+
+Usage:
+    python benchmarks/barrier_latency.py -n 2,8,32,128 -r 5
+"""
+
+# pylint: disable=redefined-builtin
+
+import time
+import asyncio
+import statistics
+
+import click
+from attrdict import AttrDict
+
+from matrix.barrier import BARRIERS
+
+
+class Network:
+    """
+    Simulated network between the controllers.
+    """
+
+    def __init__(self, latency, cost):
+        self.latency = latency
+        self.cost = cost
+        self.controllers = {}
+        self.num_messages = 0
+
+    def send(self, source, nodes, method, params):
+        loop = asyncio.get_event_loop()
+        for node in nodes:
+            inbox = self.controllers[node].inbox
+            self.num_messages += 1
+            if node == source:
+                inbox.put_nowait((method, params))
+            else:
+                loop.call_later(self.latency, inbox.put_nowait, (method, params))
+
+
+class StubController:
+    """
+    Controller stand in, with just what the barriers use.
+    """
+
+    def __init__(self, config, nodename, network, barrier_cls):
+        self.nodename = nodename
+        self.sim_nodes = config.sim_nodes
+        self.network = network
+        self.cur_round = 0
+        self.released = None
+
+        self.inbox = asyncio.Queue()
+        self.barrier = barrier_cls(self, config)
+
+    async def send_message(self, method, **params):
+        self.network.send(self.nodename, self.sim_nodes, method, params)
+
+    async def send_message_to(self, nodes, method, **params):
+        self.network.send(self.nodename, nodes, method, params)
+
+    async def round_released(self, round, num_expected):
+        self.cur_round = round + 1
+        self.released.set_result(time.perf_counter())
+
+    async def receive_loop(self):
+        while True:
+            method, params = await self.inbox.get()
+            if self.network.cost:
+                await asyncio.sleep(self.network.cost)
+            await self.barrier.methods[method](**params)
+
+
+async def run_rounds(barrier, num_nodes, num_rounds, fanout, latency, cost):
+    """
+    Run the barrier for a number of rounds.
+
+    Returns the barrier latencies and the number of messages per round.
+    """
+
+    nodes = [f"node{i}" for i in range(num_nodes)]
+    config = AttrDict({"sim_nodes": nodes, "barrier_fanout": fanout})
+
+    network = Network(latency, cost)
+    for node in nodes:
+        controller = StubController(config, node, network, BARRIERS[barrier])
+        network.controllers[node] = controller
+
+    controllers = list(network.controllers.values())
+    tasks = [asyncio.ensure_future(c.receive_loop()) for c in controllers]
+
+    loop = asyncio.get_event_loop()
+    latencies = []
+    for round in range(num_rounds):
+        for c in controllers:
+            c.released = loop.create_future()
+
+        start = time.perf_counter()
+        for c in controllers:
+            await c.barrier.arrive(round, {})
+        end = max(await asyncio.gather(*[c.released for c in controllers]))
+        latencies.append(end - start)
+
+    for task in tasks:
+        task.cancel()
+
+    return latencies, network.num_messages / num_rounds
+
+
+@click.command()
+@click.option(
+    "-n", "--nodes", default="2,4,8,16,32,64,128", help="Comma separated node counts"
+)
+@click.option("-r", "--rounds", default=5, help="Number of rounds per run")
+@click.option("-k", "--fanout", default=4, help="Fanout of the tree barrier")
+@click.option("-l", "--latency", default=0.0005, help="Network latency in seconds")
+@click.option("-c", "--cost", default=0.00005, help="Message handling cost in seconds")
+def main(nodes, rounds, fanout, latency, cost):
+    """
+    Print the barrier latency for every barrier and node count.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    print(f"{'barrier':>10} {'nodes':>6} {'latency (ms)':>13} {'messages':>9}")
+    for num_nodes in [int(n) for n in nodes.split(",")]:
+        for barrier in sorted(BARRIERS):
+            latencies, num_messages = loop.run_until_complete(
+                run_rounds(barrier, num_nodes, rounds, fanout, latency, cost)
+            )
+            latency_ms = statistics.median(latencies) * 1000
+            print(
+                f"{barrier:>10} {num_nodes:>6} {latency_ms:>13.2f} {num_messages:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Benchmark: sqlite3 store ingest and flush time against the update cache.
+
+Feeds a round of bluepill like updates, in chunks of agent ordered updates
+from interleaved agent processes, to a Sqlite3Store writing to a temporary
+database, and measures the time taken to ingest the chunks and to flush them.
+The store is compared with a variant keeping its update cache sorted
+as updates arrive, in a SortedList (from the sortedcontainers package),
+as the store used to.
+With a memory budget, the store spills sorted runs of updates to disk
+and the peak memory of the process is printed as well.
+
+Usage:
+    python benchmarks/store_flush.py -n 10000000 -P fast
+"""
+
+import os
+import time
+import resource
+import random
+import tempfile
+
+import click
+from sortedcontainers import SortedList
+
+from matrix.client.sqlite3_store import Sqlite3Store, get_first
+from matrix.sqlite_profile import DEFAULT_PROFILE, PROFILES
+
+SQL = "insert into event values (?,?,?)"
+
+
+class SortedListStore(Sqlite3Store):
+    """
+    Store inserting every update into a SortedList as it arrives.
+    """
+
+    def __init__(self, store_dsn, store_id, tracer=None, profile=DEFAULT_PROFILE, **_):
+        super().__init__(store_dsn, store_id, tracer, profile)
+        self.update_cache = SortedList(key=get_first)
+
+    def handle_updates(self, updates):
+        for store_type, store_id, order_key, update in updates:
+            if store_type != "sqlite3":
+                continue
+            if store_id != self.store_id:
+                continue
+
+            sql, params = update
+            self.update_cache.add((order_key, sql, params))
+
+    def flush(self):
+        if not self.update_cache:
+            return
+
+        with self.con:
+            cur = self.con.cursor()
+            for _, sql, params in self.update_cache:
+                if params is None:
+                    cur.execute(sql)
+                else:
+                    cur.execute(sql, tuple(params))
+
+        self.update_cache = SortedList(key=get_first)
+
+
+STORES = {"sortedlist": SortedListStore, "deferred": Sqlite3Store}
+
+
+def generate_chunks(num_updates, num_procs, chunk_size, seed):
+    """
+    Generate the chunks of updates of a round.
+
+    Every agent process sends its agents' updates in order, in chunks,
+    and the chunks of the processes arrive interleaved.
+    """
+
+    rng = random.Random(seed)
+    per_proc = num_updates // num_procs
+    next_agent = [0] * num_procs
+    procs = list(range(num_procs))
+
+    while procs:
+        proc = rng.choice(procs)
+        start = next_agent[proc]
+        end = min(start + chunk_size, per_proc)
+        next_agent[proc] = end
+        if end == per_proc:
+            procs.remove(proc)
+
+        chunk = []
+        for agent_idx in range(start, end):
+            agent_id = f"node1-{proc}-{agent_idx}"
+            params = [agent_id, "rock", 1]
+            chunk.append(["sqlite3", "event_store", [agent_id, 1], [SQL, params]])
+        yield chunk
+
+
+def run_store(store_cls, db_fname, store_kw, num_updates, num_procs, chunk_size, seed):
+    """
+    Ingest and flush a round of updates.
+
+    Returns the ingest and flush times.
+    """
+
+    store = store_cls(db_fname, "event_store", **store_kw)
+    store.con.execute("create table event (agent_id text, state text, round integer)")
+
+    ingest_time = 0.0
+    for chunk in generate_chunks(num_updates, num_procs, chunk_size, seed):
+        start = time.perf_counter()
+        store.handle_updates(chunk)
+        ingest_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    store.flush()
+    flush_time = time.perf_counter() - start
+
+    store.con.close()
+    return ingest_time, flush_time
+
+
+@click.command()
+@click.option("-n", "--updates", default=10_000_000, help="Number of updates")
+@click.option("-p", "--procs", default=16, help="Number of agent processes")
+@click.option("-c", "--chunk-size", default=1000, help="Updates per chunk")
+@click.option("-s", "--stores", default="sortedlist,deferred", help="Stores to run")
+@click.option(
+    "-P",
+    "--sqlite-profile",
+    type=click.Choice(sorted(PROFILES)),
+    default=DEFAULT_PROFILE,
+    help="Performance profile of the sqlite3 connection",
+)
+@click.option(
+    "-M",
+    "--max-cache-bytes",
+    default=0,
+    help="Memory budget of the deferred store's cache (0 for no budget)",
+)
+@click.option("--seed", default=42, help="Random seed of the chunk order")
+def main(updates, procs, chunk_size, stores, sqlite_profile, max_cache_bytes, seed):
+    """
+    Print the ingest and flush time of every store.
+
+    Run a single store to get its own peak memory.
+    """
+
+    store_kw = {"profile": sqlite_profile, "max_cache_bytes": max_cache_bytes}
+
+    print(
+        f"{'store':>10} {'ingest (s)':>11} {'flush (s)':>10} {'total (s)':>10}"
+        f" {'peak (MiB)':>11}"
+    )
+    for name in stores.split(","):
+        with tempfile.TemporaryDirectory() as tempdir:
+            db_fname = os.path.join(tempdir, "store.db")
+            ingest_time, flush_time = run_store(
+                STORES[name], db_fname, store_kw, updates, procs, chunk_size, seed
+            )
+        total_time = ingest_time + flush_time
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(
+            f"{name:>10} {ingest_time:>11.2f} {flush_time:>10.2f} {total_time:>10.2f}"
+            f" {peak:>11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,30 @@ def parse_config(config_fname, nodename=None):
             log.error(f"Controller port for node {node} is not defined")
             sys.exit(1)
 
+    for node in cfg.get("controller_socket", {}):
+        if node not in cfg.sim_nodes:
+            log.error(f"Controller socket defined for unknown node {node}")
+            sys.exit(1)
+
+    transport = cfg.get("transport", "auto")
+    if transport not in ("auto", "amqp", "mesh", "local"):
+        log.error(f"Unknown transport {transport}")
+        sys.exit(1)
+
+    if transport == "local" and len(cfg.sim_nodes) != 1:
+        log.error("The local transport can only be used with a single node")
+        sys.exit(1)
+
+    if transport == "mesh":
+        for node in cfg.sim_nodes:
+            if node not in cfg.get("mesh_address", {}):
+                log.error(f"Mesh address for node {node} is not defined")
+                sys.exit(1)
+
+    if cfg.get("barrier", "broadcast") not in ("broadcast", "tree"):
+        log.error(f"Unknown barrier {cfg.barrier}")
+        sys.exit(1)
+
     if nodename is not None and nodename not in cfg.sim_nodes:
         log.error(f"Nodename not in configured node list")
         sys.exit(1)
@@ -0,0 +1,217 @@
+"""
+Round barriers between controllers.
+
+A round ends once every controller's agents have finished the round
+and every controller has received all the events sent to it in the round.
+When a controller's agents finish, it arrives at the barrier with the number
+of store_events messages it sent to each controller during the round.
+The barrier releases the round once every controller has arrived,
+telling each controller how many messages to expect in total,
+and the controller ends the round once it has received them all.
+
+The barrier is selected with the barrier configuration option:
+
+    broadcast: every controller sends controller_finished to every other one,
+        O(N^2) messages per round, but only a single hop (default).
+    tree: arrivals are aggregated up a k-ary tree of the controllers
+        and the release is sent back down the tree, O(N) messages per round
+        and O(log N) hops. The tree's fanout is set by barrier_fanout.
+"""
+
+# pylint: disable=redefined-builtin
+
+from collections import Counter, defaultdict
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Key of the total number of messages sent in the counts of a round,
+# i.e. the number of messages the event logger is sent.
+TOTAL_KEY = "*"
+
+DEFAULT_FANOUT = 4
+
+
+class BarrierError(Exception):
+    pass
+
+
+class Barrier:
+    """
+    Base class of the round barriers.
+
+    Args:
+        controller: the local controller
+        config: the matrix configuration
+
+    Attributes:
+        methods: RPC methods used by the barrier, to be added to
+            the controller's dispatch.
+    """
+
+    def __init__(self, controller, config):
+        self.controller = controller
+        self.nodename = controller.nodename
+        self.methods = {}
+
+    async def arrive(self, round, counts):
+        """
+        Arrive at the barrier once the local agents have finished a round.
+
+        counts: nodename -> number of store_events messages sent to it this round,
+            along with the total number of messages sent.
+        """
+
+        raise NotImplementedError
+
+
+class BroadcastBarrier(Barrier):
+    """
+    Every controller tells every controller, including itself, that it has finished.
+    """
+
+    def __init__(self, controller, config):
+        super().__init__(controller, config)
+
+        self.num_controllers = len(config.sim_nodes)
+        self.num_finished = defaultdict(int)
+        self.num_expected = defaultdict(int)
+
+        self.methods = {"controller_finished": self.controller_finished}
+
+    async def arrive(self, round, counts):
+        await self.controller.send_message(
+            "controller_finished", nodename=self.nodename, round=round, counts=counts
+        )
+
+    async def controller_finished(self, nodename, round=None, counts=None):
+        """
+        RPC method: Used by other controllers to signal they have finished.
+
+        nodename: nodename of the finished controller.
+        round: the round that was finished
+        counts: number of store_events messages sent by the controller, per nodename
+        """
+
+        if round is None:
+            round = self.controller.cur_round
+
+        self.num_finished[round] += 1
+        if counts:
+            self.num_expected[round] += counts.get(self.nodename, 0)
+
+        num_finished = self.num_finished[round]
+        log.info(f"{num_finished}/{self.num_controllers} controllers are waiting ...")
+
+        if self.num_finished[round] != self.num_controllers:
+            return
+
+        del self.num_finished[round]
+        expected = self.num_expected.pop(round, 0)
+        await self.controller.round_released(round, expected)
+
+
+class TreeBarrier(Barrier):
+    """
+    Arrivals are aggregated up a k-ary tree and the release is sent down it.
+
+    Controllers are placed in the tree in the order of sim_nodes,
+    the first being the root and the children of the i-th being
+    the (k * i + 1)-th to the (k * i + k)-th.
+    """
+
+    def __init__(self, controller, config):
+        super().__init__(controller, config)
+
+        fanout = config.get("barrier_fanout", DEFAULT_FANOUT)
+        if fanout < 1:
+            raise BarrierError("barrier_fanout must be at least 1")
+
+        nodes = config.sim_nodes
+        i = nodes.index(self.nodename)
+        self.parent = nodes[(i - 1) // fanout] if i > 0 else None
+        self.children = nodes[fanout * i + 1 : fanout * i + fanout + 1]
+
+        self.num_arrived = defaultdict(int)
+        self.counts = defaultdict(Counter)
+
+        self.methods = {
+            "barrier_arrive": self.barrier_arrive,
+            "barrier_release": self.barrier_release,
+        }
+
+    async def arrive(self, round, counts):
+        await self.controller.send_message_to(
+            [self.nodename],
+            "barrier_arrive",
+            nodename=self.nodename,
+            round=round,
+            counts=counts,
+        )
+
+    async def barrier_arrive(self, nodename, round, counts):
+        """
+        RPC method: Used by controllers to arrive at the barrier.
+
+        Each controller arrives at its own barrier and at its parent's,
+        on behalf of its subtree.
+
+        nodename: nodename of the arriving controller
+        round: the round that was finished
+        counts: number of store_events messages sent in the subtree, per nodename
+        """
+
+        self.num_arrived[round] += 1
+        self.counts[round].update(counts)
+
+        num_waiting = len(self.children) + 1
+        log.info(f"{self.num_arrived[round]}/{num_waiting} subtrees are waiting ...")
+
+        if self.num_arrived[round] != num_waiting:
+            return
+
+        del self.num_arrived[round]
+        counts = dict(self.counts.pop(round))
+
+        if self.parent is None:
+            await self.barrier_release(round, counts)
+        else:
+            await self.controller.send_message_to(
+                [self.parent],
+                "barrier_arrive",
+                nodename=self.nodename,
+                round=round,
+                counts=counts,
+            )
+
+    async def barrier_release(self, round, counts):
+        """
+        RPC method: Used by the parent in the tree to release a round.
+
+        round: the round that was released
+        counts: number of store_events messages sent in the round, per nodename
+        """
+
+        # The root sends the release even without children,
+        # as the event logger is sent a copy of every message.
+        if self.children or self.parent is None:
+            await self.controller.send_message_to(
+                self.children, "barrier_release", round=round, counts=counts
+            )
+
+        await self.controller.round_released(round, counts.get(self.nodename, 0))
+
+
+BARRIERS = {"broadcast": BroadcastBarrier, "tree": TreeBarrier}
+
+
+def get_barrier(controller, config):
+    """
+    Create the configured barrier.
+    """
+
+    name = config.get("barrier", "broadcast")
+    if name not in BARRIERS:
+        raise BarrierError(f"Unknown barrier {name!r}")
+    return BARRIERS[name](controller, config)
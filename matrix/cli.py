@@ -17,6 +17,8 @@ from .controller import main_controller
 from .eventlog import main_eventlog
 from .run_rabbitmq import main_rabbitmq_start, main_rabbitmq_stop
 from .client.sqlite3_store import main_sqlite3_store
+from .sqlite_profile import PROFILES
+from .tracing import merge_traces
 
 log = logbook.Logger(__name__)
 
@@ -79,9 +81,58 @@ def controller(config, nodename):
     "-d", "--store-id", required=True, type=str, help="ID of the sqlite3 file"
 )
 @click.option(
-    "-p", "--controller-port", required=True, type=int, help="Controller port"
+    "-p",
+    "--controller-port",
+    required=True,
+    type=str,
+    help="Controller port or unix domain socket path",
 )
 @click.option("-i", "--storeproc-id", required=True, type=int, help="Store process id")
+@click.option(
+    "-f",
+    "--framing",
+    type=click.Choice(["line", "json", "msgpack"]),
+    default="json",
+    help="Protocol used to talk to the controller",
+)
+@click.option(
+    "-w",
+    "--stream-window",
+    type=int,
+    default=16,
+    help="Number of unacknowledged event pushes (0 to poll with get_events)",
+)
+@click.option(
+    "-P",
+    "--sqlite-profile",
+    type=click.Choice(sorted(PROFILES)),
+    default=None,
+    help="Performance profile of the sqlite3 connection (default: from the controller)",
+)
+@click.option(
+    "-M",
+    "--max-cache-bytes",
+    type=int,
+    default=None,
+    help="Memory budget of the cached updates, beyond which they are spilled to disk"
+    " (0 for no budget, default: from the controller or 1 GiB)",
+)
+@click.option(
+    "-t",
+    "--spill-dir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    default=None,
+    help="Directory of the updates spilled to disk (default: system temp directory)",
+)
+@click.option(
+    "-D",
+    "--flush-depth",
+    type=int,
+    default=0,
+    help="Number of flushes applied on a writer thread while the next rounds"
+    " are received, so agents may read the store that many rounds behind"
+    " (0 to flush before receiving further events)",
+)
 def sqlite3_store(**kwargs):
     """
     Start a sqlite3 store process.
@@ -114,6 +165,32 @@ def eventlog(config, output):
     return main_eventlog(cfg, output)
 
 
+@cli.group()
+def trace():
+    """
+    Work with traces of runs (see MATRIX_TRACE_DIR).
+    """
+
+
+@trace.command("merge")
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(exists=False, dir_okay=False),
+    help="Merged trace file",
+)
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+def trace_merge(output, paths):
+    """
+    Merge the traces of processes into a Chrome/Perfetto trace.
+
+    PATHS are trace files, or directories containing them.
+    """
+
+    merge_traces(paths, output)
+
+
 @cli.group()
 def rabbitmq():
     """
@@ -0,0 +1,230 @@
+"""
+Asyncio version of the RPC proxy.
+
+Unlike RPCProxy, the asyncio proxy can have many calls in flight
+on a single connection. Responses are matched to calls by their id,
+so agents and stores can pipeline work against the controller.
+"""
+
+import json
+import time
+import asyncio
+from uuid import uuid4
+from functools import partial
+
+import logbook
+
+from ..framing import (
+    FramingError,
+    handshake_request,
+    read_message,
+    write_message,
+)
+from ..rawjson import dumps
+from .rpcproxy import RPCException, is_socket_path, check_response
+
+log = logbook.Logger(__name__)
+
+# Stream buffer limit for the line protocol, matches the controller
+BUFSIZE = 16 * 2 ** 30
+
+# Default maximum number of calls in flight
+MAX_INFLIGHT = 64
+
+
+class AsyncRPCProxy:
+    """
+    Asyncio RPC Proxy class for calling controller functions.
+
+    Args:
+        host: host where the controller is running
+        port: port where the controller is listening,
+            or the path of the controller's unix domain socket.
+        framing: codec for the framed protocol ("json" or "msgpack"),
+            or None to use the newline delimited protocol.
+        max_inflight: maximum number of calls waiting for a response;
+            further calls wait till earlier ones complete.
+
+    Usage:
+        async with AsyncRPCProxy("127.0.0.1", port, "json") as proxy:
+            seed = await proxy.call("get_agentproc_seed", agentproc_id=0)
+    """
+
+    def __init__(self, host, port, framing=None, max_inflight=MAX_INFLIGHT):
+        self.host = host
+        self.port = port
+        self.framing = framing
+
+        self.codec = None
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+
+        self.max_inflight = max_inflight
+        self.inflight = {}
+
+        # These are created in connect, inside the running event loop
+        self.slots = None
+        self.write_lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type_, value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """
+        Connect to the controller.
+        """
+
+        if is_socket_path(self.port):
+            address_str = self.port
+            connect = partial(asyncio.open_unix_connection, self.port, limit=BUFSIZE)
+        else:
+            address_str = f"{self.host}:{self.port}"
+            connect = partial(
+                asyncio.open_connection, self.host, int(self.port), limit=BUFSIZE
+            )
+
+        log.notice(f"Connecting to controller at: {address_str}")
+
+        self.slots = asyncio.Semaphore(self.max_inflight)
+        self.write_lock = asyncio.Lock()
+
+        timeout = 60
+        start = time.time()
+        while True:
+            try:
+                self.reader, self.writer = await connect()
+                break
+            except OSError as e:
+                log.info("Failed to connect to controller: {}", e)
+
+                since = time.time() - start
+                if since > timeout:
+                    raise RuntimeError("Failed to connect to controller")
+                else:
+                    await asyncio.sleep(5)
+
+        if self.framing is not None:
+            self.codec = await self.negotiate_framing(self.framing)
+
+        self.receiver = asyncio.ensure_future(self.receive_loop())
+
+    async def negotiate_framing(self, codec):
+        """
+        Ask the controller to switch to the framed protocol.
+
+        Returns the codec if the controller accepted, None otherwise.
+        """
+
+        self.writer.write(handshake_request(codec))
+        await self.writer.drain()
+
+        reply = await self.reader.readline()
+        reply = reply.decode("ascii").strip()
+        if reply == f"OK {codec}":
+            return codec
+
+        log.warning("Controller refused framed protocol: {}", reply)
+        return None
+
+    async def close(self):
+        """
+        Close the connection, failing any calls still in flight.
+        """
+
+        if self.writer is None:
+            return
+
+        self.writer.close()
+        if self.receiver is not None:
+            self.receiver.cancel()
+            try:
+                await self.receiver
+            except asyncio.CancelledError:
+                pass
+
+        self.fail_inflight(RPCException("Connection closed"))
+
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+
+    async def call(self, method, **params):
+        """
+        Call the remote function.
+        """
+
+        log.info("Calling method: {}", method)
+
+        msg_id = str(uuid4())
+        msg = {"jsonrpc": "2.0", "id": msg_id, "method": method, "params": params}
+
+        if self.receiver is None or self.receiver.done():
+            raise RPCException("Not connected to controller")
+
+        await self.slots.acquire()
+        try:
+            future = asyncio.get_event_loop().create_future()
+            self.inflight[msg_id] = future
+
+            async with self.write_lock:
+                self.write_message(msg)
+                await self.writer.drain()
+
+            ret = await future
+        finally:
+            self.inflight.pop(msg_id, None)
+            self.slots.release()
+
+        return check_response(ret)
+
+    def write_message(self, msg):
+        if __debug__:
+            log.debug("RPC ->\n{}", json.dumps(msg, indent=2, sort_keys=True, default=repr))
+
+        if self.codec is None:
+            self.writer.write(dumps(msg) + b"\n")  # NOTE: The newline is important
+        else:
+            write_message(self.writer, self.codec, msg)
+
+    async def read_message(self):
+        if self.codec is None:
+            line = await self.reader.readline()
+            if not line:
+                return None
+            return json.loads(line)
+
+        return await read_message(self.reader, self.codec, keep_raw=False)
+
+    async def receive_loop(self):
+        """
+        Read responses and hand them over to the waiting calls.
+        """
+
+        try:
+            while True:
+                ret = await self.read_message()
+                if ret is None:
+                    raise RPCException("Connection closed by controller")
+
+                if __debug__:
+                    log.debug("RPC <-\n{}", json.dumps(ret, indent=2, sort_keys=True))
+
+                future = self.inflight.get(ret.get("id"))
+                if future is None:
+                    log.warning("Received response to unknown call: {}", ret)
+                    continue
+                if not future.done():
+                    future.set_result(ret)
+        except (RPCException, FramingError, EOFError, OSError, ValueError) as e:
+            self.fail_inflight(e)
+
+    def fail_inflight(self, exc):
+        for future in self.inflight.values():
+            if not future.done():
+                future.set_exception(exc)
+
@@ -7,7 +7,9 @@ import sqlite3
 
 import logbook
 
-from .rpcproxy import RPCProxy
+from .rpcproxy import RPCProxy, RawJSON
+from ..sqlite_profile import DEFAULT_PROFILE, sqlite_connect
+from ..tracing import get_tracer
 
 log = logbook.Logger(__name__)
 
@@ -75,9 +77,13 @@ def main_agent(**kwargs):
     store_dsn = kwargs["store_dsn"]
     agentproc_id = kwargs["agentproc_id"]
     num_agents = kwargs["num_agents"]
+    framing = kwargs.get("framing", "line")
+    framing = None if framing == "line" else framing
+    sqlite_profile = kwargs.get("sqlite_profile", DEFAULT_PROFILE)
 
-    with RPCProxy("127.0.0.1", port) as proxy:
-        con = sqlite3.connect(store_dsn)
+    tracer = get_tracer(f"agent {node}/{agentproc_id}")
+    with RPCProxy("127.0.0.1", port, framing, tracer) as proxy:
+        con = sqlite_connect(store_dsn, sqlite_profile)
 
         agentproc_seed = proxy.call("get_agentproc_seed", agentproc_id=agentproc_id)
         random.seed(agentproc_seed)
@@ -88,7 +94,9 @@ def main_agent(**kwargs):
             if round_info["cur_round"] == -1:
                 return
 
-            updates = do_something(node, agentproc_id, num_agents, con, round_info)
+            with tracer.span("agent_compute", round=round_info["cur_round"]):
+                updates = do_something(node, agentproc_id, num_agents, con, round_info)
+                updates = RawJSON.dumps(updates)
             proxy.call("register_events", agentproc_id=agentproc_id, events=updates)
 
 
@@ -8,6 +8,7 @@ import logbook
 from logbook.compat import redirect_logging
 
 from .bluepill_agent import main_agent, main_store_init
+from ..sqlite_profile import DEFAULT_PROFILE, PROFILES
 
 
 @click.group()
@@ -56,7 +57,13 @@ def store_init(**kwargs):
 
 @cli.command("agent-start")
 @click.option("-n", "--ctrl-node", required=True, type=str, help="Controller node name")
-@click.option("-p", "--ctrl-port", required=True, type=int, help="Controller port")
+@click.option(
+    "-p",
+    "--ctrl-port",
+    required=True,
+    type=str,
+    help="Controller port or unix domain socket path",
+)
 @click.option(
     "-s",
     "--store-dsn",
@@ -68,6 +75,20 @@ def store_init(**kwargs):
 @click.option(
     "-m", "--num-agents", default=1, help="Number of agents this process simulates"
 )
+@click.option(
+    "-f",
+    "--framing",
+    type=click.Choice(["line", "json", "msgpack"]),
+    default="json",
+    help="Protocol used to talk to the controller",
+)
+@click.option(
+    "-P",
+    "--sqlite-profile",
+    type=click.Choice(sorted(PROFILES)),
+    default=DEFAULT_PROFILE,
+    help="Performance profile of the sqlite3 connection",
+)
 def agent_start(**kwargs):
     """
     Start a BluePill agent process.
@@ -9,6 +9,18 @@ from uuid import uuid4
 
 import logbook
 
+from ..framing import (
+    FramingError,
+    handshake_request,
+    recv_line,
+    recv_message,
+    send_message,
+)
+from ..histogram import MethodStats
+from ..json_rpc import payload_size
+from ..rawjson import RawJSON, dumps
+from ..tracing import NullTracer
+
 log = logbook.Logger(__name__)
 
 
@@ -16,18 +28,51 @@ class RPCException(Exception):
     pass
 
 
+def is_socket_path(port):
+    """
+    Check if the given controller port is a unix domain socket path.
+    """
+
+    return isinstance(port, str) and not port.isdigit()
+
+
 class RPCProxy:
     """
     RPC Proxy class for calling controller functions.
+
+    Args:
+        host: host where the controller is running
+        port: port where the controller is listening,
+            or the path of the controller's unix domain socket.
+        framing: codec for the framed protocol ("json" or "msgpack"),
+            or None to use the newline delimited protocol.
+        tracer: tracer recording a span for every call (see matrix.tracing)
+
+    Attributes:
+        rpc_stats: round trip latency and payload size histograms per method,
+            logged when the proxy is closed
     """
 
-    def __init__(self, host, port):
-        address = (host, port)
+    def __init__(self, host, port, framing=None, tracer=None):
+        self.tracer = NullTracer() if tracer is None else tracer
+        self.rpc_stats = MethodStats()
 
-        address_str = ":".join(map(str, address))
-        log.notice(f"Connecting to controller at: {address_str}")
+        # Set before connecting, for close to work if connecting fails
+        self.sock = None
+        self.codec = None
+        self.fobj = None
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if is_socket_path(port):
+            address = port
+            address_str = port
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            address = (host, int(port))
+            address_str = ":".join(map(str, address))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        log.notice(f"Connecting to controller at: {address_str}")
 
         timeout = 60
         start = time.time()
@@ -44,16 +89,37 @@ class RPCProxy:
                 else:
                     time.sleep(5)
 
-        self.fobj = self.sock.makefile(mode="r", encoding="ascii")
+        if framing is not None:
+            self.codec = self.negotiate_framing(framing)
+        if self.codec is None:
+            self.fobj = self.sock.makefile(mode="r", encoding="ascii")
+
+    def negotiate_framing(self, codec):
+        """
+        Ask the controller to switch to the framed protocol.
+
+        Returns the codec if the controller accepted, None otherwise.
+        """
+
+        self.sock.sendall(handshake_request(codec))
+        reply = recv_line(self.sock).decode("ascii").strip()
+        if reply == f"OK {codec}":
+            return codec
+
+        log.warning("Controller refused framed protocol: {}", reply)
+        return None
 
     def close(self):
         if self.sock is not None:
-            self.fobj.close()
+            if self.fobj is not None:
+                self.fobj.close()
             self.sock.close()
 
             self.fobj = None
             self.sock = None
 
+            self.rpc_stats.log_summary("RPC round trips:")
+
     def __del__(self):
         self.close()
 
@@ -66,27 +132,170 @@ class RPCProxy:
     def call(self, method, **params):
         """
         Call the remote function.
+
+        Parameters may be RawJSON objects, e.g. events serialized
+        with RawJSON.dumps, which the controller passes on without decoding.
         """
 
         log.info("Calling method: {}", method)
 
         msg = {"jsonrpc": "2.0", "id": str(uuid4()), "method": method, "params": params}
+        with self.tracer.span(method, "rpc"), self.rpc_stats.timer(method) as timer:
+            timer.size = payload_size(params)
+            ret = self.roundtrip(msg)
+        return check_response(ret)
+
+    def notify(self, method, **params):
+        """
+        Send a notification; the controller sends back no response.
+        """
+
+        msg = {"jsonrpc": "2.0", "method": method, "params": params}
+        self.send(msg)
+
+    def receive(self):
+        """
+        Wait for the next message pushed by the controller.
+        """
+
+        with self.tracer.span("receive", "rpc"):
+            ret = self.recv()
+        if "jsonrpc" not in ret or ret["jsonrpc"] != "2.0" or "method" not in ret:
+            raise RPCException("Invalid RPC Notification", ret)
+
+        return ret["method"], ret.get("params", {})
+
+    def batch(self):
+        """
+        Create a batch of calls, sent together when the batch context exits.
+
+        Usage:
+            with proxy.batch() as batch:
+                batch.call("register_events", agentproc_id=0, events=events1)
+                batch.call("register_events", agentproc_id=0, events=events2)
+            results = batch.results  # see RPCBatch
+        """
+
+        return RPCBatch(self)
+
+    def roundtrip(self, msg):
+        """
+        Send a request (or a batch of requests) and read back the response.
+        """
+
+        self.send(msg)
+        return self.recv()
+
+    def send(self, msg):
         if __debug__:
-            log.debug("RPC ->\n{}", json.dumps(msg, indent=2, sort_keys=True))
+            log.debug("RPC ->\n{}", json.dumps(msg, indent=2, sort_keys=True, default=repr))
 
-        msg = json.dumps(msg) + "\n"  # NOTE: The newline is important
-        msg = msg.encode("ascii")
-        self.sock.sendall(msg)
+        if self.codec is None:
+            msg = dumps(msg) + b"\n"  # NOTE: The newline is important
+            self.sock.sendall(msg)
+        else:
+            send_message(self.sock, self.codec, msg)
 
-        ret = self.fobj.readline()
-        ret = json.loads(ret)
+    def recv(self):
+        if self.codec is None:
+            ret = self.fobj.readline()
+            if not ret:
+                raise RPCException("Connection closed by controller")
+            ret = json.loads(ret)
+        else:
+            try:
+                ret = recv_message(self.sock, self.codec, keep_raw=False)
+            except FramingError as e:
+                raise RPCException("Failed to read RPC Response", str(e))
 
         if __debug__:
             log.debug("RPC <-\n{}", json.dumps(ret, indent=2, sort_keys=True))
 
-        if "jsonrpc" not in ret or ret["jsonrpc"] != "2.0":
+        return ret
+
+
+class RPCBatch:
+    """
+    A batch of RPC calls sent to the controller in a single write.
+
+    Attributes:
+        results: results of the calls in the order they were made,
+            available after the batch has been sent.
+            A call that failed has its RPCException in place of its result.
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.requests = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.send()
+
+    def call(self, method, **params):
+        """
+        Add a call to the batch.
+
+        Returns the index of the call's result in results.
+        """
+
+        msg = {"jsonrpc": "2.0", "id": str(uuid4()), "method": method, "params": params}
+        self.requests.append(msg)
+        return len(self.requests) - 1
+
+    def send(self):
+        """
+        Send the batch and collect the results.
+        """
+
+        if not self.requests:
+            self.results = []
+            return self.results
+
+        log.info("Calling batch of {} methods", len(self.requests))
+
+        span = self.proxy.tracer.span("batch", "rpc", calls=len(self.requests))
+        with span, self.proxy.rpc_stats.timer("batch"):
+            ret = self.proxy.roundtrip(self.requests)
+        if not isinstance(ret, list):
+            # The whole batch was rejected
+            check_response(ret)
             raise RPCException("Invalid RPC Response", ret)
-        if "error" in ret:
-            raise RPCException("RPCException", ret)
 
-        return ret["result"]
+        by_id = {}
+        for response in ret:
+            if isinstance(response, dict) and "id" in response:
+                by_id[response["id"]] = response
+
+        results = []
+        for request in self.requests:
+            try:
+                response = by_id[request["id"]]
+            except KeyError:
+                raise RPCException("Missing RPC Response", request["method"])
+
+            try:
+                results.append(check_response(response))
+            except RPCException as e:
+                results.append(e)
+
+        self.requests = []
+        self.results = results
+        return results
+
+
+def check_response(ret):
+    """
+    Check the response and return the result.
+    """
+
+    if "jsonrpc" not in ret or ret["jsonrpc"] != "2.0":
+        raise RPCException("Invalid RPC Response", ret)
+    if "error" in ret:
+        raise RPCException("RPCException", ret)
+
+    return ret["result"]
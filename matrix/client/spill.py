@@ -0,0 +1,110 @@
+"""
+Sorted runs of store updates spilled to temporary files.
+
+A store that caches more updates than its memory budget allows
+sorts them and writes them out as a run, to be merged back at flush time.
+A run is written in batches of updates, each batch encoded with marshal,
+which is compact and fast for the lists, strings and numbers updates are made of,
+and prefixed with its length.
+Runs are only read back by the process that wrote them,
+so marshal's format changing between Python versions does not matter.
+"""
+
+import gc
+import sys
+import struct
+import marshal
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Number of updates per encoded batch,
+# and hence held in memory per run while the runs are merged
+BATCH_SIZE = 4096
+
+LENGTH = struct.Struct("<I")
+
+# Number of threads in gc_paused, and whether the collector was enabled
+# when the first of them entered it
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+def approx_size(value):
+    """
+    Approximate memory used by a value made of lists, dicts, strings and numbers.
+    """
+
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(approx_size(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    return size
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector.
+
+    Reading back runs allocates millions of lists and tuples,
+    which would trigger collections that find nothing, as updates have no cycles.
+    The collector is paused for the whole process, so pauses of several threads
+    are counted, the collector being resumed when the last of them ends.
+    """
+
+    global _gc_pauses, _gc_was_enabled  # pylint: disable=global-statement
+
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+class SpilledRun:
+    """
+    A sorted run of updates in a temporary file.
+
+    Iterating over the run reads the updates back, in order,
+    and then deletes the file.
+
+    Args:
+        updates: sorted list of updates
+        dir: directory of the temporary file, the system's default if None
+    """
+
+    def __init__(self, updates, dir=None):  # pylint: disable=redefined-builtin
+        self.count = len(updates)
+        self.fobj = tempfile.TemporaryFile(dir=dir)
+
+        for i in range(0, len(updates), BATCH_SIZE):
+            data = marshal.dumps(updates[i : i + BATCH_SIZE])
+            self.fobj.write(LENGTH.pack(len(data)))
+            self.fobj.write(data)
+
+        self.nbytes = self.fobj.tell()
+        self.fobj.seek(0)
+
+    def __iter__(self):
+        read = self.fobj.read
+        while True:
+            head = read(LENGTH.size)
+            if not head:
+                break
+            (size,) = LENGTH.unpack(head)
+            yield from marshal.loads(read(size))
+
+        self.close()
+
+    def close(self):
+        self.fobj.close()
@@ -2,6 +2,7 @@
 Sqlite3 store process code.
 
 This module connects to the Matrix controller,
+declares the store it serves using the register_store RPC call,
 and retrieves updates using the get_events RPC call.
 
 Every update is a 4 tuple: (store_type, store_id, order_key, update)
@@ -16,27 +17,61 @@ For sqlite3_store, store_id is a string representing a sqlite3 database.
 If there are two updates with order_key ok1 and ok2 such that ok1 < ok2
 the update with order key ok1 will be applied before the update
 with order key ok2.
+Updates with equal order keys are applied in the order they were received.
 
 `update' is a store store specific data structure that actually
 contains the update that is to be applied to the store object.
 For sqlite3_store, every update is a two tuple (sql, params).
 If params is None, it is assumed that the sql statement has no parameters.
+
+The updates of a round are cached till the round's FLUSH.
+When they exceed the store's memory budget, they are sorted
+and spilled to a temporary file as a run (see spill),
+and the runs are merged with the updates still in memory at flush time,
+so rounds of any size are applied in bounded memory.
+
+Flushes are applied synchronously by default, the store process
+receiving the next round's updates only once the flush is committed.
+With a positive flush depth, they are applied on a writer thread instead
+(see FlushWriter), overlapping the next rounds.
 """
 
-import sqlite3
+import sys
+import heapq
+import queue
+import threading
+from itertools import groupby
 
 import logbook
-from sortedcontainers import SortedList
 
 from .rpcproxy import RPCProxy
+from .spill import SpilledRun, approx_size, gc_paused
+from ..sqlite_profile import DEFAULT_PROFILE, sqlite_connect
+from ..tracing import NullTracer, get_tracer
 
 log = logbook.Logger(__name__)
 
+# Default memory budget of the update cache
+MAX_CACHE_BYTES = 2 ** 30
+
 
 def get_first(xs):
     return xs[0]
 
 
+def get_statement(xs):
+    return xs[1], xs[2] is None
+
+
+def cached_update_size(update):
+    """
+    Approximate memory used by a cached update, bar its shared sql string.
+    """
+
+    order_key, _, params = update
+    return 8 + sys.getsizeof(update) + approx_size(order_key) + approx_size(params)
+
+
 class Sqlite3Store:
     """
     Sqlite3 data store.
@@ -45,15 +80,35 @@ class Sqlite3Store:
         store_dsn: Path of the sqlite3 database file
         store_id: ID of the sqlite3 database file
         con: sqlite3 connection object
-        update_cache: sorted list of updates
+        update_cache: updates of the current round, in the order received
+        cache_bytes: approximate memory used by the update cache
+        spilled_runs: sorted runs of the current round's updates spilled to disk
+        tracer: tracer recording a span for every flush
+        profile: performance profile of the connection (see sqlite_profile)
+        max_cache_bytes: memory budget of the update cache, 0 for no budget
+        spill_dir: directory of the spilled runs, the system's default if None
     """
 
-    def __init__(self, store_dsn, store_id):
+    def __init__(
+        self,
+        store_dsn,
+        store_id,
+        tracer=None,
+        profile=DEFAULT_PROFILE,
+        max_cache_bytes=0,
+        spill_dir=None,
+    ):
         self.store_dsn = store_dsn
         self.store_id = store_id
+        self.tracer = NullTracer() if tracer is None else tracer
+        self.max_cache_bytes = max_cache_bytes
+        self.spill_dir = spill_dir
 
-        self.con = sqlite3.connect(store_dsn)
-        self.update_cache = SortedList(key=get_first)
+        # Flushes may be applied on a writer thread, see FlushWriter
+        self.con = sqlite_connect(store_dsn, profile, check_same_thread=False)
+        self.update_cache = []
+        self.cache_bytes = 0
+        self.spilled_runs = []
 
     def handle_updates(self, updates):
         """
@@ -63,6 +118,11 @@ class Sqlite3Store:
             updates: list of update 4 tuples.
         """
 
+        start = len(self.update_cache)
+
+        # The sql strings are interned as they mostly repeat
+        append = self.update_cache.append
+        intern = sys.intern
         for store_type, store_id, order_key, update in updates:
             if store_type != "sqlite3":
                 continue
@@ -70,54 +130,282 @@ class Sqlite3Store:
                 continue
 
             sql, params = update
-            self.update_cache.add((order_key, sql, params))
+            append((order_key, intern(sql), params))
+
+        # The updates of a chunk are mostly alike,
+        # so their size is estimated from the first one
+        num_added = len(self.update_cache) - start
+        if self.max_cache_bytes > 0 and num_added:
+            self.cache_bytes += num_added * cached_update_size(self.update_cache[start])
+            if self.cache_bytes > self.max_cache_bytes:
+                self.spill()
+
+    def spill(self):
+        """
+        Write the cached updates to disk as a sorted run.
+        """
+
+        updates, self.update_cache = self.update_cache, []
+        updates.sort(key=get_first)
+
+        with self.tracer.span("spill", updates=len(updates)):
+            run = SpilledRun(updates, self.spill_dir)
+        self.spilled_runs.append(run)
+
+        log.info(
+            "Spilled {} updates ({} bytes in memory) to disk in {} bytes",
+            run.count,
+            self.cache_bytes,
+            run.nbytes,
+        )
+        self.cache_bytes = 0
+
+    def take_round(self):
+        """
+        Take the cached updates and spilled runs of the current round.
+
+        Returns (updates, runs) to be applied with apply_round,
+        the store starting to cache the next round's updates.
+        """
+
+        updates, runs = self.update_cache, self.spilled_runs
+        self.update_cache = []
+        self.spilled_runs = []
+        self.cache_bytes = 0
+        return updates, runs
 
     def flush(self):
         """
         Apply the cached updates onto the store object.
         """
 
-        if not self.update_cache:
+        self.apply_round(*self.take_round())
+
+    def apply_round(self, updates, runs, track="main"):
+        """
+        Apply the updates of a round taken with take_round.
+
+        The updates are sorted once, here, rather than as they arrive.
+        Chunks of updates mostly arrive internally ordered,
+        so the stable sort mostly merges the runs of the chunks,
+        and keeps the updates with equal order keys in the order received.
+        Spilled runs are merged with the cached updates,
+        the runs spilled earlier coming first among equal order keys.
+        Consecutive updates with the same sql are applied with a single executemany.
+
+        track: trace track of the flush span
+        """
+
+        if not updates and not runs:
             return
 
-        log.info("Applying {} updates ...", len(self.update_cache))
-        with self.con:
-            cur = self.con.cursor()
-            for _, sql, params in self.update_cache:
-                if params is None:
-                    cur.execute(sql)
-                else:
-                    cur.execute(sql, tuple(params))
+        updates.sort(key=get_first)
+        count = len(updates)
+        if runs:
+            count += sum(run.count for run in runs)
+            updates = heapq.merge(*runs, updates, key=get_first)
 
-        self.update_cache = SortedList(key=get_first)
+        log.info("Applying {} updates ({} runs spilled) ...", count, len(runs))
+        span = self.tracer.span("flush", track, updates=count)
+        try:
+            with span, self.con, gc_paused():
+                cur = self.con.cursor()
+                for (sql, no_params), run in groupby(updates, key=get_statement):
+                    if no_params:
+                        for _ in run:
+                            cur.execute(sql)
+                    else:
+                        cur.executemany(sql, (params for _, _, params in run))
+        finally:
+            for run in runs:
+                run.close()
 
     def close(self):
         self.flush()
         self.con.close()
 
 
-def main_sqlite3_store(store_dsn, store_id, controller_port, storeproc_id):
+class FlushWriter:
+    """
+    Apply the flushes of a store on a writer thread.
+
+    A flush hands the round's updates over to the writer thread
+    and returns at once, so the next round's updates are received
+    while the round is written. At most depth flushes are pending,
+    a flush waiting till the oldest one is committed when there are more.
+    The store process thus acknowledges a FLUSH before the round is committed,
+    and agents reading the store may not see the last depth rounds;
+    they should also use a write ahead log profile (see sqlite_profile),
+    as otherwise their reads wait for the writer's transactions.
+
+    Args:
+        store: the Sqlite3Store
+        depth: maximum number of pending flushes
+    """
+
+    def __init__(self, store, depth):
+        self.store = store
+        self.depth = depth
+
+        self.pending = threading.BoundedSemaphore(depth)
+        self.rounds = queue.Queue()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.write_loop, name="flush-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_loop(self):
+        while True:
+            item = self.rounds.get()
+            if item is None:
+                return
+
+            try:
+                if self.error is None:
+                    self.store.apply_round(*item, track="writer")
+                else:
+                    for run in item[1]:
+                        run.close()
+            except Exception as e:  # pylint: disable=broad-except
+                log.exception("Flush failed on the writer thread")
+                self.error = e
+            finally:
+                self.pending.release()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Flush failed on the writer thread") from self.error
+
+    def flush(self):
+        """
+        Hand the current round over to the writer thread.
+        """
+
+        self.check()
+        with self.store.tracer.span("flush_wait"):
+            self.pending.acquire()
+        self.check()
+
+        self.rounds.put(self.store.take_round())
+
+    def close(self):
+        """
+        Wait for the pending flushes, then flush and close the store.
+        """
+
+        self.rounds.put(None)
+        self.thread.join()
+        self.check()
+
+        self.store.close()
+
+
+def main_sqlite3_store(
+    store_dsn,
+    store_id,
+    controller_port,
+    storeproc_id,
+    framing="line",
+    stream_window=0,
+    sqlite_profile=None,
+    max_cache_bytes=None,
+    spill_dir=None,
+    flush_depth=0,
+):
     """
     Sqlite3 store process starting point.
 
     Args:
         store_dsn: Path of the sqlite3 database file
         store_id: ID of the sqlite3 database file
-        controller_port: Port of the Matrix controller process
+        controller_port: Port or unix socket path of the Matrix controller process
         storeproc_id: ID of the current store process
+        framing: "line" or the codec used for the framed protocol
+        stream_window: if positive, subscribe to have events pushed by the controller,
+            with at most this many pushes unacknowledged;
+            otherwise poll for events with get_events.
+        sqlite_profile: performance profile of the store's connection,
+            the controller's sqlite_profile if None.
+        max_cache_bytes: memory budget of the update cache, 0 for no budget,
+            the controller's store_max_cache_bytes if None,
+            or MAX_CACHE_BYTES if that is not set either.
+        spill_dir: directory of the updates spilled to disk,
+            the system's temporary directory if None.
+        flush_depth: if positive, apply flushes on a writer thread,
+            with at most this many pending (see FlushWriter);
+            otherwise apply them before receiving further events.
     """
 
-    with RPCProxy("127.0.0.1", controller_port) as proxy:
-        state_store = Sqlite3Store(store_dsn, store_id)
+    framing = None if framing == "line" else framing
+    tracer = get_tracer(f"store {store_id}/{storeproc_id}")
+    with RPCProxy("127.0.0.1", controller_port, framing, tracer) as proxy:
+        # Only receive the updates meant for this store
+        ret = proxy.call(
+            "register_store", storeproc_id=storeproc_id, stores=[["sqlite3", store_id]]
+        )
 
-        while True:
-            ret = proxy.call("get_events", storeproc_id=storeproc_id)
-            code = ret["code"]
+        if sqlite_profile is None:
+            sqlite_profile = ret["sqlite_profile"]
+        if max_cache_bytes is None:
+            max_cache_bytes = ret.get("max_cache_bytes")
+        if max_cache_bytes is None:
+            max_cache_bytes = MAX_CACHE_BYTES
+
+        state_store = Sqlite3Store(
+            store_dsn, store_id, tracer, sqlite_profile, max_cache_bytes, spill_dir
+        )
+        if flush_depth > 0:
+            flusher = FlushWriter(state_store, flush_depth)
+        else:
+            flusher = state_store
+
+        if stream_window > 0:
+            receive_events = stream_events(proxy, storeproc_id, stream_window)
+        else:
+            receive_events = poll_events(proxy, storeproc_id)
+
+        for code, updates in receive_events:
             if code == "EVENTS":
-                updates = ret["events"]
                 state_store.handle_updates(updates)
             elif code == "FLUSH":
-                state_store.flush()
+                flusher.flush()
             elif code == "SIMEND":
-                state_store.close()
+                flusher.close()
                 break
+
+
+def poll_events(proxy, storeproc_id):
+    """
+    Retrieve events from the controller, one get_events call at a time.
+    """
+
+    while True:
+        ret = proxy.call("get_events", storeproc_id=storeproc_id)
+        yield ret["code"], ret["events"]
+
+
+def stream_events(proxy, storeproc_id, window):
+    """
+    Subscribe to events pushed by the controller.
+
+    Pushes are acknowledged after they have been processed,
+    every window / 2 pushes, and always after a FLUSH,
+    as the controller waits for the FLUSH acknowledgment
+    before it considers the store process to be ready again.
+    """
+
+    proxy.call("subscribe_events", storeproc_id=storeproc_id, window=window)
+
+    ack_every = max(1, window // 2)
+    while True:
+        method, params = proxy.receive()
+        if method != "push_events":
+            log.warning("Ignoring unexpected notification: {}", method)
+            continue
+
+        seq, code = params["seq"], params["code"]
+        yield code, params["events"]
+
+        if code == "FLUSH" or seq % ack_every == 0:
+            proxy.notify("ack_events", seq=seq)
@@ -0,0 +1,85 @@
+"""
+Compression of messages exchanged through the broker.
+
+The compression used for a message is recorded in its
+AMQP content_encoding property, so receivers can decode
+every message without any prior agreement with the sender.
+"""
+
+import zlib
+
+import logbook
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logbook.Logger(__name__)
+
+# Compression method name -> AMQP content encoding
+CONTENT_ENCODINGS = {"none": None, "zlib": "deflate", "zstd": "zstd"}
+
+DEFAULT_LEVELS = {"zlib": 1, "zstd": 3}
+
+
+class CompressionError(Exception):
+    pass
+
+
+def get_compression(config):
+    """
+    Get the compression method and level to be used for outgoing messages.
+    """
+
+    method = config.get("broker_compression", "none")
+    if method not in CONTENT_ENCODINGS:
+        raise CompressionError(f"Unknown compression method {method!r}")
+
+    level = config.get("broker_compression_level", DEFAULT_LEVELS.get(method))
+
+    # The level is zstd's, which zlib's levels do not match
+    if method == "zstd" and zstandard is None:
+        log.warning("zstandard module not available; falling back to zlib")
+        return "zlib", DEFAULT_LEVELS["zlib"]
+
+    return method, level
+
+
+def compress_parts(method, level, parts):
+    """
+    Compress data given as a list of parts, without joining them first.
+
+    Returns the list of compressed parts and the content encoding.
+    """
+
+    if method == "zlib":
+        compressor = zlib.compressobj(level)
+        encoding = "deflate"
+    elif method == "zstd":
+        # The size is recorded in the frame header, as decompress needs it
+        size = sum(len(part) for part in parts)
+        compressor = zstandard.ZstdCompressor(level=level).compressobj(size=size)
+        encoding = "zstd"
+    else:
+        return parts, None
+
+    compressed = [compressor.compress(part) for part in parts]
+    compressed.append(compressor.flush())
+    return [c for c in compressed if c], encoding
+
+
+def decompress(content_encoding, data):
+    """
+    Decompress data as per its content encoding.
+    """
+
+    if content_encoding is None:
+        return data
+    if content_encoding == "deflate":
+        return zlib.decompress(data)
+    if content_encoding == "zstd":
+        if zstandard is None:
+            raise CompressionError("Received zstd message, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise CompressionError(f"Unknown content encoding {content_encoding!r}")
@@ -2,30 +2,114 @@
 Matrix: Controller
 """
 
-import time
+import os
 import json
+import stat
+import errno
+import time
+import socket
 import random
 import asyncio
 import signal
 from functools import partial
+from collections import Counter, defaultdict
 
 import logbook
-import aioamqp
-from more_itertools import sliced
 
-from .json_rpc import rpc_dispatch, rpc_request
+from .barrier import TOTAL_KEY, get_barrier
+from .json_rpc import rpc_dispatch, rpc_request, rpc_parse, rpc_error
+from .metrics import Metrics
+from .framing import (
+    FramingError,
+    available_codecs,
+    parse_handshake,
+    read_message,
+    write_message,
+)
+from .histogram import MethodStats
+from .queues import ByteQueue
+from .rawjson import RawJSON, dumps, split_array
+from .routing import Router
+from .sqlite_profile import DEFAULT_PROFILE, PROFILES, SqliteProfileError
+from .tracing import get_tracer
+from .transport import get_transport, transport_name
+
+# pylint: disable=redefined-builtin
 
 log = logbook.Logger(__name__)
 
+# Stream buffer limit, only the line protocol needs a complete
+# request to fit in the buffer. Framed connections are not bounded by it.
 BUFSIZE = 16 * 2 ** 30
 RECEIVED_TERM = False
-EVENT_CHUNKSIZE = 1000
+
+# Default size of the chunks unserialized events from agents are split into
+EVENT_CHUNK_BYTES = 2 ** 20
+
+# Default limit on bytes of events buffered in each event queue
+MAX_QUEUE_BYTES = 512 * 2 ** 20
+
+# Default thresholds for coalescing event chunks into broker messages
+PUBLISH_MAX_BYTES = 4 * 2 ** 20
+PUBLISH_MAX_DELAY = 0.05
+
+# Methods that may run concurrently when adjacent in a batch request.
+# Methods that wait on the round barrier are always run alone and in order.
+CONCURRENT_METHODS = frozenset(
+    ["get_agentproc_seed", "register_events", "get_queue_stats"]
+)
+
+# Maximum number of concurrent requests in flight per client connection
+PIPELINE_DEPTH = 64
+
+# Default number of unacknowledged event pushes to a subscribed store process
+STREAM_WINDOW = 16
 
 
 def randint():
     return random.randint(0, 2 ** 32 - 1)
 
 
+def chunk_events(events, max_bytes):
+    """
+    Serialize events into RawJSON lists of about max_bytes each.
+
+    A chunk is closed once it reaches max_bytes,
+    so a chunk holding a single large event may be larger.
+    """
+
+    chunk = []
+    num_bytes = 0
+    for event in events:
+        data = json.dumps(event).encode("ascii")
+        chunk.append(data)
+        num_bytes += len(data) + 2
+        if num_bytes >= max_bytes:
+            yield RawJSON(b"".join([b"[", b", ".join(chunk), b"]"]))
+            chunk = []
+            num_bytes = 0
+
+    if chunk:
+        yield RawJSON(b"".join([b"[", b", ".join(chunk), b"]"]))
+
+
+def local_item_size(item):
+    """
+    Size of an item in the local events queue.
+    """
+
+    return len(item) if isinstance(item, RawJSON) else 0
+
+
+def store_item_size(item):
+    """
+    Size of an item in a store process's events queue.
+    """
+
+    _, events = item
+    return len(events) if events is not None else 0
+
+
 def term_handler(signame, loop):
     """
     Signal handler for term signals.
@@ -50,7 +134,7 @@ class Controller:
     def __init__(self, config, nodename, loop):
         self.nodename = nodename
 
-        self.num_controllers = len(config.sim_nodes)
+        self.sim_nodes = list(config.sim_nodes)
         self.num_agentprocs = config.num_agentprocs[nodename]
         self.num_storeprocs = config.num_storeprocs[nodename]
         self.num_rounds = config.num_rounds
@@ -68,28 +152,88 @@ class Controller:
         # The event loop
         self.loop = loop
 
-        # The following four attributes
-        # are the only mutable part of the class.
+        # The following three attributes
+        # are the only mutable part of the class,
+        # besides the event counts and the barrier's state below.
         self.cur_round = 0
         self.num_ap_waiting = 0
         self.num_sp_waiting = 0
-        self.num_cp_finished = 0
 
         self.all_sp_waiting = asyncio.Event()
 
+        # The round barrier between the controllers
+        self.barrier = get_barrier(self, config)
+
+        # Number of store_events messages sent to each controller in the current round,
+        # and the number received in and expected for each round.
+        # Events of a future round, sent by controllers that are ahead,
+        # are held back till the current round ends.
+        self.num_sent = Counter()
+        self.num_received = Counter()
+        self.num_expected = {}
+        self.early_events = defaultdict(list)
+
         # Local and All events queue
-        self.ev_queue_local = asyncio.Queue(maxsize=0, loop=loop)
+        # These are bounded by the number of bytes of events buffered,
+        # puts wait (and hence the agents or the broker wait) when full.
+        max_local_bytes = config.get("max_local_queue_bytes", MAX_QUEUE_BYTES)
+        max_store_bytes = config.get("max_store_queue_bytes", MAX_QUEUE_BYTES)
+        self.ev_queue_local = ByteQueue(max_local_bytes, local_item_size, loop=loop)
         self.ev_queue_all = []
         for _ in range(self.num_storeprocs):
-            self.ev_queue_all.append(asyncio.Queue(maxsize=0, loop=loop))
+            self.ev_queue_all.append(
+                ByteQueue(max_store_bytes, store_item_size, loop=loop)
+            )
 
         # Agent process queues
         self.ap_queue = asyncio.Queue(maxsize=self.num_agentprocs, loop=loop)
 
-        # This attribute will be populated later
+        # The (store_type, store_id) pairs each local store process serves,
+        # None for store processes that take all events.
+        # These are announced to the other controllers before the first round.
+        self.storeproc_interests = [None] * self.num_storeprocs
+        self.interests_announced = False
+        self.router = Router({n: config.num_storeprocs[n] for n in self.sim_nodes})
+
+        # Performance profile of the sqlite3 stores, handed to the store processes
+        sqlite_profile = config.get("sqlite_profile", DEFAULT_PROFILE)
+        if sqlite_profile not in PROFILES:
+            raise SqliteProfileError(f"Unknown sqlite profile {sqlite_profile!r}")
+        self.sqlite_profile = sqlite_profile
+
+        # Memory budget of the store processes' update caches,
+        # the store processes' own default if None
+        self.store_max_cache_bytes = config.get("store_max_cache_bytes")
+
+        # Target size of the chunks events from agents are split into
+        self.event_chunk_bytes = config.get("event_chunk_bytes", EVENT_CHUNK_BYTES)
+
+        # Thresholds for coalescing local event chunks into broker messages
+        self.publish_max_bytes = config.get("publish_max_bytes", PUBLISH_MAX_BYTES)
+        self.publish_max_delay = config.get("publish_max_delay", PUBLISH_MAX_DELAY)
+
+        # Per round performance metrics
+        metrics_file = config.get("metrics_file", {}).get(nodename)
+        self.metrics = Metrics(nodename, metrics_file)
+        self.metrics.start_round(self.cur_round)
+
+        # Spans of the main phases, if tracing is enabled
+        self.tracer = get_tracer(f"controller {nodename}")
+
+        # Latency and payload size histograms of the RPC calls handled,
+        # in the current round and in all rounds
+        self.rpc_stats = MethodStats()
+        self.rpc_stats_total = MethodStats()
+
+        # These attributes will be populated later
         # These should be bound to async functions
-        # That can be used to send messages to the backend
+        # That can be used to send messages to the backend,
+        # to all controllers or to the given list of controllers
         self.send_message = None
+        self.send_message_to = None
+
+        # Size above which the transport needs a batch of events split, if any
+        self.max_message_bytes = None
 
     async def get_agentproc_seed(self, agentproc_id):
         """
@@ -112,40 +256,121 @@ class Controller:
         assert 0 <= agentproc_id < self.num_agentprocs
         log.debug("Received CAN_WE_START_YET from agentproc {}", agentproc_id)
 
+        track = f"agentproc {agentproc_id}"
+        with self.tracer.span("can_we_start_yet", track, round=self.cur_round):
+            await self.wait_round_start()
+
+        if self.is_sim_end():
+            return {"cur_round": -1}
+
+        log.debug("Sending CAN_START to agentproc {} (round {})", agentproc_id, self.cur_round)
+        return {"cur_round": self.cur_round}
+
+    async def wait_round_start(self):
+        """
+        Count an agent process as waiting, and wait for the next round to start.
+        """
+
         self.num_ap_waiting += 1
         log.info(
             f"{self.num_ap_waiting}/{self.num_agentprocs} agent processes are waiting ..."
         )
         if self.num_ap_waiting == self.num_agentprocs:
-            # Wait for local events queue to be empty
+            self.metrics.mark("agents")
+
+            # Publish the coalesced events,
+            # and wait for local events queue to be empty
+            await self.ev_queue_local.put("FLUSH")
             await self.ev_queue_local.join()
+            self.metrics.mark("flush")
+
+            if self.cur_round == 0:
+                await self.announce_interests()
 
             # Signal the other controllers that we are done
-            await self.send_message("controller_finished", nodename=self.nodename)
+            counts, self.num_sent = dict(self.num_sent), Counter()
+            await self.barrier.arrive(self.cur_round, counts)
 
         await self.ap_queue.get()
         self.ap_queue.task_done()
 
-        if self.is_sim_end():
-            return {"cur_round": -1}
-
-        log.debug("Sending CAN_START to agentproc {} (round {})", agentproc_id, self.cur_round)
-        return {"cur_round": self.cur_round}
-
     async def register_events(self, agentproc_id, events):
         """
         RPC method: Used by agent processes to hand over generated events.
 
         agentproc_id: index of the agent process (starts at 0)
-        events: list of events
+        events: list of events, or a RawJSON serialized list of events
         """
 
         assert 0 <= agentproc_id < self.num_agentprocs
 
-        for event_chunk in sliced(events, EVENT_CHUNKSIZE):
-            await self.ev_queue_local.put(event_chunk)
+        with self.tracer.span("register_events", f"agentproc {agentproc_id}"):
+            await self.queue_local_events(events)
         return True
 
+    async def queue_local_events(self, events):
+        """
+        Put the events from a local agent in the local events queue.
+        """
+
+        if isinstance(events, RawJSON):
+            # Pre serialized events are passed on without being decoded,
+            # split between events if larger than a chunk
+            data = events.data
+            if data[:1] != b"[" or data[-1:] != b"]":
+                raise ValueError("Raw events must be a serialized json array")
+            event_chunks = split_array(data, self.event_chunk_bytes)
+        else:
+            event_chunks = chunk_events(events, self.event_chunk_bytes)
+
+        for event_chunk in event_chunks:
+            await self.ev_queue_local.put(event_chunk)
+        self.metrics.peak("local_queue_bytes", self.ev_queue_local.num_bytes)
+
+    async def register_store(self, storeproc_id, stores):
+        """
+        RPC method: Used by store processes to declare the events they need.
+
+        storeproc_id: index of the store process (starts at 0)
+        stores: list of [store_type, store_id] pairs served by the store process
+
+        Must be called before the store process first waits for events.
+        Store processes that don't call it are sent all events.
+
+        Returns the settings of the store processes in the configuration:
+            sqlite_profile: performance profile of the sqlite3 stores
+            max_cache_bytes: memory budget of the update cache, or None
+        """
+
+        assert 0 <= storeproc_id < self.num_storeprocs
+
+        if self.interests_announced:
+            raise ValueError("Store processes must register before the first round")
+        for pair in stores:
+            if len(pair) != 2:
+                raise ValueError("Stores must be [store_type, store_id] pairs")
+
+        self.storeproc_interests[storeproc_id] = [list(pair) for pair in stores]
+        return {
+            "sqlite_profile": self.sqlite_profile,
+            "max_cache_bytes": self.store_max_cache_bytes,
+        }
+
+    async def announce_interests(self):
+        """
+        Announce the events needed by the local store processes.
+
+        Waits for all the store processes to be waiting for events,
+        and hence to have registered.
+        """
+
+        await self.all_sp_waiting.wait()
+
+        self.interests_announced = True
+        await self.send_message(
+            "store_interests", nodename=self.nodename, stores=self.storeproc_interests
+        )
+
     async def get_events(self, storeproc_id):
         """
         RPC method: Used by store processes to retrieve generated events.
@@ -156,51 +381,129 @@ class Controller:
         assert 0 <= storeproc_id < self.num_storeprocs
         log.debug("Received GET_EVENTS from storeproc {}", storeproc_id)
 
+        code, events = await self.next_events(storeproc_id)
+        return {"code": code, "events": events}
+
+    async def next_events(self, storeproc_id):
+        """
+        Wait for the next item in a store process's events queue.
+
+        The store process is counted as waiting while this is in progress.
+        Used by get_events and by event subscriptions.
+        """
+
         self.num_sp_waiting += 1
         if self.num_sp_waiting == self.num_storeprocs:
             self.all_sp_waiting.set()
 
-        code, events = await self.ev_queue_all[storeproc_id].get()
+        with self.tracer.span("get_events", f"storeproc {storeproc_id}"):
+            code, events = await self.ev_queue_all[storeproc_id].get()
         self.ev_queue_all[storeproc_id].task_done()
 
         self.all_sp_waiting.clear()
         self.num_sp_waiting -= 1
 
         log.debug("Sending {} to storeproc {}", code, storeproc_id)
-        return {"code": code, "events": events}
+        return code, events
+
+    async def get_queue_stats(self):
+        """
+        RPC method: Get the current occupancy of the event queues.
+        """
+
+        return {
+            "local": self.ev_queue_local.stats(),
+            "stores": [q.stats() for q in self.ev_queue_all],
+        }
 
-    async def store_events(self, nodename, events):
+    async def store_events(self, nodename, events, storeprocs=None, round=None):
         """
         RPC method: Used by other controllers to hand over events from their local node.
 
         nodename: name of the soruce controller
-        events: list of events
+        events: RawJSON serialized list of events
+        storeprocs: nodename -> ids of the store processes the events are for,
+            all store processes if None
+        round: the round in which the events were generated
         """
 
-        for i in range(self.num_storeprocs):
+        if round is None:
+            round = self.cur_round
+
+        self.metrics.count("msgs_received")
+        self.metrics.count("bytes_received", len(events))
+
+        if storeprocs is None:
+            targets = range(self.num_storeprocs)
+        else:
+            targets = storeprocs.get(self.nodename, [])
+
+        if round > self.cur_round:
+            self.num_received[round] += 1
+            self.early_events[round].append((targets, events))
+            return
+
+        # Count the message only once its events are queued,
+        # as the round may otherwise end, from the control plane, before they are.
+        for i in targets:
             await self.ev_queue_all[i].put(("EVENTS", events))
+            self.metrics.peak("store_queue_bytes", self.ev_queue_all[i].num_bytes)
+        self.num_received[round] += 1
+
+        await self.check_round_end()
 
-    async def controller_finished(self, nodename):
+    async def store_interests(self, nodename, stores):
         """
-        RPC method: Used by other controllers to signal they have finished.
+        RPC method: Used by other controllers to announce the events their stores need.
 
-        nodename: nodename of the finished controller.
+        nodename: name of the source controller
+        stores: list with one entry per store process of the source controller,
+            a list of [store_type, store_id] pairs, or None for all events
         """
 
-        self.num_cp_finished += 1
-        log.info(
-            f"{self.num_cp_finished}/{self.num_controllers} controllers are waiting ..."
-        )
+        self.router.set_interests(nodename, stores)
+
+    async def round_released(self, round, num_expected):
+        """
+        Called by the barrier once all controllers have finished a round.
+
+        round: the round that was released
+        num_expected: number of store_events messages sent to this controller in the round
+        """
 
-        if self.num_cp_finished != self.num_controllers:
+        self.metrics.mark("barrier")
+        self.num_expected[round] = num_expected
+        await self.check_round_end()
+
+    async def check_round_end(self):
+        """
+        End the current round if it has been released
+        and all the events sent in it have been received.
+        """
+
+        round = self.cur_round
+        if round not in self.num_expected:
             return
+        if self.num_received[round] < self.num_expected[round]:
+            return
+
+        del self.num_expected[round]
+        del self.num_received[round]
+        self.metrics.mark("drain")
+        await self.end_round()
+
+    async def end_round(self):
+        """
+        Flush the events of the current round and start the next one.
+        """
 
         # Reset the state
-        self.cur_round += 1
+        # The round is advanced only once the early events of the next one are queued;
+        # events of the next round received meanwhile are buffered as early events.
+        next_round = self.cur_round + 1
         self.num_ap_waiting = 0
-        self.num_cp_finished = 0
 
-        if self.cur_round > 1:
+        if next_round > 1:
             # Add flush signal for the event queues
             for i in range(self.num_storeprocs):
                 await self.ev_queue_all[i].put(("FLUSH", None))
@@ -211,6 +514,23 @@ class Controller:
 
         # Wait for all store processes to be waiting
         await self.all_sp_waiting.wait()
+        self.metrics.mark("store")
+
+        # Hand over the events of the new round that came in early
+        while self.early_events.get(next_round):
+            for targets, events in self.early_events.pop(next_round):
+                for i in targets:
+                    await self.ev_queue_all[i].put(("EVENTS", events))
+        self.cur_round = next_round
+
+        record = self.metrics.end_round(rpc=self.rpc_stats.summary())
+        self.metrics.start_round(self.cur_round)
+        self.rpc_stats_total.merge(self.rpc_stats)
+        self.rpc_stats.reset()
+
+        start = record["start"]
+        end = start + record["wall_time"]
+        self.tracer.complete(f"round {record['round']}", start, end, "rounds")
 
         if self.is_sim_end():
             log.info("Simulation completed!")
@@ -243,18 +563,125 @@ class Controller:
     async def share_events_loop(self):
         """
         Keep sharing events put in local events queue with rest of the controllers.
+
+        Queued event chunks are coalesced into larger store_events messages.
+        A message is published once it reaches publish_max_bytes,
+        once its oldest chunk has waited publish_max_delay seconds,
+        or when a FLUSH marker is taken out of the queue.
+        Queue items are marked done only after they have been published,
+        so joining the local events queue waits for the coalesced messages.
         """
 
+        fragments = []
+        num_bytes = 0
+        num_items = 0
+        deadline = None
+
         while True:
-            events = await self.ev_queue_local.get()
-            if events is None:
+            if deadline is None:
+                events = await self.ev_queue_local.get()
+            else:
+                timeout = max(0, deadline - self.loop.time())
+                try:
+                    events = await asyncio.wait_for(self.ev_queue_local.get(), timeout)
+                except asyncio.TimeoutError:
+                    events = "FLUSH"
+                    num_items -= 1  # The timeout is not a queue item
+
+            num_items += 1
+            if events is not None and events != "FLUSH":
+                fragment = events.data
+                if len(fragment) > 2:  # Skip empty chunks
+                    # Strip the brackets, without copying the events
+                    fragments.append(memoryview(fragment)[1:-1])
+                    num_bytes += len(fragment)
+                if deadline is None:
+                    deadline = self.loop.time() + self.publish_max_delay
+
+                if num_bytes < self.publish_max_bytes:
+                    continue
+
+            if fragments:
+                events_json = b"".join([b"[", b", ".join(fragments), b"]"])
+                await self.share_events(RawJSON(events_json))
+
+            for _ in range(num_items):
                 self.ev_queue_local.task_done()
+
+            fragments = []
+            num_bytes = 0
+            num_items = 0
+            deadline = None
+
+            if events is None:
                 break
 
-            await self.send_message(
-                "store_events", nodename=self.nodename, events=events
-            )
-            self.ev_queue_local.task_done()
+    async def share_events(self, events):
+        """
+        Send a batch of local events to the controllers whose stores need them.
+
+        The batch is only decoded and split when store processes
+        have declared different interests.
+        Batches larger than the transport's max_message_bytes are sent
+        as several messages, split between events.
+        """
+
+        if not self.router.active:
+            for part in self.split_message(events):
+                self.count_sent(self.sim_nodes, part)
+                start = time.time()
+                await self.send_message(
+                    "store_events",
+                    nodename=self.nodename,
+                    events=part,
+                    round=self.cur_round,
+                )
+                self.observe_publish(start, part)
+            return
+
+        for storeprocs, group in self.router.route(events):
+            for part in self.split_message(group):
+                self.count_sent(storeprocs, part)
+                start = time.time()
+                await self.send_message_to(
+                    list(storeprocs),
+                    "store_events",
+                    nodename=self.nodename,
+                    events=part,
+                    storeprocs=storeprocs,
+                    round=self.cur_round,
+                )
+                self.observe_publish(start, part)
+
+    def split_message(self, events):
+        """
+        Split a RawJSON batch of events into batches the transport can send.
+        """
+
+        if self.max_message_bytes is None:
+            return [events]
+        return split_array(events.data, self.max_message_bytes)
+
+    def observe_publish(self, start, events):
+        """
+        Record a store_events message published since start.
+        """
+
+        end = time.time()
+        self.metrics.observe_publish(end - start)
+        self.tracer.complete("publish", start, end, "share", bytes=len(events))
+
+    def count_sent(self, nodes, events):
+        """
+        Count a store_events message sent to the given controllers.
+        """
+
+        for node in nodes:
+            self.num_sent[node] += 1
+        self.num_sent[TOTAL_KEY] += 1
+
+        self.metrics.count("msgs_sent")
+        self.metrics.count("bytes_sent", len(events))
 
     def is_sim_end(self):
         """
@@ -274,19 +701,30 @@ class Controller:
             "can_we_start_yet": self.can_we_start_yet,
             "register_events": self.register_events,
             # RPC methods used by store processes
+            "register_store": self.register_store,
             "get_events": self.get_events,
+            # RPC methods used for monitoring
+            "get_queue_stats": self.get_queue_stats,
             # RPC methods used by other contollers
             "store_events": self.store_events,
-            "controller_finished": self.controller_finished,
+            "store_interests": self.store_interests,
         }
+        # RPC methods used by the barrier
+        method_map.update(self.barrier.methods)
 
-        response = await rpc_dispatch(method_map, message)
+        response = await rpc_dispatch(
+            method_map, message, CONCURRENT_METHODS, self.rpc_stats
+        )
         return response
 
 
 async def handle_client_process(controller, reader, writer):
     """
-    Callback handler, for new tcp connections from agents.
+    Callback handler, for new tcp or unix socket connections from agents.
+
+    The first line sent by the client decides the protocol.
+    A framing handshake switches the connection to the framed protocol,
+    anything else is treated as the first request of the line protocol.
 
     controller: the controller object
     reader: async stream reader object
@@ -294,106 +732,300 @@ async def handle_client_process(controller, reader, writer):
     """
 
     address = writer.get_extra_info("peername")
-    address_str = ":".join(map(str, address))
+    if address:
+        address_str = ":".join(map(str, address))
+    else:  # Unix domain sockets have no peer address
+        address_str = "unix:" + writer.get_extra_info("sockname")
     log.info(f"New connection from {address_str}")
 
     try:
-        while True:
-            line = await reader.readline()
-            if not line:
-                break
-            line = line.decode("ascii")
-
-            response = await controller.dispatch(line)
-            assert response is not None
-
-            response = json.dumps(response) + "\n"  # NOTE: The newline important
-            response = response.encode("ascii")
-
-            writer.write(response)
+        line = await reader.readline()
+        codec = parse_handshake(line)
+        if codec is None:
+            await serve_line_protocol(controller, reader, writer, line)
+        elif codec in available_codecs():
+            writer.write(f"OK {codec}\n".encode("ascii"))
             await writer.drain()
+            log.info(f"{address_str} switched to framed protocol ({codec})")
+            await serve_framed_protocol(controller, reader, writer, codec)
+        else:
+            writer.write(f"ERROR unsupported codec {codec!r}\n".encode("ascii"))
+            await writer.drain()
+            await serve_line_protocol(controller, reader, writer, None)
     except asyncio.CancelledError:
         log.info("Stopping client connection from {}", address_str)
         return
+    except FramingError as e:
+        log.error(f"Closing connection from {address_str}: {e}")
+        writer.close()
+        return
 
     log.info(f"{address_str} disconnected")
 
 
-async def handle_broker_message(controller, channel, body, envelope, _properties):
+class RequestPipeline:
+    """
+    Dispatch the requests received on a single client connection.
+
+    Requests for methods in CONCURRENT_METHODS are run in the background,
+    so that a client can have many of them in flight;
+    responses to them are sent back as they complete,
+    and clients match them to requests by id.
+    Any other request first waits for all earlier requests to complete,
+    and no further requests are read till it completes.
+
+    The subscribe_events and ack_events methods are handled here,
+    as the event subscription is tied to the connection.
     """
-    Callback handler, for messages from amqp broker.
 
-    controller  : the controller object
-    channel     : channel from which message was received
-    body        : bytes object body of the message
-    envelope    : envelope
-    _properties : properties
+    def __init__(self, controller, writer, write_response, depth=PIPELINE_DEPTH):
+        self.controller = controller
+        self.writer = writer
+        self.write_response = write_response
+
+        self.pending = set()
+        self.slots = asyncio.Semaphore(depth)
+        self.write_lock = asyncio.Lock()
+
+        self.subscription = None
+        self.subscription_task = None
+        self.local_methods = {
+            "subscribe_events": self.subscribe_events,
+            "ack_events": self.ack_events,
+        }
+
+    async def submit(self, request):
+        """
+        Dispatch a request received from the client.
+        """
+
+        method = request.get("method") if isinstance(request, dict) else None
+        if method in CONCURRENT_METHODS:
+            # Stop reading from the client if too many requests are in flight
+            await self.slots.acquire()
+            task = asyncio.ensure_future(self.run(request, release=True))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+        else:
+            await self.join()
+            await self.run(request)
+
+        # Start pushing events only after the subscription was acknowledged
+        if self.subscription is not None and self.subscription_task is None:
+            self.subscription_task = asyncio.ensure_future(self.subscription.run())
+
+    async def run(self, request, release=False):
+        """
+        Run the request and send back the response.
+        """
+
+        try:
+            method = request.get("method") if isinstance(request, dict) else None
+            if method in self.local_methods:
+                response = await rpc_dispatch(self.local_methods, request)
+                if "id" not in request:
+                    # A failed notification, such as ack_events,
+                    # is only logged as no response may be sent for it
+                    response = None
+            else:
+                response = await self.controller.dispatch(request)
+            if response is None:  # Notifications don't get a response
+                return
+
+            await self.send(response)
+        finally:
+            if release:
+                self.slots.release()
+
+    async def send(self, msg):
+        """
+        Send a message to the client.
+        """
+
+        async with self.write_lock:
+            self.write_response(self.writer, msg)
+            await self.writer.drain()
+
+    async def subscribe_events(self, storeproc_id, window=STREAM_WINDOW):
+        """
+        RPC method: Used by store processes to have events pushed to them.
+
+        storeproc_id: index of the store process (starts at 0)
+        window: number of unacknowledged pushes allowed
+        """
+
+        assert 0 <= storeproc_id < self.controller.num_storeprocs
+        assert window > 0
+        if self.subscription is not None:
+            raise RuntimeError("Connection already has an event subscription")
+
+        log.info("Storeproc {} subscribed to events (window {})", storeproc_id, window)
+        self.subscription = EventSubscription(
+            self.controller, storeproc_id, window, self.send
+        )
+        return True
+
+    async def ack_events(self, seq):
+        """
+        RPC method: Used by store processes to acknowledge pushed events.
+
+        seq: sequence number of the last push that was processed
+        """
+
+        if self.subscription is None:
+            raise RuntimeError("Connection has no event subscription")
+
+        await self.subscription.ack(seq)
+
+    async def join(self):
+        """
+        Wait for all the requests in flight to complete.
+        """
+
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+    def cancel(self):
+        """
+        Cancel the requests in flight and the event subscription.
+        """
+
+        for task in list(self.pending):
+            task.cancel()
+        if self.subscription_task is not None:
+            self.subscription_task.cancel()
+
+
+class EventSubscription:
+    """
+    Push the events of a store process's queue to its connection.
+
+    Every push is a push_events notification with a sequence number,
+    and the store process acknowledges the pushes it has processed.
+    At most window pushes are sent ahead of the last acknowledgment.
+    After a FLUSH push nothing more is taken out of the queue
+    till the FLUSH has been acknowledged, so that the store process
+    is not counted as waiting while it is applying its updates.
     """
 
-    body = body.decode("utf-8")
+    def __init__(self, controller, storeproc_id, window, send):
+        self.controller = controller
+        self.storeproc_id = storeproc_id
+        self.window = window
+        self.send = send
+
+        self.seq = 0
+        self.acked = 0
+        self.fence = 0
+        self.can_push = asyncio.Condition()
+
+    def may_push(self):
+        return self.seq < self.acked + self.window and self.acked >= self.fence
+
+    async def ack(self, seq):
+        async with self.can_push:
+            self.acked = max(self.acked, seq)
+            self.can_push.notify_all()
+
+    async def run(self):
+        while True:
+            async with self.can_push:
+                await self.can_push.wait_for(self.may_push)
+
+            code, events = await self.controller.next_events(self.storeproc_id)
+
+            self.seq += 1
+            if code == "FLUSH":
+                self.fence = self.seq
+
+            params = {"seq": self.seq, "code": code, "events": events}
+            await self.send(rpc_request("push_events", id=False, **params))
+
+            if code == "SIMEND":
+                break
+
 
-    response = await controller.dispatch(body)
-    assert response is None
+def write_line_response(writer, response):
+    writer.write(dumps(response) + b"\n")  # NOTE: The newline important
 
-    # Send ack back to server
-    await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
 
+def write_frame_response(codec, writer, response):
+    write_message(writer, codec, response)
 
-async def send_broker_message(chan, exchange_name, method, **kwargs):
+
+async def serve_line_protocol(controller, reader, writer, line):
     """
-    Send a message to the broker to be shared with all controllers.
+    Serve newline delimited json requests till the client disconnects.
+
+    line: the first request line if it was already read
     """
 
-    request = rpc_request(method, id=False, **kwargs)
-    request = json.dumps(request)
-    request = request.encode("utf-8")
+    pipeline = RequestPipeline(controller, writer, write_line_response)
+    try:
+        while True:
+            if line is None:
+                line = await reader.readline()
+            if not line:
+                break
+
+            request, error = rpc_parse(line)
+            line = None
+            if error is not None:
+                await pipeline.join()
+                write_line_response(writer, rpc_error(error, request))
+                await writer.drain()
+                continue
+
+            await pipeline.submit(request)
 
-    await chan.basic_publish(request, exchange_name=exchange_name, routing_key="*")
+        await pipeline.join()
+    finally:
+        pipeline.cancel()
 
 
-async def make_amqp_channel(config):
+async def serve_framed_protocol(controller, reader, writer, codec):
     """
-    Create an async amqp channel.
+    Serve length prefixed requests till the client disconnects.
     """
 
-    timeout = 60
-    start = time.time()
-    while True:
-        try:
-            transport, protocol = await aioamqp.connect(
-                host=config.rabbitmq_host,
-                port=config.rabbitmq_port,
-                login=config.rabbitmq_username,
-                password=config.rabbitmq_password,
-            )
-            break
-        except OSError as e:
-            log.info("Failed to connect to RabbitMQ: {}", e)
+    pipeline = RequestPipeline(controller, writer, partial(write_frame_response, codec))
+    try:
+        while True:
+            request = await read_message(reader, codec, keep_raw=True)
+            if request is None:
+                break
 
-            since = time.time() - start
-            if since > timeout:
-                raise RuntimeError("Failed to connect to RabbitMQ")
-            else:
-                time.sleep(5)
+            await pipeline.submit(request)
 
-    channel = await protocol.channel()
-    return transport, protocol, channel
+        await pipeline.join()
+    finally:
+        pipeline.cancel()
 
 
-async def make_receiver_queue(callback, channel, config, nodename):
+def remove_stale_socket(path):
     """
-    Make the receiver queue and bind to topics.
+    Remove a unix socket left behind by a controller that did not exit cleanly.
+
+    Raises OSError (EADDRINUSE) if a process still listens on the socket,
+    as asyncio would otherwise replace its socket.
+    Anything that is not a socket is left for the bind to fail on.
     """
 
-    queue = await channel.queue_declare("", exclusive=True)
-    queue_name = queue["queue"]
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
 
-    await channel.queue_bind(
-        exchange_name=config.event_exchange, queue_name=queue_name, routing_key=nodename
-    )
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            log.warning(f"Removing stale unix socket {path}")
+            os.remove(path)
+            return
 
-    await channel.basic_consume(callback, queue_name=queue_name)
-    return queue
+    raise OSError(errno.EADDRINUSE, f"Unix socket {path} is in use")
 
 
 async def do_startup(config, nodename, loop):
@@ -403,21 +1035,12 @@ async def do_startup(config, nodename, loop):
 
     port = config.controller_port[nodename]
 
-    log.info("Creating AMQP send channel ...")
-    snd_trans, snd_proto, snd_chan = await make_amqp_channel(config)
-
-    log.info("Creating AMQP receive channel ...")
-    rcv_trans, rcv_proto, rcv_chan = await make_amqp_channel(config)
-
-    log.info("Setting up event exchange ...")
-    await snd_chan.exchange_declare(
-        exchange_name=config.event_exchange, type_name="fanout"
-    )
-
     controller = Controller(config, nodename, loop)
-    controller.send_message = partial(
-        send_broker_message, snd_chan, config.event_exchange
-    )
+    transport = get_transport(config, nodename)
+    log.info("Using {} transport", transport_name(config))
+    controller.send_message = transport.publish
+    controller.send_message_to = transport.send
+    controller.max_message_bytes = transport.max_message_bytes
 
     for signame in ["SIGINT", "SIGTERM", "SIGHUP"]:
         signum = getattr(signal, signame)
@@ -427,31 +1050,54 @@ async def do_startup(config, nodename, loop):
     log.info("Starting event share loop ...")
     asyncio.ensure_future(controller.share_events_loop())
 
-    log.info("Setting up AMQP receiver ...")
-    bm_callback = partial(handle_broker_message, controller)
-    await make_receiver_queue(bm_callback, rcv_chan, config, nodename)
+    log.info("Starting transport ...")
+    await transport.start(controller)
+
+    metrics_port = config.get("metrics_port", {}).get(nodename)
+    if metrics_port is not None:
+        await controller.metrics.serve(metrics_port)
+
+    servers = []
 
     log.info(f"Starting local TCP server at 127.0.0.1:{port} ...")
     tcon_callback = partial(handle_client_process, controller)
     server = await asyncio.start_server(tcon_callback, "127.0.0.1", port, limit=BUFSIZE)
+    servers.append(server)
+
+    socket_path = config.get("controller_socket", {}).get(nodename)
+    if socket_path is not None:
+        log.info(f"Starting local unix socket server at {socket_path} ...")
+        remove_stale_socket(socket_path)
+        server = await asyncio.start_unix_server(
+            tcon_callback, socket_path, limit=BUFSIZE
+        )
+        servers.append(server)
 
-    return server, snd_trans, snd_proto, rcv_trans, rcv_proto
+    return controller, servers, transport
 
 
-async def do_cleanup(server, snd_trans, snd_proto, rcv_trans, rcv_proto):
+async def do_cleanup(controller, servers, transport):
     """
     Cleanup the running processes.
     """
 
-    log.info("Closing local TCP server ..")
-    server.close()
-    await server.wait_closed()
+    log.info("Closing local servers ..")
+    for server in servers:
+        paths = [s.getsockname() for s in server.sockets if s.family == socket.AF_UNIX]
+
+        server.close()
+        await server.wait_closed()
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    await transport.close()
+    await controller.metrics.close()
+    controller.tracer.close()
 
-    log.info("Closing AMQP send and receive channels ...")
-    await snd_proto.close()
-    await rcv_proto.close()
-    snd_trans.close()
-    rcv_trans.close()
+    controller.rpc_stats_total.merge(controller.rpc_stats)
+    controller.rpc_stats_total.log_summary("RPC calls handled:")
 
 
 def main_controller(config, nodename):
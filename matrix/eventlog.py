@@ -7,16 +7,17 @@ import json
 import asyncio
 import signal
 from functools import partial
+from collections import defaultdict
 
 import logbook
 
-from .controller import (
-    make_amqp_channel,
-    make_receiver_queue,
-    term_handler,
-    handle_broker_message,
-)
+from .barrier import TOTAL_KEY
+from .controller import term_handler
 from .json_rpc import rpc_dispatch
+from .rawjson import RawJSON
+from .transport import get_transport, transport_name
+
+# pylint: disable=redefined-builtin
 
 log = logbook.Logger(__name__)
 
@@ -34,43 +35,103 @@ class EventLogger:
         self.event_fobj = gzip.open(output_fname, "wt")
 
         self.cur_round = 0
-        self.num_cp_finished = 0
+        self.num_finished = defaultdict(int)
+
+        # Number of store_events messages received,
+        # and the number sent in the released rounds.
+        self.num_received = 0
+        self.num_expected = 0
 
-    async def store_events(self, nodename, events):
+    async def store_events(self, nodename, events, storeprocs=None, round=None):
         """
         RPC method: Used by other controllers to hand over events from their local node.
 
-        events: list of events.
+        events: RawJSON serialized list of events.
+        storeprocs: the store processes the events are meant for (ignored)
+        round: the round in which the events were generated (ignored)
         """
 
+        if isinstance(events, RawJSON):
+            events = events.loads()
+
         for event in events:
             event = json.dumps(event)
             self.event_fobj.write(event + "\n")
 
-    async def controller_finished(self, nodename):
+        self.num_received += 1
+        self.check_sim_end()
+
+    async def store_interests(self, nodename, stores):
+        """
+        RPC method: Used by controllers to announce the events their stores need.
+
+        Every event is logged, so this is ignored.
+        """
+
+    async def controller_finished(self, nodename, round=None, counts=None):
         """
         RPC method: Used by other controllers to signal they have finished.
 
         nodename: nodename of the finished controller.
+        round: the round that was finished
+        counts: number of store_events messages sent by the controller
         """
 
-        self.num_cp_finished += 1
-        log.info(
-            f"{self.num_cp_finished}/{self.num_controllers} controllers are waiting ..."
-        )
+        if round is None:
+            round = self.cur_round
 
-        if self.num_cp_finished != self.num_controllers:
+        self.num_finished[round] += 1
+        if counts:
+            self.num_expected += counts.get(TOTAL_KEY, 0)
+
+        num_finished = self.num_finished[round]
+        log.info(f"{num_finished}/{self.num_controllers} controllers are waiting ...")
+
+        if self.num_finished[round] != self.num_controllers:
             return
 
-        self.cur_round += 1
-        self.num_cp_finished = 0
+        del self.num_finished[round]
+        self.round_released(round)
+
+    async def barrier_arrive(self, nodename, round, counts):
+        """
+        RPC method: Used by controllers to arrive at the tree barrier (ignored).
+        """
+
+    async def barrier_release(self, round, counts):
+        """
+        RPC method: Used by controllers to release a round of the tree barrier.
+
+        Every controller with children in the tree sends the release,
+        so the event logger receives several copies.
+        """
+
+        if round < self.cur_round:
+            return
+
+        self.num_expected += counts.get(TOTAL_KEY, 0)
+        self.round_released(round)
+
+    def round_released(self, round):
+        """
+        Start the next round.
+        """
+
+        self.cur_round = round + 1
 
         if self.is_sim_end():
             log.info("Simulation completed!")
         else:
             log.info(f"Round {self.cur_round}/{self.num_rounds} starting ...")
 
-        if self.is_sim_end():
+        self.check_sim_end()
+
+    def check_sim_end(self):
+        """
+        Stop once the simulation has ended and all the events are logged.
+        """
+
+        if self.is_sim_end() and self.num_received == self.num_expected:
             # self.event_fobj.close()
             self.event_loop.stop()
 
@@ -89,7 +150,10 @@ class EventLogger:
         method_map = {
             # RPC methods used by other contollers
             "store_events": self.store_events,
+            "store_interests": self.store_interests,
             "controller_finished": self.controller_finished,
+            "barrier_arrive": self.barrier_arrive,
+            "barrier_release": self.barrier_release,
         }
 
         response = await rpc_dispatch(method_map, message)
@@ -101,36 +165,26 @@ async def do_startup(config, output_fname, event_loop):
     Start the event logger.
     """
 
-    log.info("Creating AMQP receive channel ...")
-    rcv_trans, rcv_proto, rcv_chan = await make_amqp_channel(config)
-
-    log.info("Setting up event exchange ...")
-    await rcv_chan.exchange_declare(
-        exchange_name=config.event_exchange, type_name="fanout"
-    )
-
     logger = EventLogger(config, output_fname, event_loop)
+    transport = get_transport(config, None)
 
     for signame in ["SIGINT", "SIGTERM", "SIGHUP"]:
         signum = getattr(signal, signame)
         handler = partial(term_handler, signame=signame, loop=event_loop)
         event_loop.add_signal_handler(signum, handler)
 
-    log.info("Setting up AMQP receiver ...")
-    bm_callback = partial(handle_broker_message, logger)
-    await make_receiver_queue(bm_callback, rcv_chan, config, "")
+    log.info("Starting transport ...")
+    await transport.start(logger)
 
-    return rcv_trans, rcv_proto
+    return (transport,)
 
 
-async def do_cleanup(rcv_trans, rcv_proto):
+async def do_cleanup(transport):
     """
     Cleanup the running processes.
     """
 
-    log.info("Closing AMQP receive channel ...")
-    await rcv_proto.close()
-    rcv_trans.close()
+    await transport.close()
 
 
 def main_eventlog(config, output_fname):
@@ -138,6 +192,17 @@ def main_eventlog(config, output_fname):
     Event logger starting point.
     """
 
+    if transport_name(config) == "local":
+        log.warning(
+            "Controller uses the local transport, there are no events to log. "
+            "Set transport to amqp or mesh to log events of a single node simulation."
+        )
+        return
+
+    if not config.get("event_logging", True):
+        log.warning("Event logging is disabled, there are no events to log.")
+        return
+
     loop = asyncio.get_event_loop()
 
     resources = loop.run_until_complete(do_startup(config, output_fname, loop))
@@ -0,0 +1,274 @@
+"""
+Length prefixed framing for the controller RPC channel.
+
+The original protocol sends one ASCII JSON message per line.
+A client can switch a freshly opened connection to the framed protocol
+by sending a single handshake line before any request:
+
+    MATRIX-FRAMED <codec>\\n
+
+The controller replies with "OK <codec>\\n" if it supports the codec,
+or "ERROR <reason>\\n" in which case the connection stays in line mode.
+After a successful handshake every message in either direction
+is an 8 byte big endian body length followed by the encoded body.
+Bodies larger than MAX_FRAME_SIZE are refused by the reader.
+A message with RawJSON attachments is followed by one frame per attachment
+(see matrix.rawjson).
+"""
+
+import json
+import struct
+import asyncio
+
+from .rawjson import split_attachments, count_attachments, join_attachments
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HANDSHAKE_PREFIX = "MATRIX-FRAMED"
+HEADER = struct.Struct("!Q")
+
+# Bodies smaller than this are sent along with the header
+# in a single write, larger ones are sent without copying.
+COALESCE_LIMIT = 2 ** 16
+
+# Largest frame body read, so that a corrupt length header
+# can not make the reader allocate arbitrary amounts of memory.
+MAX_FRAME_SIZE = 2 ** 30
+
+
+class FramingError(Exception):
+    pass
+
+
+def available_codecs():
+    """
+    Return the list of codecs supported in the current environment.
+    """
+
+    codecs = ["json"]
+    if msgpack is not None:
+        codecs.append("msgpack")
+    return codecs
+
+
+def encode(codec, obj):
+    """
+    Encode an object into a frame body.
+    """
+
+    if codec == "json":
+        return json.dumps(obj).encode("utf-8")
+    if codec == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    raise FramingError(f"Unknown codec {codec!r}")
+
+
+def decode(codec, body):
+    """
+    Decode a frame body into an object.
+    """
+
+    if codec == "json":
+        return json.loads(body)
+    if codec == "msgpack":
+        return msgpack.unpackb(body, raw=False)
+    raise FramingError(f"Unknown codec {codec!r}")
+
+
+def handshake_request(codec):
+    """
+    Generate the handshake line sent by the client.
+    """
+
+    return f"{HANDSHAKE_PREFIX} {codec}\n".encode("ascii")
+
+
+def parse_handshake(line):
+    """
+    Check if line is a handshake request.
+
+    Returns the requested codec, or None if line is a regular request.
+    """
+
+    if not line.startswith(HANDSHAKE_PREFIX.encode("ascii")):
+        return None
+
+    parts = line.decode("ascii").split()
+    if len(parts) != 2:
+        return ""
+    return parts[1]
+
+
+def check_frame_size(size, max_size):
+    if size > max_size:
+        raise FramingError(f"Frame of {size} bytes exceeds the {max_size} bytes limit")
+
+
+async def read_frame(reader, max_size=MAX_FRAME_SIZE):
+    """
+    Read one frame body from an async stream reader.
+
+    Large bodies are read chunk by chunk into a buffer of the frame's size,
+    rather than accumulated in the reader's buffer and copied out of it.
+    Returns None on a clean end of stream.
+    """
+
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise FramingError("Connection closed in the middle of a frame")
+    (size,) = HEADER.unpack(header)
+    check_frame_size(size, max_size)
+
+    if size < COALESCE_LIMIT:
+        try:
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise FramingError("Connection closed in the middle of a frame")
+
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        chunk = await reader.read(size - pos)
+        if not chunk:
+            raise FramingError("Connection closed in the middle of a frame")
+        view[pos : pos + len(chunk)] = chunk
+        pos += len(chunk)
+    return buf
+
+
+def write_frame(writer, body):
+    """
+    Write one frame to an async stream writer.
+    """
+
+    header = HEADER.pack(len(body))
+    if len(body) < COALESCE_LIMIT:
+        writer.write(header + body)
+    else:
+        writer.write(header)
+        writer.write(body)
+
+
+def recv_exactly(sock, size):
+    """
+    Read exactly size bytes from a blocking socket into a single buffer.
+    """
+
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:])
+        if not n:
+            raise FramingError("Connection closed in the middle of a frame")
+        pos += n
+    return buf
+
+
+def recv_frame(sock, max_size=MAX_FRAME_SIZE):
+    """
+    Read one frame body from a blocking socket.
+    """
+
+    (size,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    check_frame_size(size, max_size)
+    return recv_exactly(sock, size)
+
+
+def send_frame(sock, body):
+    """
+    Write one frame to a blocking socket.
+    """
+
+    header = HEADER.pack(len(body))
+    if len(body) < COALESCE_LIMIT:
+        sock.sendall(header + body)
+    else:
+        sock.sendall(header)
+        sock.sendall(body)
+
+
+def recv_line(sock):
+    """
+    Read a single short line from a blocking socket without buffering.
+    """
+
+    buf = bytearray()
+    while not buf.endswith(b"\n"):
+        c = sock.recv(1)
+        if not c:
+            raise FramingError("Connection closed during handshake")
+        buf += c
+    return bytes(buf)
+
+
+def message_frames(codec, msg):
+    """
+    Encode a message into the list of its frame bodies.
+
+    The first body is the message itself, followed by its attachments.
+    """
+
+    msg, blobs = split_attachments(msg)
+    return [encode(codec, msg)] + blobs
+
+
+def write_message(writer, codec, msg):
+    """
+    Write a message along with its attachments to an async stream writer.
+    """
+
+    for body in message_frames(codec, msg):
+        write_frame(writer, body)
+
+
+async def read_message(reader, codec, keep_raw, max_size=MAX_FRAME_SIZE):
+    """
+    Read a message along with its attachments from an async stream reader.
+
+    keep_raw: keep the attachments as RawJSON objects instead of decoding them
+    max_size: size of the largest frame body accepted
+
+    Returns None on a clean end of stream.
+    """
+
+    body = await read_frame(reader, max_size)
+    if body is None:
+        return None
+    msg = decode(codec, body)
+    del body
+
+    blobs = []
+    for _ in range(count_attachments(msg)):
+        blob = await read_frame(reader, max_size)
+        if blob is None:
+            raise FramingError("Connection closed before all attachments were read")
+        blobs.append(blob)
+
+    return join_attachments(msg, blobs, keep_raw)
+
+
+def send_message(sock, codec, msg):
+    """
+    Write a message along with its attachments to a blocking socket.
+    """
+
+    for body in message_frames(codec, msg):
+        send_frame(sock, body)
+
+
+def recv_message(sock, codec, keep_raw, max_size=MAX_FRAME_SIZE):
+    """
+    Read a message along with its attachments from a blocking socket.
+    """
+
+    msg = decode(codec, recv_frame(sock, max_size))
+    blobs = [recv_frame(sock, max_size) for _ in range(count_attachments(msg))]
+    return join_attachments(msg, blobs, keep_raw)
@@ -0,0 +1,237 @@
+"""
+Fixed memory histograms of latencies and sizes.
+
+Values are counted in log-linear buckets, as in HDR histograms:
+values below 2 * 2^bits each have a bucket of their own,
+and every further power of two is split into 2^bits buckets of equal width,
+so percentiles are accurate to within 2^-bits of the value
+whatever its magnitude, and the memory used is fixed
+by the largest value counted.
+"""
+
+import math
+import time
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Default precision, buckets are at most 1/32 (about 3%) of their values wide
+PRECISION_BITS = 5
+
+# Default bit length of the largest value counted, larger values are clamped
+MAX_VALUE_BITS = 40
+
+PERCENTILES = [50, 90, 99]
+
+
+class Histogram:
+    """
+    Histogram of non negative integer values.
+
+    Args:
+        bits: precision of the buckets
+        max_bits: bit length of the largest value counted
+    """
+
+    def __init__(self, bits=PRECISION_BITS, max_bits=MAX_VALUE_BITS):
+        self.bits = bits
+        self.sub_count = 2 ** bits
+        self.max_value = 2 ** max_bits - 1
+        self.counts = [0] * (self.bucket_index(self.max_value) + 1)
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket_index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.bits - 1
+        return shift * self.sub_count + (value >> shift)
+
+    def bucket_high(self, index):
+        """
+        Largest value counted in a bucket.
+        """
+
+        if index < 2 * self.sub_count:
+            return index
+        shift = index // self.sub_count - 1
+        top = index - shift * self.sub_count
+        return ((top + 1) << shift) - 1
+
+    def record(self, value):
+        """
+        Count a value.
+        """
+
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self.bucket_index(value)] += 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Value below which p percent of the counted values are.
+        """
+
+        if not self.count:
+            return 0
+
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_high(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram of the same shape.
+        """
+
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def summary(self):
+        """
+        Count, mean, max and percentiles of the values.
+        """
+
+        ret = {"count": self.count}
+        ret["mean"] = self.total / self.count if self.count else 0
+        for p in PERCENTILES:
+            ret[f"p{p}"] = self.percentile(p)
+        ret["max"] = self.max or 0
+        return ret
+
+
+class MethodStats:
+    """
+    Latency and payload size histograms per RPC method.
+
+    Latencies are counted in microseconds, sizes in bytes.
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.size = {}
+
+    def record(self, method, seconds, size=0):
+        """
+        Count a call of a method.
+        """
+
+        try:
+            latency = self.latency[method]
+            sizes = self.size[method]
+        except KeyError:
+            latency = self.latency[method] = Histogram()
+            sizes = self.size[method] = Histogram()
+
+        latency.record(seconds * 1e6)
+        sizes.record(size)
+
+    def timer(self, method):
+        """
+        Context manager recording the latency of a call.
+        """
+
+        return CallTimer(self, method)
+
+    def merge(self, other):
+        for method in other.latency:
+            if method not in self.latency:
+                self.latency[method] = Histogram()
+                self.size[method] = Histogram()
+            self.latency[method].merge(other.latency[method])
+            self.size[method].merge(other.size[method])
+
+    def reset(self):
+        for hist in self.latency.values():
+            hist.reset()
+        for hist in self.size.values():
+            hist.reset()
+
+    def summary(self):
+        """
+        Summary of the histograms of every method called.
+
+        Returns method -> {"latency_us": ..., "size": ...}
+        """
+
+        return {
+            method: {
+                "latency_us": self.latency[method].summary(),
+                "size": self.size[method].summary(),
+            }
+            for method in sorted(self.latency)
+            if self.latency[method].count
+        }
+
+    def log_summary(self, title):
+        """
+        Log the percentiles of every method called.
+        """
+
+        summary = self.summary()
+        if not summary:
+            return
+
+        lines = [title]
+        for method, stats in summary.items():
+            lat, size = stats["latency_us"], stats["size"]
+            lines.append(
+                f"  {method}: {lat['count']} calls,"
+                f" latency p50 {lat['p50'] / 1000:.3f} ms,"
+                f" p99 {lat['p99'] / 1000:.3f} ms,"
+                f" max {lat['max'] / 1000:.3f} ms,"
+                f" size p50 {size['p50']} B, p99 {size['p99']} B"
+            )
+        log.info("\n".join(lines))
+
+
+class CallTimer:
+    """
+    Record the latency of a call, along with the size set while it runs.
+    """
+
+    __slots__ = ["stats", "method", "start", "size"]
+
+    def __init__(self, stats, method):
+        self.stats = stats
+        self.method = method
+        self.start = None
+        self.size = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.stats.record(self.method, seconds, self.size)
+        return False
@@ -3,30 +3,44 @@ Methods to implement jsonrpc over asyncio.
 """
 
 import json
+import asyncio
 from uuid import uuid4
 
 import logbook
 
+from .rawjson import RawJSON
+
 log = logbook.Logger(__name__)
 
 
 def rpc_parse(line):
     """
-    Parse a jsonrpc request and check correctness.
+    Parse a jsonrpc request or batch of requests.
+
+    The individual requests are checked for correctness at dispatch.
     """
 
     try:
         request = json.loads(line)
-        if not isinstance(request, dict):
-            return None, "Request object is not of type object"
     except ValueError:
         if __debug__:
             log.debug(f"Failed to parse RPC request\n{line}")
         return None, "Failed to parse RPC request"
 
+    return request, None
+
+
+def rpc_validate(request):
+    """
+    Check correctness of an already decoded jsonrpc request.
+    """
+
+    if not isinstance(request, dict):
+        return None, "Request object is not of type object"
+
     try:
         if request["jsonrpc"] != "2.0":
-            return "Incompatible RPC version: jsonrpc != '2.0'"
+            return request, "Incompatible RPC version: jsonrpc != '2.0'"
     except KeyError:
         return request, "JsonRPC version missing in request"
 
@@ -86,12 +100,88 @@ def rpc_response(result, request):
     return response
 
 
-async def rpc_dispatch(method_map, line):
+def payload_size(value):
+    """
+    Bytes of serialized events carried by params or a result.
+
+    Counts the RawJSON values, whether given directly
+    or as members of a list or an object.
+    """
+
+    if isinstance(value, RawJSON):
+        return len(value)
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        return 0
+    return sum(len(v) for v in value if isinstance(v, RawJSON))
+
+
+async def rpc_dispatch(method_map, message, concurrent=frozenset(), stats=None):
     """
     Dispatch the proper method.
+
+    message: a serialized json request (str or bytes),
+             or a request object decoded by the framing layer.
+    concurrent: names of methods which may be run concurrently
+                when they are adjacent in a batch request.
+    stats: MethodStats recording the latency and payload size
+           of every call (see matrix.histogram), optional.
+
+    Returns the response object, a list of response objects for batches,
+    or None if no response is to be sent back.
+    """
+
+    if isinstance(message, (str, bytes, bytearray)):
+        request, error = rpc_parse(message)
+        if error is not None:
+            return rpc_error(error, request)
+    else:
+        request = message
+
+    if isinstance(request, list):
+        return await rpc_dispatch_batch(method_map, request, concurrent, stats)
+    return await rpc_dispatch_request(method_map, request, stats)
+
+
+async def rpc_dispatch_batch(method_map, requests, concurrent, stats=None):
+    """
+    Dispatch the requests of a batch.
+
+    Runs of adjacent requests for methods in concurrent are run concurrently,
+    every other request is run alone in the order it appears in the batch.
+    """
+
+    if not requests:
+        return rpc_error("Empty batch request")
+
+    responses = []
+    group = []
+    for request in requests:
+        if isinstance(request, dict) and request.get("method") in concurrent:
+            group.append(rpc_dispatch_request(method_map, request, stats))
+            continue
+
+        if group:
+            responses.extend(await asyncio.gather(*group))
+            group = []
+        responses.append(await rpc_dispatch_request(method_map, request, stats))
+
+    if group:
+        responses.extend(await asyncio.gather(*group))
+
+    responses = [r for r in responses if r is not None]
+    if not responses:
+        return None
+    return responses
+
+
+async def rpc_dispatch_request(method_map, request, stats=None):
+    """
+    Dispatch a single request.
     """
 
-    request, error = rpc_parse(line)
+    request, error = rpc_validate(request)
     if error is not None:
         return rpc_error(error, request)
 
@@ -109,7 +199,13 @@ async def rpc_dispatch(method_map, line):
         args, kwargs = [], {}
 
     try:
-        response = await method_map[method](*args, **kwargs)
+        if stats is None:
+            response = await method_map[method](*args, **kwargs)
+        else:
+            with stats.timer(method) as timer:
+                response = await method_map[method](*args, **kwargs)
+                size = payload_size(request.get("params")) + payload_size(response)
+                timer.size = size
     except Exception as e:  # pylint disable=broad-except
         log.exception(f"Error dispatching {method}")
         return rpc_error(e, request)
@@ -0,0 +1,278 @@
+"""
+Per round performance metrics of the controller.
+
+For every round the controller records where the round's time went,
+split into the phases below, along with the messages and bytes of events
+it sent and received, the peak occupancy of its event queues,
+and the time taken to publish its store_events messages.
+
+    agents_time: from the start of the round till all the local agents finished
+    flush_time: publishing the remaining local events
+    barrier_time: waiting at the round barrier for the other controllers
+    drain_time: waiting for the round's events after the barrier released it
+    store_time: waiting for the store processes to apply the round's events
+
+Records are written to metrics_file if configured,
+as CSV if its name ends in .csv and as json lines otherwise.
+Json records also carry the percentiles of the latency and payload size
+of the RPC calls the controller handled in the round, per method.
+Those don't fit in CSV columns, so along with a CSV file they are written
+as json lines, with the node and round, to a file of the same name
+ending in .extra.jsonl instead.
+If metrics_port is configured, the records of the recent rounds are also
+served over HTTP at /metrics (json lines) and /metrics.csv on 127.0.0.1.
+"""
+
+# pylint: disable=redefined-builtin
+
+import io
+import csv
+import json
+import time
+import asyncio
+from collections import deque
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Number of rounds kept in memory to be served over HTTP
+HISTORY_SIZE = 1000
+
+# Phases of a round, in order.
+# A phase ends with the mark of the same name and the next one starts.
+PHASES = ["agents", "flush", "barrier", "drain", "store"]
+
+COUNTERS = [
+    "msgs_sent",
+    "bytes_sent",
+    "msgs_received",
+    "bytes_received",
+    "publish_count",
+]
+
+PEAKS = ["local_queue_bytes", "store_queue_bytes", "publish_time_max"]
+
+FIELDS = (
+    ["node", "round", "start", "wall_time"]
+    + [f"{phase}_time" for phase in PHASES]
+    + COUNTERS
+    + ["publish_time"]
+    + PEAKS
+)
+
+
+def extra_path(path):
+    """
+    Path of the file the fields that are not CSV columns are written to.
+    """
+
+    return path[: -len(".csv")] + ".extra.jsonl"
+
+
+class Metrics:
+    """
+    Collect the metrics of the current round.
+
+    Args:
+        nodename: nodename of the controller
+        path: file the records are written to (optional)
+    """
+
+    def __init__(self, nodename, path=None):
+        self.nodename = nodename
+        self.path = str(path) if path is not None else None
+        self.csv = self.path is not None and self.path.endswith(".csv")
+
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.fobj = None
+        self.extra_fobj = None
+        self.server = None
+
+        self.round = None
+        self.start = None
+        self.marks = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.publish_time = 0.0
+        self.peaks = dict.fromkeys(PEAKS, 0)
+
+    def start_round(self, round):
+        """
+        Start collecting the metrics of a round.
+        """
+
+        self.round = round
+        self.start = time.time()
+        self.marks = {"start": time.perf_counter()}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.publish_time = 0.0
+        self.peaks = dict.fromkeys(PEAKS, 0)
+
+    def mark(self, name):
+        """
+        Record the end of a phase of the current round.
+        """
+
+        self.marks[name] = time.perf_counter()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def peak(self, name, value):
+        if value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def observe_publish(self, seconds):
+        """
+        Record the time taken to publish a store_events message.
+        """
+
+        self.counters["publish_count"] += 1
+        self.publish_time += seconds
+        self.peak("publish_time_max", seconds)
+
+    def end_round(self, **extra):
+        """
+        Finish the record of the current round and write it out.
+
+        extra: further fields of the record, written apart from CSV files
+        """
+
+        if self.round is None:
+            return None
+
+        end = time.perf_counter()
+        record = {
+            "node": self.nodename,
+            "round": self.round,
+            "start": round(self.start, 6),
+            "wall_time": end - self.marks["start"],
+        }
+
+        # A phase that was not marked takes no time
+        prev = self.marks["start"]
+        for phase in PHASES:
+            cur = max(prev, self.marks.get(phase, prev))
+            record[f"{phase}_time"] = cur - prev
+            prev = cur
+
+        record.update(self.counters)
+        record["publish_time"] = self.publish_time
+        record.update(self.peaks)
+        record.update(extra)
+
+        self.history.append(record)
+        self.write(record)
+        log.debug("Round {} metrics: {}", self.round, record)
+
+        self.round = None
+        return record
+
+    def write(self, record):
+        """
+        Write a record to the metrics file.
+        """
+
+        if self.path is None:
+            return
+
+        if self.fobj is None:
+            self.fobj = open(self.path, "wt", newline="")
+            if self.csv:
+                csv.writer(self.fobj).writerow(FIELDS)
+
+        if self.csv:
+            csv.writer(self.fobj).writerow([record[f] for f in FIELDS])
+            self.write_extra(record)
+        else:
+            self.fobj.write(json.dumps(record) + "\n")
+        self.fobj.flush()
+
+    def write_extra(self, record):
+        """
+        Write the fields of a record that are not CSV columns to the extra file.
+        """
+
+        extra = {k: v for k, v in record.items() if k not in FIELDS}
+        if not extra:
+            return
+
+        if self.extra_fobj is None:
+            self.extra_fobj = open(extra_path(self.path), "wt")
+
+        extra = dict(node=record["node"], round=record["round"], **extra)
+        self.extra_fobj.write(json.dumps(extra) + "\n")
+        self.extra_fobj.flush()
+
+    def format(self, as_csv):
+        """
+        Format the records of the recent rounds.
+        """
+
+        if not as_csv:
+            return "".join(json.dumps(r) + "\n" for r in self.history)
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        for record in self.history:
+            writer.writerow([record[f] for f in FIELDS])
+        return out.getvalue()
+
+    async def serve(self, port):
+        """
+        Start serving the records over HTTP.
+        """
+
+        log.info(f"Starting metrics server at 127.0.0.1:{port} ...")
+        self.server = await asyncio.start_server(self.handle_http, "127.0.0.1", port)
+
+    async def handle_http(self, reader, writer):
+        """
+        Answer a single HTTP GET request.
+        """
+
+        try:
+            request_line = await reader.readline()
+            while True:  # Skip the request headers
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+
+            if path == "/metrics":
+                status, ctype, body = "200 OK", "application/x-ndjson", self.format(False)
+            elif path == "/metrics.csv":
+                status, ctype, body = "200 OK", "text/csv", self.format(True)
+            else:
+                status, ctype, body = "404 Not Found", "text/plain", "Not found\n"
+
+            body = body.encode("utf-8")
+            head = (
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: {ctype}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode("latin-1") + body)
+            await writer.drain()
+        except (OSError, UnicodeDecodeError) as e:
+            log.info("Metrics request failed: {}", e)
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+        if self.extra_fobj is not None:
+            self.extra_fobj.close()
+            self.extra_fobj = None
@@ -0,0 +1,50 @@
+"""
+Queues bounded by the number of bytes buffered.
+"""
+
+import asyncio
+
+
+class ByteQueue(asyncio.Queue):
+    """
+    An asyncio queue bounded by the total size of its items in bytes.
+
+    put waits while the buffered bytes are at or above max_bytes.
+    An item is always accepted by an empty queue, irrespective of its size,
+    so a single item larger than max_bytes can not block the queue forever.
+
+    Args:
+        max_bytes: maximum number of bytes buffered (0 means unbounded)
+        sizeof: function returning the size of an item in bytes
+    """
+
+    def __init__(self, max_bytes=0, sizeof=len, loop=None):
+        if loop is None:
+            super().__init__(maxsize=0)
+        else:
+            super().__init__(maxsize=0, loop=loop)
+
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.num_bytes = 0
+
+    def full(self):
+        if self.max_bytes <= 0:
+            return False
+        return self.num_bytes >= self.max_bytes
+
+    def _put(self, item):
+        self.num_bytes += self.sizeof(item)
+        super()._put(item)
+
+    def _get(self):
+        item = super()._get()
+        self.num_bytes -= self.sizeof(item)
+        return item
+
+    def stats(self):
+        """
+        Return the current occupancy of the queue.
+        """
+
+        return {"items": self.qsize(), "bytes": self.num_bytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,202 @@
+"""
+Pass through of already serialized json values.
+
+Event batches are serialized once by the agent process
+and decoded once by the store process.
+In between they are carried around as RawJSON objects,
+which the controller never decodes.
+
+On the framed protocol and on the broker, RawJSON values that are
+direct members of a message's params or result object are replaced by
+markers and sent as separate attachments following the message.
+On the line protocol they are spliced into the message text.
+"""
+
+import re
+import json
+
+RAW_MARKER = "$matrix-raw"
+ATTACHMENTS_KEY = "attachments"
+
+# Strings, skipped whole, and the characters delimiting json values
+_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{},]')
+
+
+class RawJSON:
+    """
+    An already serialized json value.
+
+    Attributes:
+        data: bytes like object containing ASCII json text
+    """
+
+    __slots__ = ["data"]
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"RawJSON(<{len(self.data)} bytes>)"
+
+    @classmethod
+    def dumps(cls, obj):
+        """
+        Serialize obj into a RawJSON object.
+        """
+
+        return cls(json.dumps(obj).encode("ascii"))
+
+    def loads(self):
+        """
+        Deserialize the json value.
+        """
+
+        return _loads(self.data)
+
+
+def split_array(data, max_bytes):
+    """
+    Split a serialized json array into RawJSON arrays of at most max_bytes each.
+
+    The array is split between its top level elements,
+    so an element larger than max_bytes makes a chunk of its own.
+    """
+
+    if len(data) <= max_bytes:
+        yield RawJSON(data)
+        return
+
+    view = memoryview(data)
+    start = 1  # Start of the first element of the chunk
+    end = None  # End of the last element that fits in the chunk
+    for pos in _top_level_commas(data):
+        if end is not None and pos - start + 2 > max_bytes:
+            yield RawJSON(b"".join([b"[", view[start:end], b"]"]))
+            start = end + 1
+        end = pos
+
+    yield RawJSON(b"".join([b"[", view[start:end], b"]"]))
+
+
+def _top_level_commas(data):
+    """
+    Yield the positions of the commas between the elements of a json array,
+    followed by the position of its closing bracket.
+    """
+
+    depth = 0
+    for match in _TOKENS.finditer(data, 1, len(data) - 1):
+        token = match.group()
+        if token in (b"[", b"{"):
+            depth += 1
+        elif token in (b"]", b"}"):
+            depth -= 1
+        elif token == b"," and depth == 0:
+            yield match.start()
+
+    yield len(data) - 1
+
+
+def _loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _members(msg):
+    """
+    Yield the params/result objects of msg, which may be a batch.
+    """
+
+    msgs = msg if isinstance(msg, list) else [msg]
+    for m in msgs:
+        if not isinstance(m, dict):
+            continue
+        for key in ("params", "result"):
+            obj = m.get(key)
+            if isinstance(obj, dict):
+                yield m, key, obj
+
+
+def split_attachments(msg):
+    """
+    Replace the RawJSON values in msg with markers.
+
+    The params/result objects containing RawJSON values are copied,
+    and every message with attachments records their count.
+    Returns the modified message and the list of attachment data.
+    """
+
+    if isinstance(msg, list):
+        msg = [dict(m) if isinstance(m, dict) else m for m in msg]
+    else:
+        msg = dict(msg)
+
+    blobs = []
+    for m, key, obj in _members(msg):
+        raw_keys = [k for k, v in obj.items() if isinstance(v, RawJSON)]
+        if not raw_keys:
+            continue
+
+        obj = dict(obj)
+        for k in raw_keys:
+            blobs.append(obj[k].data)
+            obj[k] = {RAW_MARKER: len(blobs) - 1}
+        m[key] = obj
+        m[ATTACHMENTS_KEY] = m.get(ATTACHMENTS_KEY, 0) + len(raw_keys)
+
+    return msg, blobs
+
+
+def count_attachments(msg):
+    """
+    Return the number of attachments following msg.
+    """
+
+    msgs = msg if isinstance(msg, list) else [msg]
+    return sum(m.get(ATTACHMENTS_KEY, 0) for m in msgs if isinstance(m, dict))
+
+
+def join_attachments(msg, blobs, keep_raw):
+    """
+    Replace the markers in msg with the attachments.
+
+    keep_raw: if True the attachments are put back as RawJSON objects,
+              otherwise they are decoded.
+    """
+
+    for m, _, obj in _members(msg):
+        m.pop(ATTACHMENTS_KEY, None)
+        for k, v in obj.items():
+            if isinstance(v, dict) and len(v) == 1 and RAW_MARKER in v:
+                blob = blobs[v[RAW_MARKER]]
+                obj[k] = RawJSON(blob) if keep_raw else _loads(blob)
+
+    return msg
+
+
+def dumps(msg):
+    """
+    Serialize msg into ASCII json bytes, splicing in RawJSON values.
+    """
+
+    msg, blobs = split_attachments(msg)
+    if not blobs:
+        return json.dumps(msg).encode("ascii")
+
+    for m, _, _ in _members(msg):
+        m.pop(ATTACHMENTS_KEY, None)
+    text = json.dumps(msg).encode("ascii")
+
+    parts = []
+    for i, blob in enumerate(blobs):
+        marker = json.dumps({RAW_MARKER: i}).encode("ascii")
+        before, text = text.split(marker, 1)
+        parts.append(before)
+        parts.append(blob)
+    parts.append(text)
+
+    return b"".join(parts)
@@ -0,0 +1,114 @@
+"""
+Routing of events to the store processes interested in them.
+
+Every event is a 4 tuple (store_type, store_id, order_key, update).
+A store process may declare the (store_type, store_id) pairs it serves
+with the register_store RPC call; store processes that do not,
+are sent every event.
+Controllers announce the declarations of their store processes
+to one another before the first round,
+and the sending controller splits its events by destination.
+A controller's announcement may arrive after events of the first round
+are sent, e.g. when the barrier releases the round from another controller,
+so the store processes of a controller not heard from yet are sent every event.
+"""
+
+import logbook
+
+from .rawjson import RawJSON
+
+log = logbook.Logger(__name__)
+
+
+def event_key(event):
+    """
+    Get the (store_type, store_id) pair of an event.
+    """
+
+    try:
+        key = event[0], event[1]
+        hash(key)
+    except (TypeError, IndexError, KeyError):
+        return None
+    return key
+
+
+class Router:
+    """
+    Event router.
+
+    Args:
+        num_storeprocs: nodename -> number of store processes of the node
+
+    Attributes:
+        interests: nodename -> list with one entry per store process,
+            a frozenset of (store_type, store_id) pairs, or None for all events
+        active: False if every store process is interested in the same events,
+            in which case events need not be split.
+    """
+
+    def __init__(self, num_storeprocs):
+        self.interests = {node: [None] * n for node, n in num_storeprocs.items()}
+        self.routes = {}
+        self.active = False
+
+    def set_interests(self, nodename, stores):
+        """
+        Record the interests of a node's store processes.
+
+        stores: list with one entry per store process,
+            a list of [store_type, store_id] pairs, or None for all events
+        """
+
+        self.interests[nodename] = [
+            None if s is None else frozenset(tuple(pair) for pair in s) for s in stores
+        ]
+        self.routes = {}
+
+        distinct = {s for ss in self.interests.values() for s in ss}
+        self.active = len(distinct) > 1
+
+    def destinations(self, key):
+        """
+        Get the store processes interested in events with the given key.
+
+        Returns a sorted tuple of (nodename, (storeproc_id, ...)) pairs.
+        """
+
+        try:
+            return self.routes[key]
+        except KeyError:
+            pass
+
+        dests = []
+        for node, stores in sorted(self.interests.items()):
+            storeprocs = tuple(
+                i for i, s in enumerate(stores) if s is None or key in s
+            )
+            if storeprocs:
+                dests.append((node, storeprocs))
+        dests = tuple(dests)
+
+        self.routes[key] = dests
+        return dests
+
+    def route(self, events):
+        """
+        Split a batch of events by destination.
+
+        events: RawJSON serialized list of events
+
+        Returns a list of (storeprocs, events) pairs, where storeprocs maps
+        the destination nodenames to their store process ids,
+        and events is a RawJSON serialized list of events.
+        """
+
+        groups = {}
+        for event in events.loads():
+            dests = self.destinations(event_key(event))
+            groups.setdefault(dests, []).append(event)
+
+        return [
+            ({node: list(sps) for node, sps in dests}, RawJSON.dumps(group))
+            for dests, group in groups.items()
+        ]
@@ -0,0 +1,121 @@
+"""
+Performance profiles of the sqlite3 connections of stores and agents.
+
+A profile is a named set of connection settings:
+
+    default: sqlite's own defaults (rollback journal, synchronous=FULL)
+    durable: write ahead log, synchronous=FULL, larger cache and mmap.
+        Readers no longer wait on the store's write transaction,
+        and every committed flush survives a power loss.
+    fast: write ahead log, synchronous=NORMAL, temporary tables in memory.
+        A power loss may lose the last flushes but never corrupts the database.
+    bulk-load: write ahead log, synchronous=OFF, the largest cache.
+        For runs that are restarted from scratch on failure,
+        as a crash of the host may corrupt the database.
+
+The write ahead log mode is recorded in the database file,
+so other connections to it use the log too.
+"""
+
+import sqlite3
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+PROFILES = {
+    "default": {},
+    "durable": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 2 ** 20,
+        "temp_store": "default",
+        "cached_statements": 256,
+    },
+    "fast": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -256 * 1024,
+        "mmap_size": 2 ** 30,
+        "temp_store": "memory",
+        "cached_statements": 256,
+    },
+    "bulk-load": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "cache_size": -1024 * 1024,
+        "mmap_size": 2 ** 30,
+        "temp_store": "memory",
+        "cached_statements": 512,
+    },
+}
+
+DEFAULT_PROFILE = "default"
+
+# Pragmas set by the profiles, in the order they are applied.
+# cache_size is in pages if positive and in KiB if negative.
+PRAGMAS = ["journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store"]
+
+# Names of the values the pragmas read back as
+PRAGMA_NAMES = {
+    "synchronous": {0: "off", 1: "normal", 2: "full", 3: "extra"},
+    "temp_store": {0: "default", 1: "file", 2: "memory"},
+}
+
+
+class SqliteProfileError(Exception):
+    pass
+
+
+def read_settings(con):
+    """
+    Read the settings in effect on a connection.
+    """
+
+    settings = {}
+    for pragma in PRAGMAS:
+        row = con.execute(f"pragma {pragma}").fetchone()
+        value = row[0] if row else None  # e.g. no mmap for in memory databases
+        settings[pragma] = PRAGMA_NAMES.get(pragma, {}).get(value, value)
+    return settings
+
+
+def sqlite_connect(dsn, profile=DEFAULT_PROFILE, **kwargs):
+    """
+    Open a sqlite3 connection with the settings of a profile.
+
+    The settings in effect are logged,
+    along with the ones sqlite did not apply, e.g. the write ahead log
+    of an in memory database or an mmap_size above sqlite's compiled limit.
+
+    kwargs: further arguments of sqlite3.connect
+    """
+
+    if profile not in PROFILES:
+        raise SqliteProfileError(f"Unknown sqlite profile {profile!r}")
+    wanted = PROFILES[profile]
+
+    if "cached_statements" in wanted:
+        kwargs["cached_statements"] = wanted["cached_statements"]
+    con = sqlite3.connect(dsn, **kwargs)
+
+    for pragma in PRAGMAS:
+        if pragma in wanted:
+            con.execute(f"pragma {pragma} = {wanted[pragma]}")
+
+    settings = read_settings(con)
+    desc = ", ".join(f"{k}={v}" for k, v in settings.items())
+    log.info("sqlite profile {} for {}: {}", profile, dsn, desc)
+
+    for pragma in PRAGMAS:
+        if pragma in wanted and settings[pragma] != wanted[pragma]:
+            log.warning(
+                "sqlite {} for {} is {}, not {}",
+                pragma,
+                dsn,
+                settings[pragma],
+                wanted[pragma],
+            )
+
+    return con
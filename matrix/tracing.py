@@ -0,0 +1,225 @@
+"""
+Opt-in tracing of the main phases of a run, in the Chrome trace format.
+
+Tracing is enabled by setting the MATRIX_TRACE_DIR environment variable
+to a directory, for the controllers, the agent and the store processes alike.
+Every process writes its spans to a file of its own in the directory,
+one Chrome trace event per line,
+and `matrix trace merge` combines the files into a single trace
+that can be opened with chrome://tracing or https://ui.perfetto.dev.
+
+Span timestamps are wall clock times, so the spans of processes
+on different hosts line up only as well as the hosts' clocks do.
+"""
+
+import os
+import re
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+TRACE_DIR_ENV = "MATRIX_TRACE_DIR"
+TRACE_SUFFIX = ".trace.jsonl"
+
+
+class Tracer:
+    """
+    Record spans of a process.
+
+    Spans are grouped into named tracks, shown as threads of the process.
+    Spans may be recorded from several threads.
+
+    Args:
+        fobj: text file the trace events are written to
+        process_name: name the process is shown with
+    """
+
+    def __init__(self, fobj, process_name):
+        self.fobj = fobj
+        self.pid = os.getpid()
+        self.tracks = {}
+        self.lock = threading.RLock()
+
+        self.write(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": 0,
+                "args": {"name": process_name},
+            }
+        )
+
+    def write(self, event):
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            if self.fobj is not None:
+                self.fobj.write(line)
+
+    def track_id(self, track):
+        """
+        Get the thread id of a track, naming the track when first used.
+        """
+
+        with self.lock:
+            try:
+                return self.tracks[track]
+            except KeyError:
+                pass
+
+            tid = len(self.tracks) + 1
+            self.tracks[track] = tid
+            self.write(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": track},
+                }
+            )
+            return tid
+
+    def complete(self, name, start, end, track="main", **args):
+        """
+        Record a span that started and ended at the given times.
+        """
+
+        self.write(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self.pid,
+                "tid": self.track_id(track),
+                "args": args,
+            }
+        )
+
+    @contextmanager
+    def span(self, name, track="main", **args):
+        """
+        Record a span around the body of a with statement.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.time(), track, **args)
+
+    def close(self):
+        with self.lock:
+            if self.fobj is not None:
+                self.fobj.close()
+                self.fobj = None
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+
+class NullTracer:
+    """
+    Tracer used when tracing is not enabled, it records nothing.
+    """
+
+    null_span = NullSpan()
+
+    def complete(self, name, start, end, track="main", **args):
+        pass
+
+    def span(self, name, track="main", **args):
+        return self.null_span
+
+    def close(self):
+        pass
+
+
+def get_tracer(process_name):
+    """
+    Get the tracer of a process, a NullTracer unless tracing is enabled.
+
+    process_name: name the process is shown with, e.g. "controller node1"
+    """
+
+    trace_dir = os.environ.get(TRACE_DIR_ENV)
+    if not trace_dir:
+        return NullTracer()
+
+    os.makedirs(trace_dir, exist_ok=True)
+    prefix = re.sub(r"[^\w.-]+", "-", process_name) + f"-{os.getpid()}"
+
+    # Processes may have more than one tracer with the same name
+    for i in itertools.count():
+        fname = prefix + (f"-{i}" if i else "") + TRACE_SUFFIX
+        path = os.path.join(trace_dir, fname)
+        try:
+            fobj = open(path, "xt", buffering=1)
+            break
+        except FileExistsError:
+            continue
+
+    log.info(f"Writing trace to {path}")
+    return Tracer(fobj, process_name)
+
+
+def read_trace(path):
+    """
+    Read the trace events of a process.
+
+    A process that was killed may have left its last line incomplete,
+    which is skipped.
+    """
+
+    events = []
+    with open(path, "rt") as fobj:
+        for lineno, line in enumerate(fobj, 1):
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                log.warning(f"Skipping malformed trace event at {path}:{lineno}")
+    return events
+
+
+def merge_traces(paths, output):
+    """
+    Merge the traces of the processes of a run into a single trace file.
+
+    paths: trace files, or directories containing them
+    output: path of the merged trace
+    """
+
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if fname.endswith(TRACE_SUFFIX):
+                    fnames.append(os.path.join(path, fname))
+        else:
+            fnames.append(path)
+
+    metadata = []
+    events = []
+    for fname in fnames:
+        for event in read_trace(fname):
+            if event.get("ph") == "M":
+                metadata.append(event)
+            else:
+                events.append(event)
+    events.sort(key=lambda e: e.get("ts", 0))
+
+    log.info(f"Merging {len(events)} trace events from {len(fnames)} files")
+    with open(output, "wt") as fobj:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, fobj)
@@ -0,0 +1,41 @@
+"""
+Transports for the messages exchanged between controllers.
+
+The transport is selected with the transport configuration option:
+
+    amqp: through a RabbitMQ fanout exchange
+    mesh: through direct TCP connections between the controllers
+    local: within the controller process, for single node simulations
+    auto: local if there is a single node, amqp otherwise (default)
+"""
+
+from .base import Transport, TransportError
+from .amqp import AMQPTransport
+from .mesh import MeshTransport
+from .local import LocalTransport
+
+TRANSPORTS = {"amqp": AMQPTransport, "mesh": MeshTransport, "local": LocalTransport}
+
+
+def transport_name(config):
+    """
+    Get the name of the configured transport, resolving auto.
+    """
+
+    name = config.get("transport", "auto")
+    if name == "auto":
+        name = "local" if len(config.sim_nodes) == 1 else "amqp"
+    return name
+
+
+def get_transport(config, nodename):
+    """
+    Create the configured transport.
+
+    nodename: nodename of the controller, or None for the event logger
+    """
+
+    name = transport_name(config)
+    if name not in TRANSPORTS:
+        raise TransportError(f"Unknown transport {name!r}")
+    return TRANSPORTS[name](config, nodename)
@@ -0,0 +1,514 @@
+"""
+Transport through a RabbitMQ headers exchange.
+
+Every message carries a header per destination,
+"node.<nodename>" for controllers and "eventlog" for the event logger,
+along with a "plane" header telling data messages from control messages.
+Each controller binds one exclusive queue per plane to its own header,
+and consumes each of them on its own connection.
+The event logger binds a single queue.
+So a message is only routed to the receivers it names,
+and control messages never queue behind data messages.
+
+Received messages are acknowledged in batches, with a single ack
+covering every message up to it, and the broker is told how many
+unacknowledged messages it may push to a receiver (prefetch).
+Publisher confirms are optional, in which case a bounded number
+of published messages may await the broker's confirm at a time.
+
+Controllers keep the events of a message below broker_max_message_bytes,
+splitting larger batches between events into messages of their own,
+so every message is compressed and received whole.
+"""
+
+import json
+import time
+import asyncio
+from functools import partial
+
+import logbook
+import aioamqp
+from aioamqp.channel import Channel
+from aioamqp.protocol import AmqpProtocol
+
+from ..json_rpc import rpc_request
+from ..compression import get_compression, compress_parts, decompress
+from ..rawjson import ATTACHMENTS_KEY, split_attachments, join_attachments
+from .base import DATA_PLANE, CONTROL_PLANE, Transport, TransportError, message_plane
+
+log = logbook.Logger(__name__)
+
+EVENTLOG_HEADER = "eventlog"
+PLANE_HEADER = "plane"
+
+# Default number of unacknowledged messages the broker may push to a receiver
+PREFETCH_COUNT = 256
+
+# Received messages are acknowledged every ACK_EVERY messages,
+# or ACK_DELAY seconds after the oldest unacknowledged one, whichever is sooner.
+ACK_EVERY = 64
+ACK_DELAY = 0.05
+
+# Default size above which a batch of events is split into several messages
+MAX_MESSAGE_BYTES = 8 * 2 ** 20
+
+
+def node_header(nodename):
+    """
+    Header naming a controller as a destination.
+    """
+
+    return f"node.{nodename}"
+
+
+class AMQPTransport(Transport):
+    """
+    Exchange messages through the broker.
+
+    Every controller, and the event logger,
+    binds an exclusive queue to the event exchange.
+    A controller's own messages are not sent through the broker,
+    they are handed directly to the controller.
+
+    Configuration:
+        broker_prefetch_count: number of unacknowledged messages
+            the broker may push to a receive queue (0 means unlimited)
+        broker_ack_every: acknowledge received messages every so many messages
+        broker_ack_delay: or after so many seconds
+        broker_confirm_window: number of published messages that may await
+            the broker's confirm (0, the default, disables publisher confirms)
+        broker_max_message_bytes: size above which a batch of events
+            is split into several messages
+    """
+
+    def __init__(self, config, nodename):
+        super().__init__(config, nodename)
+
+        self.compression = get_compression(config)
+        self.connections = []
+        self.snd_chans = {}
+        self.ackers = []
+
+        self.prefetch_count = config.get("broker_prefetch_count", PREFETCH_COUNT)
+        self.ack_every = config.get("broker_ack_every", ACK_EVERY)
+        self.ack_delay = config.get("broker_ack_delay", ACK_DELAY)
+        self.confirm_window = config.get("broker_confirm_window", 0)
+        self.max_message_bytes = config.get(
+            "broker_max_message_bytes", MAX_MESSAGE_BYTES
+        )
+
+        # The broker stops pushing once prefetch_count messages are unacknowledged,
+        # so they should be acknowledged before that.
+        if self.prefetch_count > 0:
+            self.ack_every = max(1, min(self.ack_every, self.prefetch_count // 2))
+
+    async def start(self, receiver):
+        self.receiver = receiver
+        config = self.config
+
+        if self.nodename is None:
+            log.info("Creating AMQP receive channel ...")
+            rcv_chan = await self.open_channel()
+
+            log.info("Setting up event exchange ...")
+            await declare_exchange(rcv_chan, config)
+
+            log.info("Setting up AMQP receiver ...")
+            await self.make_receiver(rcv_chan, {EVENTLOG_HEADER: True})
+            return
+
+        for plane in (DATA_PLANE, CONTROL_PLANE):
+            log.info(f"Creating AMQP {plane} send channel ...")
+            snd_chan = await self.open_channel()
+            if self.confirm_window > 0:
+                snd_chan = await ConfirmedChannel.create(snd_chan, self.confirm_window)
+            self.snd_chans[plane] = snd_chan
+
+        log.info("Setting up event exchange ...")
+        await declare_exchange(self.snd_chans[CONTROL_PLANE], config)
+        log.info("Using broker message compression: {}", self.compression[0])
+
+        for plane in (DATA_PLANE, CONTROL_PLANE):
+            log.info(f"Setting up AMQP {plane} receiver ...")
+            rcv_chan = await self.open_channel()
+            bindings = {node_header(self.nodename): True, PLANE_HEADER: plane}
+            await self.make_receiver(rcv_chan, bindings)
+
+    async def make_receiver(self, channel, bindings):
+        """
+        Start consuming the messages with the given headers on a channel.
+        """
+
+        acker = BatchAcker(channel, self.ack_every, self.ack_delay)
+        self.ackers.append(acker)
+
+        bm_callback = partial(handle_broker_message, self, acker)
+        await make_receiver_queue(
+            bm_callback, channel, self.config, bindings, self.prefetch_count
+        )
+
+    async def open_channel(self):
+        """
+        Open a channel on a connection of its own.
+        """
+
+        trans, proto, chan = await make_amqp_channel(self.config)
+        self.connections.append((trans, proto))
+        return chan
+
+    async def send(self, nodes, method, **params):
+        destinations = {
+            node_header(node): True for node in nodes if node != self.nodename
+        }
+        if self.event_logging:
+            destinations[EVENTLOG_HEADER] = True
+
+        if destinations:
+            plane = message_plane(method)
+            destinations[PLANE_HEADER] = plane
+            await send_broker_message(
+                self.snd_chans[plane],
+                self.config.event_exchange,
+                self.compression,
+                destinations,
+                method,
+                **params,
+            )
+
+        if self.nodename in nodes:
+            await self.deliver(rpc_request(method, id=False, **params))
+
+    async def close(self):
+        for snd_chan in self.snd_chans.values():
+            if isinstance(snd_chan, ConfirmedChannel):
+                log.info("Waiting for publisher confirms ...")
+                await snd_chan.wait_confirmed()
+
+        for acker in self.ackers:
+            await acker.flush()
+        self.ackers = []
+
+        log.info("Closing AMQP channels ...")
+        for trans, proto in self.connections:
+            await proto.close()
+            trans.close()
+        self.connections = []
+
+
+class BatchAcker:
+    """
+    Acknowledge the messages received on a channel in batches.
+
+    Messages on a channel are handled in the order they are delivered,
+    so a single ack with multiple set covers every message handled so far.
+
+    Args:
+        channel: the receive channel
+        every: acknowledge once this many messages are unacknowledged
+        delay: or once the oldest unacknowledged message is this many seconds old
+    """
+
+    def __init__(self, channel, every, delay):
+        self.channel = channel
+        self.every = every
+        self.delay = delay
+
+        self.last_tag = None
+        self.num_pending = 0
+        self.timer = None
+
+    async def ack(self, delivery_tag):
+        """
+        Acknowledge a handled message, eventually.
+        """
+
+        self.last_tag = delivery_tag
+        self.num_pending += 1
+
+        if self.num_pending >= self.every:
+            await self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Acknowledge every message handled so far.
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.num_pending:
+            return
+        self.num_pending = 0
+
+        await self.channel.basic_client_ack(delivery_tag=self.last_tag, multiple=True)
+
+
+class AMQPChannel(Channel):
+    """
+    aioamqp channel handing the broker's publisher confirms to a ConfirmedChannel.
+
+    Channels without one handle confirms as aioamqp does.
+    """
+
+    confirms = None
+
+    async def basic_server_ack(self, frame):
+        if self.confirms is None:
+            await super().basic_server_ack(frame)
+        else:
+            await self.confirms.server_ack(frame)
+
+    async def basic_server_nack(self, frame, delivery_tag=None):
+        if self.confirms is None:
+            await super().basic_server_nack(frame, delivery_tag)
+        else:
+            await self.confirms.server_nack(frame)
+
+
+class AMQPProtocol(AmqpProtocol):
+    CHANNEL_FACTORY = AMQPChannel
+
+
+class ConfirmedChannel:
+    """
+    Send channel in publisher confirm mode, with pipelined confirms.
+
+    Up to window published messages may await their confirm,
+    further publishing waits for the broker to catch up.
+    aioamqp waits for each message's confirm before returning from basic_publish,
+    and does not handle confirms covering multiple messages,
+    so confirms are tracked here instead, as handed over by the AMQPChannel.
+    """
+
+    def __init__(self, channel, window):
+        self.channel = channel
+        self.window = window
+
+        self.next_tag = 1
+        self.unconfirmed = set()
+        self.rejected = []
+        self.changed = asyncio.Condition()
+
+    @classmethod
+    async def create(cls, channel, window):
+        """
+        Put an AMQPChannel in confirm mode.
+        """
+
+        chan = cls(channel, window)
+
+        await channel.confirm_select()
+        # Otherwise aioamqp's basic_publish waits for the message's confirm
+        channel.publisher_confirms = False
+        channel.confirms = chan
+
+        return chan
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def check(self):
+        if self.rejected:
+            raise TransportError(f"Broker rejected {len(self.rejected)} messages")
+
+    async def basic_publish(self, *args, **kwargs):
+        async with self.changed:
+            await self.changed.wait_for(lambda: len(self.unconfirmed) < self.window)
+        self.check()
+
+        # The broker numbers published messages from 1, in the order they arrive
+        self.unconfirmed.add(self.next_tag)
+        self.next_tag += 1
+        await self.channel.basic_publish(*args, **kwargs)
+
+    async def wait_confirmed(self):
+        """
+        Wait for every published message to be confirmed.
+        """
+
+        async with self.changed:
+            await self.changed.wait_for(lambda: not self.unconfirmed)
+        self.check()
+
+    async def confirmed(self, delivery_tag, multiple):
+        if multiple:
+            self.unconfirmed = {t for t in self.unconfirmed if t > delivery_tag}
+        else:
+            self.unconfirmed.discard(delivery_tag)
+
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def server_ack(self, frame):
+        await self.confirmed(frame.delivery_tag, frame.multiple)
+
+    async def server_nack(self, frame):
+        log.error("Broker rejected message {}", frame.delivery_tag)
+        self.rejected.append(frame.delivery_tag)
+        await self.confirmed(frame.delivery_tag, frame.multiple)
+
+
+async def handle_broker_message(transport, acker, channel, body, envelope, properties):
+    """
+    Callback handler, for messages from amqp broker.
+
+    transport   : the transport receiving the message
+    acker       : the BatchAcker of the channel
+    channel     : channel from which message was received
+    body        : bytes object body of the message
+    envelope    : envelope
+    properties  : properties
+    """
+
+    body = decompress(properties.content_encoding, body)
+    request = decode_broker_message(body, properties.headers)
+
+    await transport.deliver(request)
+
+    # Send ack back to server
+    await acker.ack(envelope.delivery_tag)
+
+
+def encode_broker_parts(method, **kwargs):
+    """
+    Serialize a notification to be sent through the broker, as a list of parts.
+
+    RawJSON parameters are appended to the message body as attachments,
+    which are not copied.
+    Returns the parts of the message body and the AMQP headers.
+    """
+
+    request = rpc_request(method, id=False, **kwargs)
+    request, blobs = split_attachments(request)
+
+    request = json.dumps(request).encode("ascii")
+    if not blobs:
+        return [request], {}
+
+    headers = {ATTACHMENTS_KEY: ",".join(str(len(b)) for b in blobs)}
+    return [request] + blobs, headers
+
+
+def decode_broker_message(body, headers):
+    """
+    Deserialize a message received through the broker.
+
+    Attachments are returned as RawJSON objects referring to the body.
+    """
+
+    sizes = (headers or {}).get(ATTACHMENTS_KEY)
+    if not sizes:
+        return json.loads(body)
+
+    body = memoryview(body)
+    sizes = [int(x) for x in sizes.split(",")]
+    start = len(body) - sum(sizes)
+
+    request = json.loads(bytes(body[:start]))
+    blobs = []
+    for size in sizes:
+        blobs.append(body[start : start + size])
+        start += size
+
+    return join_attachments(request, blobs, keep_raw=True)
+
+
+async def send_broker_message(
+    chan, exchange_name, compression, destinations, method, **kwargs
+):
+    """
+    Send a message to the broker to be shared with other controllers.
+
+    compression: (method, level) tuple used to compress the message
+    destinations: headers naming the receivers of the message
+    """
+
+    parts, headers = encode_broker_parts(method, **kwargs)
+    headers.update(destinations)
+
+    parts, content_encoding = compress_parts(*compression, parts)
+    properties = {"headers": headers}
+    if content_encoding is not None:
+        properties["content_encoding"] = content_encoding
+
+    await chan.basic_publish(
+        b"".join(parts),
+        exchange_name=exchange_name,
+        routing_key="",
+        properties=properties,
+    )
+
+
+async def make_amqp_channel(config):
+    """
+    Create an async amqp channel.
+    """
+
+    timeout = 60
+    start = time.time()
+    while True:
+        try:
+            transport, protocol = await aioamqp.connect(
+                host=config.rabbitmq_host,
+                port=config.rabbitmq_port,
+                login=config.rabbitmq_username,
+                password=config.rabbitmq_password,
+                protocol_factory=AMQPProtocol,
+            )
+            break
+        except OSError as e:
+            log.info("Failed to connect to RabbitMQ: {}", e)
+
+            since = time.time() - start
+            if since > timeout:
+                raise RuntimeError("Failed to connect to RabbitMQ")
+            else:
+                time.sleep(5)
+
+    channel = await protocol.channel()
+    return transport, protocol, channel
+
+
+async def declare_exchange(channel, config):
+    """
+    Declare the event exchange.
+    """
+
+    await channel.exchange_declare(
+        exchange_name=config.event_exchange, type_name="headers"
+    )
+
+
+async def make_receiver_queue(callback, channel, config, bindings, prefetch_count=0):
+    """
+    Make the receiver queue and bind it to messages with all the given headers.
+
+    prefetch_count: number of unacknowledged messages the broker may push
+        to the queue's consumer (0 means unlimited)
+    """
+
+    if prefetch_count > 0:
+        await channel.basic_qos(prefetch_count=prefetch_count)
+
+    queue = await channel.queue_declare("", exclusive=True)
+    queue_name = queue["queue"]
+
+    arguments = {"x-match": "all"}
+    arguments.update(bindings)
+    await channel.queue_bind(
+        exchange_name=config.event_exchange,
+        queue_name=queue_name,
+        routing_key="",
+        arguments=arguments,
+    )
+
+    await channel.basic_consume(callback, queue_name=queue_name)
+    return queue
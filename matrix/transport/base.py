@@ -0,0 +1,104 @@
+"""
+Transport interface.
+"""
+
+import asyncio
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Messages carrying events are sent on the data plane,
+# the rest, used for coordination, on the control plane.
+DATA_PLANE = "data"
+CONTROL_PLANE = "control"
+DATA_METHODS = frozenset(["store_events"])
+
+
+def message_plane(method):
+    """
+    Get the plane a message is sent on.
+    """
+
+    return DATA_PLANE if method in DATA_METHODS else CONTROL_PLANE
+
+
+class TransportError(Exception):
+    pass
+
+
+class Transport:
+    """
+    Base class of the transports carrying messages between controllers.
+
+    Messages are json rpc notifications (store_events, controller_finished).
+    A message published by a controller is delivered to every controller,
+    including itself, and to the event logger if event logging is enabled.
+    Transports hand a controller's messages to itself without sending them out.
+
+    Data and control messages are carried separately,
+    so control messages never wait behind bulk data.
+    Messages of a plane from a sender are delivered in the order they were sent,
+    and each receiver handles the messages of a plane one at a time.
+    There is no ordering between the planes; receivers rely on the message
+    counts exchanged at the round barrier instead (see matrix.barrier).
+
+    Controllers split batches of events larger than max_message_bytes
+    into several messages, None meaning the transport has no limit.
+
+    Args:
+        config: the matrix configuration
+        nodename: nodename of the controller,
+            or None when used by the event logger which only receives.
+    """
+
+    def __init__(self, config, nodename):
+        self.config = config
+        self.nodename = nodename
+        self.receiver = None
+        self.max_message_bytes = None
+
+        self.event_logging = config.get("event_logging", True)
+        self.deliver_locks = {DATA_PLANE: asyncio.Lock(), CONTROL_PLANE: asyncio.Lock()}
+
+    async def start(self, receiver):
+        """
+        Connect to the peers and start handing messages to receiver.
+
+        receiver: object with a dispatch coroutine (Controller, EventLogger)
+        """
+
+        raise NotImplementedError
+
+    async def publish(self, method, **params):
+        """
+        Send a notification to all the controllers.
+        """
+
+        await self.send(self.config.sim_nodes, method, **params)
+
+    async def send(self, nodes, method, **params):
+        """
+        Send a notification to the given controllers.
+
+        The event logger is sent every notification, irrespective of nodes.
+        """
+
+        raise NotImplementedError
+
+    async def close(self):
+        """
+        Release the transport's connections.
+        """
+
+        raise NotImplementedError
+
+    async def deliver(self, request):
+        """
+        Hand a received message to the receiver.
+        """
+
+        plane = message_plane(request.get("method"))
+        async with self.deliver_locks[plane]:
+            response = await self.receiver.dispatch(request)
+        assert response is None
@@ -0,0 +1,30 @@
+"""
+In process transport for single node simulations.
+"""
+
+import logbook
+
+from ..json_rpc import rpc_request
+from .base import Transport
+
+log = logbook.Logger(__name__)
+
+
+class LocalTransport(Transport):
+    """
+    Hand messages straight to the controller's own dispatch.
+
+    With a single controller, every message published is only
+    received by the publisher itself, so no broker is needed.
+    Messages are delivered before publish returns.
+    """
+
+    async def start(self, receiver):
+        self.receiver = receiver
+
+    async def send(self, nodes, method, **params):
+        if self.nodename in nodes:
+            await self.deliver(rpc_request(method, id=False, **params))
+
+    async def close(self):
+        pass
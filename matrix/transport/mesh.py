@@ -0,0 +1,253 @@
+"""
+Transport over direct TCP connections between controllers.
+
+Every controller listens on its mesh address and opens two connections,
+one per plane, to every other controller, and to the event logger if configured.
+A connection starts with a hello message naming the sender and the plane,
+followed by the sender's messages in the framed protocol's json codec
+(see matrix.framing), so event batches are passed through undecoded.
+
+Messages of a plane from all connections and the controller's own messages
+are funneled into the plane's inbox and handled one at a time,
+as with the broker's per controller queues.
+Per sender ordering follows from each sender using a single connection per plane.
+"""
+
+import time
+import socket
+import asyncio
+from operator import itemgetter
+
+import logbook
+
+from ..json_rpc import rpc_request
+from ..framing import (
+    MAX_FRAME_SIZE,
+    FramingError,
+    message_frames,
+    read_message,
+    write_frame,
+)
+from ..queues import ByteQueue
+from ..rawjson import RawJSON
+from .base import DATA_PLANE, CONTROL_PLANE, Transport, TransportError, message_plane
+
+log = logbook.Logger(__name__)
+
+CODEC = "json"
+
+# Default limit on the bytes of events buffered in the data inbox.
+# Peer data connections stop being read while the inbox is full.
+MAX_INBOX_BYTES = 512 * 2 ** 20
+
+# Default time to wait for a peer to start listening
+CONNECT_TIMEOUT = 60
+
+# Peer name of the event logger
+EVENTLOG_PEER = "<eventlog>"
+
+
+def parse_address(address):
+    """
+    Parse a host:port string.
+    """
+
+    host, _, port = str(address).rpartition(":")
+    if not host or not port.isdigit():
+        raise TransportError(f"Invalid mesh address {address!r}")
+    return host, int(port)
+
+
+def request_size(request):
+    """
+    Size of the events carried by a request.
+    """
+
+    params = request.get("params")
+    if not isinstance(params, dict):
+        return 0
+    return sum(len(v) for v in params.values() if isinstance(v, RawJSON))
+
+
+class MeshTransport(Transport):
+    """
+    Exchange messages over direct connections between controllers.
+
+    Configuration:
+        mesh_address: host:port each controller listens on, per node
+        eventlog_address: host:port the event logger listens on (optional)
+        max_inbox_bytes: limit on the bytes of events buffered in the data inbox
+    """
+
+    def __init__(self, config, nodename):
+        super().__init__(config, nodename)
+
+        if nodename is None:
+            address = config.get("eventlog_address")
+            if address is None:
+                raise TransportError("eventlog_address is not defined")
+            self.address = parse_address(address)
+            self.peer_addresses = {}
+        else:
+            self.address = parse_address(config.mesh_address[nodename])
+            self.peer_addresses = {
+                node: parse_address(config.mesh_address[node])
+                for node in config.sim_nodes
+                if node != nodename
+            }
+            address = config.get("eventlog_address")
+            if address is not None and self.event_logging:
+                self.peer_addresses[EVENTLOG_PEER] = parse_address(address)
+
+        max_inbox_bytes = config.get("max_inbox_bytes", MAX_INBOX_BYTES)
+        self.inboxes = {
+            DATA_PLANE: ByteQueue(max_inbox_bytes, itemgetter(0)),
+            CONTROL_PLANE: ByteQueue(0, itemgetter(0)),
+        }
+
+        # Events are sent as a frame of their own, which receivers bound
+        self.max_message_bytes = MAX_FRAME_SIZE
+
+        self.server = None
+        self.writers = {}
+        self.tasks = []
+        self.send_locks = {DATA_PLANE: asyncio.Lock(), CONTROL_PLANE: asyncio.Lock()}
+
+    async def start(self, receiver):
+        self.receiver = receiver
+
+        host, port = self.address
+        log.info(f"Starting mesh server at {host}:{port} ...")
+        self.server = await asyncio.start_server(self.accept_peer, host, port)
+
+        for inbox in self.inboxes.values():
+            self.tasks.append(asyncio.ensure_future(self.inbox_loop(inbox)))
+
+        if self.peer_addresses:
+            log.info("Connecting to mesh peers ...")
+            links = [
+                (peer, plane)
+                for peer in self.peer_addresses
+                for plane in (DATA_PLANE, CONTROL_PLANE)
+            ]
+            writers = await asyncio.gather(*[self.connect(*link) for link in links])
+            self.writers = dict(zip(links, writers))
+
+    async def connect(self, peer, plane):
+        """
+        Open a connection to a peer, waiting for it to start listening.
+        """
+
+        host, port = self.peer_addresses[peer]
+
+        start = time.time()
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                break
+            except OSError as e:
+                log.info("Failed to connect to mesh peer {}: {}", peer, e)
+
+                since = time.time() - start
+                if since > CONNECT_TIMEOUT:
+                    raise TransportError(f"Failed to connect to mesh peer {peer}")
+                else:
+                    await asyncio.sleep(1)
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        for body in message_frames(CODEC, {"node": self.nodename, "plane": plane}):
+            write_frame(writer, body)
+        await writer.drain()
+
+        log.info(f"Connected to mesh peer {peer} at {host}:{port} ({plane})")
+        return writer
+
+    def accept_peer(self, reader, writer):
+        """
+        Handle a new peer connection in a task of its own, cancelled on close.
+        """
+
+        self.tasks.append(asyncio.ensure_future(self.handle_peer(reader, writer)))
+
+    async def handle_peer(self, reader, writer):
+        """
+        Read messages from a peer into the inbox of the connection's plane.
+        """
+
+        try:
+            hello = await read_message(reader, CODEC, keep_raw=True)
+            if hello is None:
+                return
+            peer, plane = hello.get("node"), hello.get("plane", DATA_PLANE)
+            if plane not in self.inboxes:
+                raise ValueError(f"Unknown plane {plane!r}")
+            log.info("Mesh peer {} connected ({})", peer, plane)
+
+            inbox = self.inboxes[plane]
+            while True:
+                request = await read_message(reader, CODEC, keep_raw=True)
+                if request is None:
+                    log.info("Mesh peer {} disconnected ({})", peer, plane)
+                    return
+                await inbox.put((request_size(request), request))
+        except (FramingError, OSError, ValueError) as e:
+            log.error("Connection to mesh peer failed: {}", e)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            writer.close()
+
+    async def inbox_loop(self, inbox):
+        """
+        Hand the received messages to the receiver, one at a time.
+        """
+
+        try:
+            while True:
+                _, request = await inbox.get()
+                await self.deliver(request)
+        except asyncio.CancelledError:
+            pass
+
+    async def send(self, nodes, method, **params):
+        request = rpc_request(method, id=False, **params)
+        bodies = message_frames(CODEC, request)
+
+        plane = message_plane(method)
+        peers = [
+            peer
+            for peer in self.peer_addresses
+            if peer in nodes or peer == EVENTLOG_PEER
+        ]
+
+        async with self.send_locks[plane]:
+            for peer in peers:
+                writer = self.writers[peer, plane]
+                for body in bodies:
+                    write_frame(writer, body)
+                try:
+                    await writer.drain()
+                except OSError as e:
+                    raise TransportError(f"Failed to send to mesh peer {peer}: {e}")
+
+            if self.nodename in nodes:
+                await self.inboxes[plane].put((request_size(request), request))
+
+    async def close(self):
+        log.info("Closing mesh connections ...")
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
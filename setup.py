@@ -11,7 +11,7 @@ setup(
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
 
-    packages=["matrix", "matrix.client"],
+    packages=["matrix", "matrix.client", "matrix.transport"],
     scripts=["bin/matrix", "bin/bluepill"],
 
     use_scm_version=True,
@@ -22,10 +22,13 @@ setup(
         "logbook",
         "attrdict",
         "pyyaml",
-        "aioamqp",
-        "more-itertools",
-        "sortedcontainers"
+        # The transport subclasses aioamqp's channel (see matrix.transport.amqp)
+        "aioamqp>=0.15,<0.16",
     ],
+    extras_require={
+        "msgpack": ["msgpack"],
+        "zstd": ["zstandard"],
+    },
 
     url="http://github.com/NSSAC/socioneticus-matrix",
     classifiers=(
@@ -2,15 +2,30 @@
 Common fixtures for other tests.
 """
 
+import asyncio
 from pathlib import Path
 from subprocess import Popen as _Popen, DEVNULL
 
+import yaml
 import pytest
 
 @pytest.fixture
 def tempdir(tmpdir):
     return Path(tmpdir)
 
+@pytest.fixture
+def loop():
+    """
+    Fixture for a fresh event loop, set as the current one.
+    """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+
+    loop.close()
+    asyncio.set_event_loop(None)
+
 @pytest.fixture
 def popener(tempdir):
     """
@@ -55,3 +70,34 @@ def popener(tempdir):
         fobj.close()
     for fobj in errs:
         fobj.close()
+
+@pytest.fixture
+def start_controller(tempdir, popener):
+    """
+    Fixture for starting a single node controller without agent or store processes.
+    """
+
+    def do_start(port, **config):
+        """
+        Start the controller; config overrides the default configuration.
+        """
+
+        cfg = {
+            "sim_nodes": ["node0"],
+            "controller_port": {"node0": port},
+            "num_agentprocs": {"node0": 1},
+            "num_storeprocs": {"node0": 1},
+            "root_seed": 42,
+            "num_rounds": 1,
+        }
+        cfg.update(config)
+
+        config_fname = tempdir / "controller-config.yaml"
+        with open(config_fname, "wt") as fobj:
+            fobj.write(yaml.dump(cfg))
+
+        # Not through a shell, so that the controller itself is terminated
+        cmd = ["matrix", "controller", "-c", str(config_fname), "-n", "node0"]
+        return popener(cmd, output_prefix="controller-node0")
+
+    return do_start
@@ -0,0 +1,241 @@
+"""
+Test sending messages through the broker, without a broker.
+"""
+# pylint: disable=redefined-outer-name
+
+import random
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pamqp.commands import Basic, Confirm
+
+from matrix.compression import DEFAULT_LEVELS, zstandard
+from matrix.rawjson import RawJSON
+from matrix.transport.base import TransportError
+from matrix.transport.amqp import (
+    AMQPChannel,
+    BatchAcker,
+    ConfirmedChannel,
+    handle_broker_message,
+    send_broker_message,
+)
+
+NO_ZSTD = pytest.mark.skipif(zstandard is None, reason="zstandard not installed")
+METHODS = ["none", "zlib", pytest.param("zstd", marks=NO_ZSTD)]
+
+class Channel:
+    """
+    Channel recording the messages published on it.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    async def basic_publish(self, payload, exchange_name, routing_key, properties):
+        properties = SimpleNamespace(
+            headers=properties["headers"],
+            content_encoding=properties.get("content_encoding"),
+        )
+        self.published.append((payload, properties))
+
+class Receiver:
+    """
+    Stand in for the receiving transport and its acker.
+    """
+
+    def __init__(self):
+        self.delivered = []
+        self.num_acked = 0
+
+    async def deliver(self, request):
+        self.delivered.append(request)
+
+    async def ack(self, delivery_tag):
+        self.num_acked += 1
+
+    async def receive(self, payload, properties):
+        envelope = SimpleNamespace(delivery_tag=self.num_acked + 1)
+        await handle_broker_message(self, self, None, payload, envelope, properties)
+
+def make_events(rng, nodename, num_events):
+    """
+    Make a batch of bluepill like events.
+    """
+
+    events = []
+    for i in range(num_events):
+        agent_id = f"{nodename}-{rng.randrange(1000)}"
+        state = rng.choice(["rock", "paper", "scissors"])
+        sql = "insert into event values (?,?,?)"
+        events.append(["sqlite3", "event_store", [agent_id, i], [sql, [agent_id, state, i]]])
+    return RawJSON.dumps(events)
+
+def interleave(rng, streams):
+    """
+    Merge the streams at random, keeping the order of each stream.
+    """
+
+    streams = [list(s) for s in streams if s]
+    while streams:
+        stream = rng.choice(streams)
+        yield stream.pop(0)
+        if not stream:
+            streams.remove(stream)
+
+@pytest.mark.parametrize("method", METHODS)
+def test_round_trip(loop, method):
+    """
+    Test messages of interleaved senders are decoded, each received whole.
+    """
+
+    rng = random.Random(42)
+    compression = method, DEFAULT_LEVELS.get(method)
+    nodenames = ["node0", "node1", "node2"]
+
+    sent = {}
+    channels = []
+    for nodename in nodenames:
+        sent[nodename] = [make_events(rng, nodename, rng.randint(50, 200)) for _ in range(3)]
+
+        chan = Channel()
+        for events in sent[nodename]:
+            coro = send_broker_message(
+                chan,
+                "events",
+                compression,
+                {"node.node9": "1"},
+                "store_events",
+                nodename=nodename,
+                events=events,
+            )
+            loop.run_until_complete(coro)
+        channels.append(chan)
+
+    assert all(len(chan.published) == 3 for chan in channels)
+
+    receiver = Receiver()
+    for payload, properties in interleave(rng, [c.published for c in channels]):
+        loop.run_until_complete(receiver.receive(payload, properties))
+
+    assert receiver.num_acked == 9
+
+    received = {nodename: [] for nodename in nodenames}
+    for request in receiver.delivered:
+        assert request["method"] == "store_events"
+        params = request["params"]
+        received[params["nodename"]].append(bytes(params["events"].data))
+    assert received == {n: [e.data for e in es] for n, es in sent.items()}
+
+class AckChannel:
+    """
+    Channel recording the acks sent on it.
+    """
+
+    def __init__(self):
+        self.acks = []
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+class Protocol:
+    """
+    Connection discarding the frames written to it.
+    """
+
+    server_frame_max = 4096
+
+    def __init__(self):
+        self._stream_writer = SimpleNamespace(write=lambda data: None)
+
+    async def ensure_open(self):
+        pass
+
+    async def _drain(self):
+        pass
+
+def test_ack_every(loop):
+    """
+    Test a batch of messages is acknowledged with a single ack.
+    """
+
+    channel = AckChannel()
+    acker = BatchAcker(channel, 3, 60)
+
+    async def receive():
+        for tag in range(1, 8):
+            await acker.ack(tag)
+
+    loop.run_until_complete(receive())
+    assert channel.acks == [(3, True), (6, True)]
+
+    loop.run_until_complete(acker.flush())
+    assert channel.acks == [(3, True), (6, True), (7, True)]
+
+def test_ack_delay(loop):
+    """
+    Test messages are acknowledged once the oldest one is delay seconds old.
+    """
+
+    channel = AckChannel()
+    acker = BatchAcker(channel, 100, 0.05)
+
+    loop.run_until_complete(acker.ack(1))
+    loop.run_until_complete(acker.ack(2))
+    assert channel.acks == []
+
+    loop.run_until_complete(asyncio.sleep(0.2))
+    assert channel.acks == [(2, True)]
+    assert acker.timer is None
+
+def make_confirmed_channel(loop, window):
+    """
+    Put an AMQPChannel in confirm mode, the broker confirming at once.
+    """
+
+    channel = AMQPChannel(Protocol(), 1)
+    create = ConfirmedChannel.create(channel, window)
+    chan, _ = loop.run_until_complete(
+        asyncio.gather(create, channel.dispatch_frame(Confirm.SelectOk()))
+    )
+    return channel, chan
+
+def publish(chan):
+    return chan.basic_publish(b"{}", exchange_name="events", routing_key="")
+
+def test_confirm_window(loop):
+    """
+    Test publishing waits for the broker to confirm messages beyond the window.
+    """
+
+    channel, chan = make_confirmed_channel(loop, 2)
+    loop.run_until_complete(publish(chan))
+    loop.run_until_complete(publish(chan))
+
+    third = asyncio.ensure_future(publish(chan))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert not third.done()
+
+    loop.run_until_complete(channel.dispatch_frame(Basic.Ack(2, multiple=True)))
+    loop.run_until_complete(third)
+    assert chan.unconfirmed == {3}
+
+    loop.run_until_complete(channel.dispatch_frame(Basic.Ack(3)))
+    loop.run_until_complete(chan.wait_confirmed())
+
+def test_confirm_nack(loop):
+    """
+    Test a message rejected by the broker fails the publisher.
+    """
+
+    channel, chan = make_confirmed_channel(loop, 10)
+    for _ in range(3):
+        loop.run_until_complete(publish(chan))
+
+    loop.run_until_complete(channel.dispatch_frame(Basic.Nack(2)))
+    loop.run_until_complete(channel.dispatch_frame(Basic.Ack(3, multiple=True)))
+
+    with pytest.raises(TransportError):
+        loop.run_until_complete(chan.wait_confirmed())
+    with pytest.raises(TransportError):
+        loop.run_until_complete(publish(chan))
@@ -0,0 +1,78 @@
+"""
+Test the asyncio RPC proxy against a controller.
+"""
+
+import asyncio
+
+import pytest
+
+from matrix.rawjson import RawJSON
+from matrix.client.rpcproxy import RPCException
+from matrix.client.async_rpcproxy import AsyncRPCProxy
+
+QUEUE_BYTES = 1000
+NUM_CHUNKS = 8
+
+# Publish every chunk as is, and block the agent once two chunks are queued
+CONFIG = {
+    "publish_max_bytes": 1,
+    "max_local_queue_bytes": QUEUE_BYTES,
+    "max_store_queue_bytes": QUEUE_BYTES,
+}
+
+def make_chunk(i):
+    events = [["test", "store", [f"agent{j}", 1], ["update", [i, j]]] for j in range(10)]
+    return RawJSON.dumps(events)
+
+@pytest.mark.parametrize("framing, port", [(None, 17101), ("json", 17102)])
+def test_overlapping_calls(start_controller, loop, framing, port):
+    """
+    Test responses to calls in flight are matched to them as they arrive.
+
+    The store process's queue is not drained at first,
+    so the calls handing over events block once the queues are full,
+    while later calls complete.
+    Concurrent calls may complete in any order,
+    and so the chunks may be queued in any order.
+    """
+
+    controller = start_controller(port, **CONFIG)
+
+    async def run():
+        async with AsyncRPCProxy("127.0.0.1", port, framing) as agent:
+            chunks = [make_chunk(i) for i in range(NUM_CHUNKS)]
+            assert all(len(c) > QUEUE_BYTES // 2 for c in chunks)
+
+            calls = [
+                asyncio.ensure_future(
+                    agent.call("register_events", agentproc_id=0, events=chunk)
+                )
+                for chunk in chunks
+            ]
+            await asyncio.sleep(1)
+            blocked = [c for c in calls if not c.done()]
+            assert blocked
+
+            stats, seed = await asyncio.gather(
+                agent.call("get_queue_stats"),
+                agent.call("get_agentproc_seed", agentproc_id=0),
+            )
+            assert stats["stores"][0]["bytes"] >= QUEUE_BYTES
+            assert isinstance(seed, int)
+            with pytest.raises(RPCException):
+                await agent.call("get_agentproc_seed", agentproc_id=1)
+            assert not any(c.done() for c in blocked)
+
+            # Drain the store process's queue from a connection of its own
+            received = []
+            async with AsyncRPCProxy("127.0.0.1", port, framing) as store:
+                for _ in range(NUM_CHUNKS):
+                    ret = await store.call("get_events", storeproc_id=0)
+                    assert ret["code"] == "EVENTS"
+                    received.append(ret["events"])
+
+            assert await asyncio.gather(*calls) == [True] * NUM_CHUNKS
+            assert sorted(received) == sorted(c.loads() for c in chunks)
+
+    loop.run_until_complete(asyncio.wait_for(run(), 60))
+    assert controller.poll() is None
@@ -3,12 +3,17 @@ Test the matrix controller with the bluepill agents.
 """
 # pylint: disable=redefined-outer-name
 
+import csv
+import json
 import time
 import random
+import socket
 import sqlite3
 
 import yaml
 
+from matrix.metrics import FIELDS, PHASES, COUNTERS, extra_path
+
 CONFIG_BASE = """
 rabbitmq_host: localhost
 rabbitmq_port: 5672
@@ -34,9 +39,10 @@ def assert_equal_event_tables(dsn1, dsn2):
     rows1 = list(cur1.execute("select * from event order by rowid"))
     rows2 = list(cur2.execute("select * from event order by rowid"))
 
+    assert rows1
     assert rows1 == rows2
 
-def do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range):
+def do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, unix_socket=False, transport=None, barrier=None, metrics=False, sqlite_profile=None, store_max_cache_bytes=None, flush_depth=None):
     """
     Do the tests.
     """
@@ -53,6 +59,24 @@ def do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range):
     cfg["num_agentprocs"]  = {f"node{i}": random.randint(*num_agentproc_range) for i in node_idxs}
     cfg["num_storeprocs"]  = {f"node{i}": 1 for i in node_idxs}
     cfg["_state_dsn"]      = {f"node{i}": tempdir / f"state{i}.db" for i in node_idxs}
+    if unix_socket:
+        cfg["controller_socket"] = {f"node{i}": str(tempdir / f"node{i}.sock") for i in node_idxs}
+    if transport is not None:
+        cfg["transport"] = transport
+    if barrier is not None:
+        cfg["barrier"] = barrier
+        cfg["barrier_fanout"] = 2
+    if transport == "mesh":
+        cfg["mesh_address"]     = {f"node{i}": f"127.0.0.1:{18001 + i}" for i in node_idxs}
+        cfg["eventlog_address"] = "127.0.0.1:18000"
+    if sqlite_profile is not None:
+        cfg["sqlite_profile"] = sqlite_profile
+    if store_max_cache_bytes is not None:
+        cfg["store_max_cache_bytes"] = store_max_cache_bytes
+    if metrics:
+        # The first node writes json lines, the others CSV
+        cfg["metrics_file"] = {f"node{i}": str(tempdir / f"metrics{i}.csv") for i in node_idxs}
+        cfg["metrics_file"]["node0"] = str(tempdir / "metrics0.jsonl")
 
     with open(config_fname, "wt") as fobj:
         fobj.write(yaml.dump(cfg))
@@ -80,24 +104,28 @@ def do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range):
     # Start all the store processes
     for node in cfg["sim_nodes"]:
         state_dsn = cfg["_state_dsn"][node]
-        port = cfg["controller_port"][node]
+        port = cfg["controller_socket"][node] if unix_socket else cfg["controller_port"][node]
         num_storeprocs = cfg["num_storeprocs"][node]
 
         for storeproc_id in range(num_storeprocs):
             # Start bluepill agent process
             cmd = f"matrix sqlite3-store -p {port} -s {state_dsn} -d event_store -i {storeproc_id}"
+            if flush_depth is not None:
+                cmd += f" -D {flush_depth}"
             storeproc = popener(cmd, shell=True, output_prefix=f"bluepill-store-{node}-{storeproc_id}")
             all_procs.append(storeproc)
 
     # Start all the agent processes
     for node in cfg["sim_nodes"]:
         state_dsn = cfg["_state_dsn"][node]
-        port = cfg["controller_port"][node]
+        port = cfg["controller_socket"][node] if unix_socket else cfg["controller_port"][node]
         num_agentprocs = cfg["num_agentprocs"][node]
 
         for agentproc_id in range(num_agentprocs):
             # Start bluepill agent process
             cmd = f"bluepill agent-start -n {node} -p {port} -s {state_dsn} -i {agentproc_id}"
+            if sqlite_profile is not None:
+                cmd += f" -P {sqlite_profile}"
             agentproc = popener(cmd, shell=True, output_prefix=f"bluepill-agent-{node}-{agentproc_id}")
             all_procs.append(agentproc)
 
@@ -131,6 +159,44 @@ def do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range):
         for rest_state_dsn in rest_state_dsns:
             assert_equal_event_tables(first_state_dsn, rest_state_dsn)
 
+    # Check the metrics, one record per round
+    if metrics:
+        for node in cfg["sim_nodes"]:
+            with open(cfg["metrics_file"][node]) as fobj:
+                if node == "node0":
+                    records = [json.loads(line) for line in fobj]
+                else:
+                    records = list(csv.DictReader(fobj))
+            assert [int(r["round"]) for r in records] == list(range(cfg["num_rounds"] + 1))
+
+            starts = []
+            for record in records:
+                assert record["node"] == node
+                assert set(FIELDS) <= set(record)
+
+                phase_times = [float(record[f"{phase}_time"]) for phase in PHASES]
+                assert all(t >= 0 for t in phase_times)
+                assert sum(phase_times) <= float(record["wall_time"]) + 1e-6
+
+                for counter in COUNTERS:
+                    assert int(record[counter]) >= 0
+                starts.append(float(record["start"]))
+            assert starts == sorted(starts)
+
+            # The other controllers sent the node their events
+            if num_nodes > 1:
+                assert sum(int(r["msgs_received"]) for r in records) > 0
+                assert sum(int(r["bytes_received"]) for r in records) > 0
+
+            # The RPC histograms of CSV files are written apart
+            if node != "node0":
+                with open(extra_path(cfg["metrics_file"][node])) as fobj:
+                    extra = [json.loads(line) for line in fobj]
+                assert [r["round"] for r in extra] == [int(r["round"]) for r in records]
+                assert all(r["node"] == node for r in extra)
+                records = extra
+            assert any("can_we_start_yet" in r["rpc"] for r in records)
+
 def test_bluepill1(tempdir, popener):
     """
     Test the basic overall run with one agent.
@@ -150,3 +216,146 @@ def test_bluepill7(tempdir, popener):
     num_agentproc_range = 10, 20
 
     do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range)
+
+def test_bluepill1_unix_socket(tempdir, popener):
+    """
+    Test the basic overall run with agents connecting over a unix socket.
+    """
+
+    num_nodes = 1
+    num_agentproc_range = 2, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, unix_socket=True)
+
+def test_bluepill1_stale_socket(tempdir, popener):
+    """
+    Test the controller replacing the unix socket of a crashed run.
+    """
+
+    socket_path = tempdir / "node0.sock"
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(str(socket_path))
+    assert socket_path.exists()
+
+    num_nodes = 1
+    num_agentproc_range = 2, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, unix_socket=True)
+    assert not socket_path.exists()
+
+def test_bluepill1_amqp(tempdir, popener):
+    """
+    Test a single node run through the broker.
+    """
+
+    num_nodes = 1
+    num_agentproc_range = 1, 1
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, transport="amqp")
+
+def test_bluepill3_mesh(tempdir, popener):
+    """
+    Test the controllers connected directly to one another.
+    """
+
+    num_nodes = 3
+    num_agentproc_range = 2, 4
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, transport="mesh")
+
+def test_bluepill7_tree_barrier(tempdir, popener):
+    """
+    Test the controllers ending rounds through the tree barrier.
+    """
+
+    num_nodes = 7
+    num_agentproc_range = 2, 4
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, barrier="tree")
+
+def test_bluepill3_metrics(tempdir, popener):
+    """
+    Test the controllers writing out their per round metrics.
+    """
+
+    num_nodes = 3
+    num_agentproc_range = 1, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, transport="mesh", metrics=True)
+
+def test_bluepill3_trace(tempdir, popener, monkeypatch):
+    """
+    Test merging the traces of the processes of a run.
+    """
+
+    trace_dir = tempdir / "traces"
+    monkeypatch.setenv("MATRIX_TRACE_DIR", str(trace_dir))
+
+    num_nodes = 3
+    num_agentproc_range = 1, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, transport="mesh")
+
+    trace_fname = tempdir / "trace.json"
+    cmd = f"matrix trace merge -o {trace_fname} {trace_dir}"
+    assert popener(cmd, shell=True, output_prefix="trace-merge").wait() == 0
+
+    with open(trace_fname) as fobj:
+        events = json.load(fobj)["traceEvents"]
+
+    # Names of the spans of every process, along with the name it is shown with
+    process_names = {
+        e["pid"]: e["args"]["name"] for e in events if e["name"] == "process_name"
+    }
+    spans = {pid: set() for pid in process_names}
+    for event in events:
+        if event["ph"] == "X":
+            assert event["dur"] >= 0
+            spans[event["pid"]].add(event["name"])
+
+    def process_spans(prefix):
+        return [spans[pid] for pid, name in process_names.items() if name.startswith(prefix)]
+
+    rounds = {f"round {i}" for i in range(1, 11)}
+    for i in range(num_nodes):
+        [controller_spans] = process_spans(f"controller node{i}")
+        assert {"can_we_start_yet", "register_events", "get_events"} <= controller_spans
+        assert {"publish"} | rounds <= controller_spans
+
+    store_spans = process_spans("store ")
+    assert len(store_spans) == num_nodes
+    assert all("flush" in v for v in store_spans)
+
+    agent_spans = process_spans("agent ")
+    assert agent_spans
+    assert all("agent_compute" in v for v in agent_spans)
+
+def test_bluepill3_sqlite_profile(tempdir, popener):
+    """
+    Test the stores and agents with a sqlite performance profile.
+    """
+
+    num_nodes = 3
+    num_agentproc_range = 1, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, sqlite_profile="fast")
+
+def test_bluepill3_spill(tempdir, popener):
+    """
+    Test the stores spilling the updates of every round to disk.
+    """
+
+    num_nodes = 3
+    num_agentproc_range = 1, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, store_max_cache_bytes=1)
+
+def test_bluepill3_flush_writer(tempdir, popener):
+    """
+    Test the stores applying their flushes on a writer thread.
+    """
+
+    num_nodes = 3
+    num_agentproc_range = 1, 2
+
+    do_test_bluepill(tempdir, popener, num_nodes, num_agentproc_range, sqlite_profile="fast", flush_depth=2)
@@ -0,0 +1,117 @@
+"""
+Test the compression of messages exchanged through the broker.
+"""
+
+import json
+import zlib
+
+import pytest
+from attrdict import AttrDict
+
+from matrix import compression
+from matrix.compression import (
+    DEFAULT_LEVELS,
+    CompressionError,
+    compress_parts,
+    decompress,
+    get_compression,
+    zstandard,
+)
+
+NO_ZSTD = pytest.mark.skipif(zstandard is None, reason="zstandard not installed")
+METHODS = ["none", "zlib", pytest.param("zstd", marks=NO_ZSTD)]
+
+def make_parts():
+    """
+    Make the parts of a bluepill like store_events message.
+    """
+
+    events = []
+    for i in range(2000):
+        agent_id = f"node1-0-{i}"
+        sql = "insert into event values (?,?,?)"
+        events.append(["sqlite3", "event_store", [agent_id, 1], [sql, [agent_id, "rock", 1]]])
+
+    head = json.dumps({"jsonrpc": "2.0", "method": "store_events"}).encode("ascii")
+    return [head, json.dumps(events).encode("ascii")]
+
+def test_get_compression():
+    assert get_compression(AttrDict()) == ("none", None)
+
+    config = AttrDict(broker_compression="zlib")
+    assert get_compression(config) == ("zlib", DEFAULT_LEVELS["zlib"])
+
+    config = AttrDict(broker_compression="zlib", broker_compression_level=9)
+    assert get_compression(config) == ("zlib", 9)
+
+    with pytest.raises(CompressionError):
+        get_compression(AttrDict(broker_compression="lzma"))
+
+def test_zstd_fallback(monkeypatch):
+    """
+    Test zstd falls back to zlib, at zlib's level, when zstandard is missing.
+    """
+
+    monkeypatch.setattr(compression, "zstandard", None)
+    config = AttrDict(broker_compression="zstd")
+    assert get_compression(config) == ("zlib", DEFAULT_LEVELS["zlib"])
+
+    config = AttrDict(broker_compression="zstd", broker_compression_level=19)
+    assert get_compression(config) == ("zlib", DEFAULT_LEVELS["zlib"])
+
+@pytest.mark.parametrize("method", METHODS)
+def test_round_trip(method):
+    parts = make_parts()
+    data = b"".join(parts)
+
+    compressed, encoding = compress_parts(method, DEFAULT_LEVELS.get(method), parts)
+    body = b"".join(compressed)
+    if method == "none":
+        assert encoding is None and body == data
+    else:
+        assert len(body) < len(data) // 10
+
+    assert decompress(encoding, body) == data
+
+LEVELS = ["zlib", pytest.param("zstd", marks=NO_ZSTD)]
+
+@pytest.mark.parametrize("method", LEVELS)
+def test_levels(method, monkeypatch):
+    """
+    Test the level is handed to the compressor.
+    """
+
+    levels = []
+    if method == "zlib":
+        compressobj = zlib.compressobj
+
+        def recording_compressobj(level, *args, **kwargs):
+            levels.append(level)
+            return compressobj(level, *args, **kwargs)
+
+        monkeypatch.setattr(zlib, "compressobj", recording_compressobj)
+    else:
+        compressor = zstandard.ZstdCompressor
+
+        def recording_compressor(level, **kwargs):
+            levels.append(level)
+            return compressor(level=level, **kwargs)
+
+        monkeypatch.setattr(zstandard, "ZstdCompressor", recording_compressor)
+
+    parts = make_parts()
+    sizes = []
+    for level in [1, 9]:
+        compressed, encoding = compress_parts(method, level, parts)
+        body = b"".join(compressed)
+        assert decompress(encoding, body) == b"".join(parts)
+        sizes.append(len(body))
+    assert levels == [1, 9]
+
+    # zstd's sizes need not shrink as the level goes up on such small inputs
+    if method == "zlib":
+        assert sizes[1] < sizes[0]
+
+def test_unknown_encoding():
+    with pytest.raises(CompressionError):
+        decompress("lzma", b"")
@@ -0,0 +1,109 @@
+"""
+Test parts of the controller in process.
+"""
+
+import json
+import socket
+from types import SimpleNamespace
+from collections import Counter
+
+import pytest
+
+from matrix.barrier import TOTAL_KEY
+from matrix.controller import Controller, remove_stale_socket
+from matrix.metrics import Metrics
+from matrix.queues import ByteQueue
+from matrix.rawjson import RawJSON
+from matrix.routing import Router
+from matrix.tracing import NullTracer
+
+def test_remove_stale_socket(tempdir):
+    """
+    Test only sockets nothing listens on are removed.
+    """
+
+    path = tempdir / "node0.sock"
+    remove_stale_socket(str(path))
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(str(path))
+        sock.listen()
+        with pytest.raises(OSError):
+            remove_stale_socket(str(path))
+        assert path.exists()
+
+    remove_stale_socket(str(path))
+    assert not path.exists()
+
+    path.write_text("not a socket")
+    remove_stale_socket(str(path))
+    assert path.exists()
+
+def test_queue_raw_events(loop):
+    """
+    Test serialized events larger than a chunk are queued in chunks of events.
+    """
+
+    events = [{"id": i, "text": "a, b] } [ {" * (i % 10)} for i in range(100)]
+    data = json.dumps(events).encode("ascii")
+    controller = SimpleNamespace(
+        ev_queue_local=ByteQueue(0, len),
+        event_chunk_bytes=1000,
+        metrics=SimpleNamespace(peak=lambda name, value: None),
+    )
+
+    async def run():
+        await Controller.queue_local_events(controller, RawJSON(data))
+        chunks = []
+        while not controller.ev_queue_local.empty():
+            chunks.append(await controller.ev_queue_local.get())
+        return chunks
+
+    chunks = loop.run_until_complete(run())
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    assert [e for chunk in chunks for e in json.loads(chunk.data)] == events
+
+    with pytest.raises(ValueError):
+        coro = Controller.queue_local_events(controller, RawJSON(b'{"id": 0}'))
+        loop.run_until_complete(coro)
+
+@pytest.mark.parametrize("max_message_bytes", [None, 1000])
+def test_share_large_events(loop, max_message_bytes):
+    """
+    Test batches larger than the transport's limit are sent as several messages.
+    """
+
+    events = [{"id": i, "text": "x" * 50} for i in range(100)]
+    data = json.dumps(events).encode("ascii")
+
+    controller = Controller.__new__(Controller)
+    controller.nodename = "node0"
+    controller.sim_nodes = ["node0", "node1"]
+    controller.cur_round = 1
+    controller.router = Router({"node0": 1, "node1": 1})
+    controller.num_sent = Counter()
+    controller.metrics = Metrics("node0")
+    controller.tracer = NullTracer()
+    controller.max_message_bytes = max_message_bytes
+
+    sent = []
+
+    async def send_message(method, events, **params):
+        sent.append(events)
+
+    controller.send_message = send_message
+    loop.run_until_complete(controller.share_events(RawJSON(data)))
+
+    if max_message_bytes is None:
+        assert len(sent) == 1
+    else:
+        assert len(sent) > 1
+        assert all(len(events) <= max_message_bytes for events in sent)
+    num_sent = len(sent)
+    assert controller.num_sent == {
+        "node0": num_sent,
+        "node1": num_sent,
+        TOTAL_KEY: num_sent,
+    }
+    assert [e for events in sent for e in json.loads(events.data)] == events
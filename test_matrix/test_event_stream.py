@@ -0,0 +1,156 @@
+"""
+Test the events pushed by the controller to subscribed store processes.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from matrix.controller import EventSubscription, RequestPipeline
+from matrix.json_rpc import rpc_request
+from matrix.client.sqlite3_store import stream_events
+
+class Controller:
+    """
+    Controller side of a store process's events queue.
+    """
+
+    def __init__(self, items):
+        self.queue = asyncio.Queue()
+        for item in items:
+            self.queue.put_nowait(item)
+        self.num_taken = 0
+
+    async def next_events(self, storeproc_id):
+        item = await self.queue.get()
+        self.num_taken += 1
+        return item
+
+def start_subscription(items, window):
+    """
+    Start pushing items, returning the subscription and the pushes sent.
+    """
+
+    controller = Controller(items)
+    pushes = []
+
+    async def send(msg):
+        pushes.append(msg["params"])
+
+    subscription = EventSubscription(controller, 0, window, send)
+    task = asyncio.ensure_future(subscription.run())
+    return subscription, controller, pushes, task
+
+def settle(loop):
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+def test_window(loop):
+    """
+    Test no more than window pushes are ever unacknowledged.
+    """
+
+    items = [("EVENTS", [i]) for i in range(10)] + [("SIMEND", None)]
+    subscription, _, pushes, task = start_subscription(items, 3)
+
+    settle(loop)
+    assert [p["seq"] for p in pushes] == [1, 2, 3]
+
+    loop.run_until_complete(subscription.ack(2))
+    settle(loop)
+    assert [p["seq"] for p in pushes] == [1, 2, 3, 4, 5]
+
+    while not task.done():
+        assert len(pushes) <= subscription.acked + 3
+        loop.run_until_complete(subscription.ack(len(pushes)))
+        settle(loop)
+
+    assert [p["events"] for p in pushes[:10]] == [[i] for i in range(10)]
+    assert pushes[-1]["code"] == "SIMEND"
+
+def test_flush_fence(loop):
+    """
+    Test nothing is taken out of the queue after a FLUSH till it is acknowledged.
+    """
+
+    items = [("EVENTS", [1]), ("FLUSH", None), ("EVENTS", [2]), ("SIMEND", None)]
+    subscription, controller, pushes, task = start_subscription(items, 10)
+
+    settle(loop)
+    assert [p["code"] for p in pushes] == ["EVENTS", "FLUSH"]
+    assert controller.num_taken == 2
+
+    loop.run_until_complete(subscription.ack(1))
+    settle(loop)
+    assert controller.num_taken == 2
+
+    loop.run_until_complete(subscription.ack(2))
+    settle(loop)
+    assert [p["code"] for p in pushes] == ["EVENTS", "FLUSH", "EVENTS", "SIMEND"]
+    assert task.done()
+
+class Proxy:
+    """
+    Connection of a store process receiving the given pushes.
+    """
+
+    def __init__(self, pushes, log):
+        self.pushes = list(pushes)
+        self.log = log
+
+    def call(self, method, **params):
+        assert method == "subscribe_events"
+        return True
+
+    def receive(self):
+        return "push_events", self.pushes.pop(0)
+
+    def notify(self, method, seq):
+        assert method == "ack_events"
+        self.log.append(("ack", seq))
+
+def test_store_acks():
+    """
+    Test the store process acknowledges a FLUSH only once it has flushed.
+    """
+
+    codes = ["EVENTS"] * 5 + ["FLUSH", "EVENTS", "SIMEND"]
+    pushes = [{"seq": i, "code": c, "events": []} for i, c in enumerate(codes, 1)]
+    log = []
+
+    for code, _ in stream_events(Proxy(pushes, log), 0, 4):
+        log.append(code)
+        if code == "SIMEND":
+            break
+
+    assert log == [
+        "EVENTS",
+        "EVENTS",
+        ("ack", 2),
+        "EVENTS",
+        "EVENTS",
+        ("ack", 4),
+        "EVENTS",
+        "FLUSH",
+        ("ack", 6),
+        "EVENTS",
+        "SIMEND",
+    ]
+
+def test_failed_ack_notification(loop):
+    """
+    Test a failed ack_events notification gets no response, unlike a call.
+    """
+
+    responses = []
+
+    async def drain():
+        pass
+
+    writer = SimpleNamespace(drain=drain)
+    pipeline = RequestPipeline(None, writer, lambda writer, msg: responses.append(msg))
+
+    # The connection has no event subscription to acknowledge
+    loop.run_until_complete(pipeline.submit(rpc_request("ack_events", id=False, seq=1)))
+    assert responses == []
+
+    loop.run_until_complete(pipeline.submit(rpc_request("ack_events", id=1, seq=1)))
+    assert len(responses) == 1 and "error" in responses[0]
@@ -0,0 +1,157 @@
+"""
+Test the length prefixed framing of the controller RPC channel.
+"""
+
+import socket
+import asyncio
+
+import pytest
+
+from matrix.rawjson import RawJSON
+from matrix.framing import (
+    COALESCE_LIMIT,
+    HEADER,
+    FramingError,
+    available_codecs,
+    handshake_request,
+    parse_handshake,
+    message_frames,
+    write_message,
+    read_message,
+    send_message,
+    recv_message,
+)
+
+MESSAGE = {
+    "jsonrpc": "2.0",
+    "id": "1",
+    "method": "register_events",
+    "params": {"agentproc_id": 0, "events": RawJSON(b'[["sqlite3", "x", [1], null]]')},
+}
+
+class Writer:
+    """
+    Stream writer collecting the data written to it.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+def read_from(loop, data, num_messages=1, codec="json", keep_raw=True, **kwargs):
+    """
+    Read messages from a stream containing the given data.
+    """
+
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes(data))
+        reader.feed_eof()
+        return [
+            await read_message(reader, codec, keep_raw, **kwargs)
+            for _ in range(num_messages)
+        ]
+
+    msgs = loop.run_until_complete(read())
+    return msgs if num_messages > 1 else msgs[0]
+
+def encoded(codec, msg):
+    writer = Writer()
+    write_message(writer, codec, msg)
+    return writer.data
+
+def test_handshake():
+    for codec in available_codecs():
+        assert parse_handshake(handshake_request(codec)) == codec
+
+    assert parse_handshake(b"MATRIX-FRAMED\n") == ""
+    assert parse_handshake(b'{"jsonrpc": "2.0", "method": "x"}\n') is None
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_round_trip(loop, codec):
+    """
+    Test messages with attachments through streams and sockets.
+    """
+
+    data = encoded(codec, MESSAGE)
+    assert len(message_frames(codec, MESSAGE)) == 2
+
+    events = MESSAGE["params"]["events"]
+    expected = dict(MESSAGE, params=dict(MESSAGE["params"], events=events.loads()))
+    msgs = read_from(loop, data + data, 3, codec, keep_raw=False)
+    assert msgs == [expected, expected, None]
+
+    msg = read_from(loop, data, 1, codec)
+    events = msg["params"]["events"]
+    assert isinstance(events, RawJSON)
+    assert bytes(events.data) == MESSAGE["params"]["events"].data
+
+    sock1, sock2 = socket.socketpair()
+    with sock1, sock2:
+        send_message(sock1, codec, MESSAGE)
+        assert recv_message(sock2, codec, keep_raw=False) == expected
+
+def test_truncated(loop):
+    """
+    Test streams ending in the middle of a message.
+    """
+
+    data = encoded("json", MESSAGE)
+    assert read_from(loop, b"") is None
+
+    first_size = HEADER.unpack(data[: HEADER.size])[0] + HEADER.size
+    for end in [3, HEADER.size + 5, first_size, first_size + 3, len(data) - 1]:
+        with pytest.raises(FramingError):
+            read_from(loop, data[:end])
+
+def test_large_frames(loop):
+    """
+    Test frames larger than the reader's buffer, received piece by piece.
+    """
+
+    events = RawJSON.dumps([["sqlite3", "x", [i], "y" * 100] for i in range(2000)])
+    assert len(events) > 2 * COALESCE_LIMIT
+    msg = dict(MESSAGE, params=dict(MESSAGE["params"], events=events))
+    data = bytes(encoded("json", msg))
+
+    async def read(data):
+        reader = asyncio.StreamReader()
+
+        async def feed():
+            for i in range(0, len(data), 10000):
+                reader.feed_data(data[i : i + 10000])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            return await read_message(reader, "json", keep_raw=True)
+        finally:
+            await feeder
+
+    received = loop.run_until_complete(read(data))
+    assert received["params"]["events"].data == events.data
+
+    with pytest.raises(FramingError):
+        loop.run_until_complete(read(data[:-1]))
+
+def test_frame_size_limit(loop):
+    """
+    Test frames larger than the limit are refused before they are read.
+    """
+
+    with pytest.raises(FramingError):
+        read_from(loop, HEADER.pack(2 ** 62))
+
+    data = encoded("json", MESSAGE)
+    assert read_from(loop, data, max_size=len(data))
+    with pytest.raises(FramingError):
+        read_from(loop, data, max_size=20)
+
+    sock1, sock2 = socket.socketpair()
+    with sock1, sock2:
+        sock1.sendall(HEADER.pack(2 ** 62))
+        with pytest.raises(FramingError):
+            recv_message(sock2, "json", keep_raw=True)
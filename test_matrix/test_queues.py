@@ -0,0 +1,63 @@
+"""
+Test the queues bounded by the number of bytes buffered.
+"""
+
+import asyncio
+
+from matrix.queues import ByteQueue
+
+def test_bounded_by_bytes(loop):
+    """
+    Test puts wait once max_bytes are buffered, however many items that is.
+    """
+
+    async def run():
+        queue = ByteQueue(100)
+
+        for _ in range(99):
+            await asyncio.wait_for(queue.put(b"x"), 1)
+        assert queue.stats() == {"items": 99, "bytes": 99, "max_bytes": 100}
+
+        # Accepted below the limit, even though it overshoots it
+        await asyncio.wait_for(queue.put(b"x" * 50), 1)
+        assert queue.num_bytes == 149
+
+        put = asyncio.ensure_future(queue.put(b"x"))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+
+        # Taking out items frees bytes, the put waits till below the limit
+        for _ in range(49):
+            queue.get_nowait()
+        await asyncio.sleep(0.01)
+        assert not put.done()
+
+        queue.get_nowait()
+        await asyncio.wait_for(put, 1)
+        assert queue.num_bytes == 100
+
+    loop.run_until_complete(run())
+
+def test_large_item(loop):
+    """
+    Test an empty queue accepts an item larger than max_bytes.
+    """
+
+    async def run():
+        queue = ByteQueue(10, sizeof=lambda item: item["size"])
+        await asyncio.wait_for(queue.put({"size": 1000}), 1)
+        assert queue.full()
+
+        assert (await queue.get())["size"] == 1000
+        assert queue.num_bytes == 0 and not queue.full()
+
+    loop.run_until_complete(run())
+
+def test_unbounded(loop):
+    async def run():
+        queue = ByteQueue(0)
+        for _ in range(10):
+            await asyncio.wait_for(queue.put(b"x" * 2 ** 20), 1)
+        assert not queue.full()
+
+    loop.run_until_complete(run())
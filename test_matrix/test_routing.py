@@ -0,0 +1,57 @@
+"""
+Test routing events to the store processes interested in them.
+"""
+
+from matrix.routing import Router
+from matrix.rawjson import RawJSON
+
+A = ["sqlite3", "a"]
+B = ["sqlite3", "b"]
+
+def test_destinations():
+    """
+    Test events go only to the store processes that declared their key.
+    """
+
+    router = Router({"node0": 2, "node1": 1})
+    router.set_interests("node0", [[A], [B]])
+    router.set_interests("node1", [None])
+
+    assert router.active
+    assert router.destinations(tuple(A)) == (("node0", (0,)), ("node1", (0,)))
+    assert router.destinations(tuple(B)) == (("node0", (1,)), ("node1", (0,)))
+
+def test_unannounced_node():
+    """
+    Test a node whose interests have not arrived yet is sent every event.
+    """
+
+    router = Router({"node0": 1, "node1": 2})
+    assert not router.active
+
+    router.set_interests("node0", [[A]])
+    assert router.active
+    assert router.destinations(tuple(B)) == (("node1", (0, 1)),)
+
+    router.set_interests("node1", [[A], [A]])
+    assert not router.active
+    assert router.destinations(tuple(B)) == ()
+
+def test_route():
+    """
+    Test splitting a batch of events by destination.
+    """
+
+    router = Router({"node0": 1, "node1": 1})
+    router.set_interests("node0", [[A]])
+    router.set_interests("node1", [[B]])
+
+    events = RawJSON.dumps([A + [1, "x"], B + [1, "y"], A + [2, "z"]])
+    groups = {
+        tuple(sorted(storeprocs)): group.loads()
+        for storeprocs, group in router.route(events)
+    }
+    assert groups == {
+        ("node0",): [A + [1, "x"], A + [2, "z"]],
+        ("node1",): [B + [1, "y"]],
+    }
@@ -0,0 +1,56 @@
+"""
+Test the RPC proxy against a controller.
+"""
+
+import itertools
+
+import pytest
+
+from matrix.client import rpcproxy
+from matrix.client.rpcproxy import RPCProxy, RPCException
+
+@pytest.mark.parametrize("framing, port", [(None, 17111), ("json", 17112)])
+def test_batch(start_controller, framing, port):
+    """
+    Test a batch with failing calls returns the results of the others.
+    """
+
+    controller = start_controller(port)
+
+    with RPCProxy("127.0.0.1", port, framing) as proxy:
+        seed = proxy.call("get_agentproc_seed", agentproc_id=0)
+
+        with proxy.batch() as batch:
+            batch.call("get_agentproc_seed", agentproc_id=0)
+            batch.call("get_agentproc_seed", agentproc_id=1)
+            batch.call("get_queue_stats")
+            batch.call("no_such_method")
+
+        results = batch.results
+        assert len(results) == 4
+        assert results[0] == seed
+        assert isinstance(results[1], RPCException)
+        assert results[2]["local"]["items"] == 0
+        assert isinstance(results[3], RPCException)
+        assert "Unknown RPC method" in str(results[3])
+
+        # The connection is still usable
+        assert proxy.call("get_agentproc_seed", agentproc_id=0) == seed
+
+    assert controller.poll() is None
+
+def test_connect_failure(tempdir, monkeypatch):
+    """
+    Test a proxy that failed to connect can still be closed.
+    """
+
+    clock = itertools.count(0, 30)
+    monkeypatch.setattr(rpcproxy.time, "time", lambda: next(clock))
+    monkeypatch.setattr(rpcproxy.time, "sleep", lambda seconds: None)
+
+    proxy = RPCProxy.__new__(RPCProxy)
+    with pytest.raises(RuntimeError):
+        proxy.__init__(None, str(tempdir / "missing.sock"))
+
+    proxy.close()
+    assert proxy.sock is None
@@ -0,0 +1,48 @@
+"""
+Test the spilled runs of store updates.
+"""
+
+import gc
+import threading
+
+from matrix.client.spill import SpilledRun, gc_paused
+
+def test_spilled_run(tmpdir):
+    """
+    Test reading back a run spanning several batches.
+    """
+
+    sql = "insert into event values (?)"
+    updates = [[[f"agent{i:05}", 1], sql, [i]] for i in range(10000)]
+    run = SpilledRun(updates, str(tmpdir))
+
+    assert run.count == len(updates)
+    assert list(run) == updates
+    assert run.fobj.closed
+
+def test_gc_paused_threads():
+    """
+    Test the collector stays paused till the pauses of all threads end.
+    """
+
+    assert gc.isenabled()
+
+    entered = threading.Event()
+    leave = threading.Event()
+
+    def writer():
+        with gc_paused():
+            entered.set()
+            leave.wait()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    entered.wait()
+
+    with gc_paused():
+        assert not gc.isenabled()
+    assert not gc.isenabled()
+
+    leave.set()
+    thread.join()
+    assert gc.isenabled()